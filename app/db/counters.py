@@ -0,0 +1,91 @@
+"""
+Maintenance for the denormalized vote counters on Question and QuestionTagLink.
+
+The vote routes keep the counters in sync transactionally; this recomputes them
+from the raw vote rows after a crash, a manual edit or a migration.
+
+    python -m app.db.counters          # reconcile
+    python -m app.db.counters --check  # only report drift
+"""
+import argparse
+
+from sqlalchemy import func, update
+from sqlmodel import Session, select
+
+from app.db.revisions import next_revision
+from app.models import Question, QuestionTagLink, QuestionTagVote, QuestionVote
+
+
+def _question_total():
+    return (
+        select(func.coalesce(func.sum(QuestionVote.vote_value), 0))
+        .where(QuestionVote.question_id == Question.id)
+        .scalar_subquery()
+    )
+
+
+def _question_tag_total():
+    return (
+        select(func.coalesce(func.sum(QuestionTagVote.vote_value), 0))
+        .where(
+            QuestionTagVote.question_id == QuestionTagLink.question_id,
+            QuestionTagVote.tag_id == QuestionTagLink.tag_id,
+        )
+        .scalar_subquery()
+    )
+
+
+def count_vote_counter_drift(session: Session) -> tuple[int, int]:
+    """Return how many question and question-tag counters disagree with the vote rows."""
+    questions = session.exec(
+        select(func.count()).select_from(Question).where(Question.vote_sum != _question_total())
+    ).one()
+    links = session.exec(
+        select(func.count()).select_from(QuestionTagLink).where(QuestionTagLink.vote_sum != _question_tag_total())
+    ).one()
+    return questions, links
+
+
+def rebuild_vote_counters(session: Session) -> tuple[int, int]:
+    """
+    Recompute every counter from the raw vote rows, touching only rows that drifted.
+    Returns the number of question and question-tag rows that were fixed. The caller commits.
+    """
+    question_total = _question_total()
+    questions = session.execute(
+        update(Question)
+        .where(Question.vote_sum != question_total)
+        .values(vote_sum=question_total, revision=next_revision())
+    ).rowcount
+
+    question_tag_total = _question_tag_total()
+    # Questions display their tags' totals, so they change with them
+    drifted_links = select(QuestionTagLink.question_id).where(QuestionTagLink.vote_sum != question_tag_total)
+    session.execute(update(Question).where(Question.id.in_(drifted_links)).values(revision=next_revision()))
+    links = session.execute(
+        update(QuestionTagLink)
+        .where(QuestionTagLink.vote_sum != question_tag_total)
+        .values(vote_sum=question_tag_total)
+    ).rowcount
+    return questions, links
+
+
+def main():
+    from app.db.database import engine
+
+    parser = argparse.ArgumentParser(description="Reconcile denormalized vote counters with the vote tables.")
+    parser.add_argument("--check", action="store_true", help="only report drift, don't write")
+    args = parser.parse_args()
+
+    with Session(engine) as session:
+        if args.check:
+            questions, links = count_vote_counter_drift(session)
+            print(f"{questions} question counters and {links} question-tag counters out of sync")
+            return
+        questions, links = rebuild_vote_counters(session)
+        session.commit()
+    print(f"Fixed {questions} question counters and {links} question-tag counters")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,17 @@
 from typing import Annotated
 
-from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from sqlalchemy import event, make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import Field, Session, SQLModel, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from app import settings
 from app.models import User, Question, Tag, QuestionVote
+from app.db.migrations import upgrade
+from app.db.instrumentation import instrument
+from app.db.profiles import apply_profile
+from app.db.replicas import POLICIES, ReplicaRouter, mark_write, reads_from_primary
 
 # class Hero(SQLModel, table=True):
 #     id: int | None = Field(default=None, primary_key=True)
@@ -11,15 +19,77 @@ from app.models import User, Question, Tag, QuestionVote
 #     age: int | None = Field(default=None, index=True)
 #     secret_name: str
 
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
 
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
+
+def async_url(url: str):
+    """Swap the driver of a sync database URL for its asyncio counterpart."""
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+database_url = make_url(settings.DATABASE_URL)
+is_sqlite = database_url.get_backend_name() == "sqlite"
+connect_args = {"check_same_thread": False} if is_sqlite else {}
+
+
+def pool_args(size: int, overflow: int, url=database_url) -> dict:
+    # In-memory SQLite uses a single static connection and takes no pool sizing
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}
+    return {"pool_size": size, "max_overflow": overflow, "pool_timeout": settings.DB_POOL_TIMEOUT}
+
+
+# SQLite allows one writer at a time; funnelling writes through one pooled
+# connection queues them in the app instead of in busy_timeout retries
+writer_pool = pool_args(1, 0) if is_sqlite else pool_args(settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW)
+reader_pool = pool_args(settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW)
+
+# Sync engine for startup migrations, CLI tools and background threads
+engine = create_engine(database_url, connect_args=connect_args)
+# Async engines used by the routes: writes, and read-only GETs
+async_engine = create_async_engine(async_url(settings.DATABASE_URL), **writer_pool)
+read_engine = create_async_engine(async_url(settings.DATABASE_URL), **reader_pool)
+
+apply_profile(engine, settings.DATABASE_PROFILE)
+apply_profile(async_engine.sync_engine, settings.DATABASE_PROFILE)
+apply_profile(read_engine.sync_engine, settings.DATABASE_PROFILE, read_only=True)
+
+replica_engines = []
+for replica_url in settings.DATABASE_REPLICA_URLS:
+    replica_engine = create_async_engine(
+        async_url(replica_url),
+        pool_pre_ping=True,
+        **pool_args(settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW, make_url(replica_url)),
+    )
+    apply_profile(replica_engine.sync_engine, settings.DATABASE_PROFILE, read_only=True)
+    replica_engines.append(replica_engine)
+
+for instrumented in (engine, async_engine.sync_engine, read_engine.sync_engine, *(e.sync_engine for e in replica_engines)):
+    instrument(instrumented)
+
+# GET routes read from the replicas when there are any, else from read_engine
+read_router = ReplicaRouter(
+    read_engine,
+    replica_engines,
+    policy=POLICIES[settings.DATABASE_READ_POLICY],
+    retry_seconds=settings.REPLICA_RETRY_SECONDS,
+)
+
+
+@event.listens_for(Session, "after_commit")
+def remember_write(session):
+    state = session.info.get("request_state")
+    if state is not None:
+        mark_write(state)
 
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    upgrade(engine)
 
 
 def get_session():
@@ -27,4 +97,23 @@ def get_session():
         yield session
 
 
+async def get_async_session(request: Request):
+    # Objects stay usable after commit; reloading them lazily isn't possible on the event loop
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        if read_router.replicas:
+            # Commits make the client read from the primary for a while
+            session.sync_session.info["request_state"] = request.state
+        yield session
+
+
+async def get_read_session(request: Request):
+    session = await read_router.open_session(use_primary=reads_from_primary(request))
+    async with session:
+        yield session
+
+
 SessionDep = Annotated[Session, Depends(get_session)]
+AsyncSessionDep = Annotated[AsyncSession, Depends(get_async_session)]
+# For routes that only read; on a replica unless the client just wrote, and
+# its connections refuse writes
+ReadSessionDep = Annotated[AsyncSession, Depends(get_read_session)]
@@ -0,0 +1,148 @@
+"""
+Query counts and timings per request and per route.
+
+Every statement run on an instrumented engine is counted against the current
+request's QueryStats (a contextvar set by QueryInstrumentationMiddleware) and
+added to the per-route totals in `route_stats`. Statements slower than
+SLOW_QUERY_MS are logged, a SLOW_QUERY_SAMPLE_RATE fraction of them, with the
+route and timing as structured fields. With QUERY_COUNT_HEADER=1 responses
+carry X-Query-Count and X-Query-Time-Ms, which makes N+1 regressions in
+QuestionPublic.from_question / TagPublic.from_tag show up right away.
+Streamed pages (no Content-Length) run most of their queries after the
+headers went out, so they get no header; their counts are logged once the
+body is done instead. db_queries_per_request always has the full count.
+Statements that fail with "database is locked" are counted in
+db_lock_errors_total.
+"""
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+
+from sqlalchemy import Engine, event
+
+from app import settings
+from app.metrics import db_lock_errors, db_queries_per_request, db_query_seconds_per_request
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class QueryStats:
+    count: int = 0
+    duration: float = 0.0  # seconds
+    scope: dict = field(default_factory=dict, repr=False)
+
+    @property
+    def route(self) -> Optional[str]:
+        # FastAPI puts the matched route in the scope before calling the endpoint
+        return getattr(self.scope.get("route"), "path", None)
+
+
+@dataclass
+class RouteQueryStats:
+    requests: int = 0
+    queries: int = 0
+    duration: float = 0.0  # seconds spent in queries
+    max_queries: int = 0
+
+
+current_query_stats: ContextVar[Optional[QueryStats]] = ContextVar("current_query_stats", default=None)
+
+# route path -> totals since startup
+route_stats: dict[str, RouteQueryStats] = {}
+_route_stats_lock = threading.Lock()
+
+
+def instrument(engine: Engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats = current_query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.duration += elapsed
+
+    if elapsed * 1000 >= settings.SLOW_QUERY_MS and random.random() < settings.SLOW_QUERY_SAMPLE_RATE:
+        route = stats.route if stats else None
+        logger.warning(
+            "Slow query: %.1fms route=%s statement=%s",
+            elapsed * 1000,
+            route,
+            " ".join(statement.split())[:500],
+            extra={"duration_ms": round(elapsed * 1000, 3), "route": route, "statement": statement},
+        )
+
+
+def _handle_error(context):
+    # after_cursor_execute doesn't run for a failed statement
+    if context.connection is not None and context.connection.info.get("query_started"):
+        context.connection.info["query_started"].pop()
+    if "database is locked" in str(context.original_exception):
+        db_lock_errors.inc()
+
+
+def record_route(route: str, stats: QueryStats):
+    with _route_stats_lock:
+        totals = route_stats.setdefault(route, RouteQueryStats())
+        totals.requests += 1
+        totals.queries += stats.count
+        totals.duration += stats.duration
+        totals.max_queries = max(totals.max_queries, stats.count)
+    db_queries_per_request.observe(route, value=stats.count)
+    db_query_seconds_per_request.observe(route, value=stats.duration)
+
+
+class QueryInstrumentationMiddleware:
+    """Collects QueryStats for each HTTP request and reports them per route."""
+
+    def __init__(self, app, header: bool = False):
+        self.app = app
+        self.header = header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = QueryStats(scope=scope)
+        token = current_query_stats.set(stats)
+        streamed = False
+
+        async def send_with_stats(message):
+            nonlocal streamed
+            if message["type"] == "http.response.start" and self.header:
+                headers = message.get("headers", [])
+                streamed = not any(name.lower() == b"content-length" for name, _ in headers)
+                if not streamed:
+                    message = {**message, "headers": [
+                        *headers,
+                        (b"x-query-count", str(stats.count).encode()),
+                        (b"x-query-time-ms", f"{stats.duration * 1000:.1f}".encode()),
+                    ]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            current_query_stats.reset(token)
+            if stats.route is not None:
+                record_route(stats.route, stats)
+            if streamed:
+                logger.info(
+                    "Streamed response: %d queries in %.1fms route=%s",
+                    stats.count,
+                    stats.duration * 1000,
+                    stats.route,
+                    extra={"queries": stats.count, "duration_ms": round(stats.duration * 1000, 3), "route": stats.route},
+                )
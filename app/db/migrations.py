@@ -0,0 +1,130 @@
+"""
+In-place upgrades for an existing database.db.
+
+create_all only creates missing tables, so columns and indexes added to
+existing tables are applied here. Every step is idempotent and runs on startup.
+"""
+from sqlalchemy import Engine, Table, inspect, select, text, update
+from sqlmodel import Session
+
+from app.db.counters import rebuild_vote_counters
+from app.db.revisions import create_revision_counter, next_revision
+from app.models import Question, QuestionTagLink, QuestionTagVote, QuestionVote, Tag
+from app.models.tag import normalize_tag_name
+from app.services import rankings, search
+
+# Columns of app/services/rankings.py, on Question and QuestionTagLink
+RANKING_COLUMNS = {
+    "up_count": "INTEGER NOT NULL DEFAULT 0",
+    "down_count": "INTEGER NOT NULL DEFAULT 0",
+    "hot_score": "FLOAT NOT NULL DEFAULT 0",
+    "wilson_score": "FLOAT NOT NULL DEFAULT 0",
+    "controversy_score": "FLOAT NOT NULL DEFAULT 0",
+}
+
+
+def _add_missing_column(conn, table: Table, column: str, ddl: str) -> bool:
+    existing = {c["name"] for c in inspect(conn).get_columns(table.name)}
+    if column in existing:
+        return False
+    conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {column} {ddl}'))
+    return True
+
+
+def _delete_duplicate_votes(conn, table: Table, index: str, key: str) -> int:
+    """Keep only the latest vote per key so the unique index can be created."""
+    if index in {i["name"] for i in inspect(conn).get_indexes(table.name)}:
+        return 0
+    return conn.execute(text(
+        f'DELETE FROM "{table.name}" WHERE id NOT IN '
+        f'(SELECT max(id) FROM "{table.name}" GROUP BY {key})'
+    )).rowcount
+
+
+def _merge_duplicate_tags(conn) -> int:
+    """
+    Fill in Tag.normalized_name and fold tags whose names only differ in case
+    or spacing into the oldest of them, so the unique index can be created.
+    Returns the number of tags merged away.
+    """
+    if "uq_tag_normalized_name" in {i["name"] for i in inspect(conn).get_indexes(Tag.__table__.name)}:
+        return 0
+    keepers: dict[str, int] = {}
+    merged = 0
+    for tag_id, name in conn.execute(text("SELECT id, name FROM tag ORDER BY id")).all():
+        normalized = normalize_tag_name(name)
+        keeper = keepers.setdefault(normalized, tag_id)
+        if keeper == tag_id:
+            conn.execute(text("UPDATE tag SET normalized_name = :normalized WHERE id = :id"), {"normalized": normalized, "id": tag_id})
+            continue
+
+        ids = {"duplicate": tag_id, "keeper": keeper}
+        # A user who voted on both keeps their vote on the older tag
+        conn.execute(text(
+            "DELETE FROM questiontagvote WHERE tag_id = :duplicate AND EXISTS ("
+            "SELECT 1 FROM questiontagvote AS kept WHERE kept.tag_id = :keeper "
+            "AND kept.user_id = questiontagvote.user_id AND kept.question_id = questiontagvote.question_id)"
+        ), ids)
+        conn.execute(text("UPDATE questiontagvote SET tag_id = :keeper WHERE tag_id = :duplicate"), ids)
+        conn.execute(text(
+            "DELETE FROM questiontaglink WHERE tag_id = :duplicate AND question_id IN ("
+            "SELECT question_id FROM questiontaglink WHERE tag_id = :keeper)"
+        ), ids)
+        conn.execute(text("UPDATE questiontaglink SET tag_id = :keeper WHERE tag_id = :duplicate"), ids)
+        conn.execute(
+            update(Question)
+            .where(Question.id.in_(select(QuestionTagLink.question_id).where(QuestionTagLink.tag_id == keeper)))
+            .values(revision=next_revision())
+        )
+        conn.execute(text("DELETE FROM tag WHERE id = :duplicate"), ids)
+        merged += 1
+    return merged
+
+
+def _create_missing_indexes(engine: Engine, table: Table):
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+
+
+def upgrade(engine: Engine):
+    with engine.begin() as conn:
+        added_counters = _add_missing_column(conn, Question.__table__, "vote_sum", "INTEGER NOT NULL DEFAULT 0")
+        added_counters |= _add_missing_column(conn, QuestionTagLink.__table__, "vote_sum", "INTEGER NOT NULL DEFAULT 0")
+        _add_missing_column(conn, Question.__table__, "revision", "INTEGER NOT NULL DEFAULT 0")
+        create_revision_counter(conn)
+        _add_missing_column(conn, Tag.__table__, "normalized_name", "VARCHAR")
+        added_scores = False
+        for table in (Question.__table__, QuestionTagLink.__table__):
+            for column, ddl in RANKING_COLUMNS.items():
+                added_scores |= _add_missing_column(conn, table, column, ddl)
+
+    with engine.begin() as conn:
+        removed_votes = _delete_duplicate_votes(
+            conn, QuestionVote.__table__, "uq_questionvote_user_question", "user_id, question_id"
+        )
+        removed_votes += _delete_duplicate_votes(
+            conn, QuestionTagVote.__table__, "uq_questiontagvote_user_question_tag", "user_id, question_id, tag_id"
+        )
+        merged_tags = _merge_duplicate_tags(conn)
+
+    for table in (Question.__table__, QuestionVote.__table__, QuestionTagVote.__table__, Tag.__table__):
+        _create_missing_indexes(engine, table)
+
+    if added_counters or removed_votes or merged_tags:
+        # Fresh counter columns start at 0 and deduplication changes the sums;
+        # backfill them from the vote rows
+        with Session(engine) as session:
+            rebuild_vote_counters(session)
+            session.commit()
+    if added_scores or removed_votes or merged_tags:
+        with Session(engine) as session:
+            rankings.rebuild(session)
+            session.commit()
+
+    with engine.begin() as conn:
+        created_search_index = search.create_search_index(conn)
+    if created_search_index or merged_tags:
+        # Index whatever the database already holds
+        with Session(engine) as session:
+            search.rebuild(session)
+            session.commit()
@@ -0,0 +1,178 @@
+"""
+Read replica routing.
+
+With DATABASE_REPLICA_URLS set, ReadSessionDep sessions go to a replica picked
+by the DATABASE_READ_POLICY policy. A replica whose connection fails is skipped
+for REPLICA_RETRY_SECONDS, and reads fall back to the primary when none is
+healthy. Without replicas every read goes to the primary's read pool.
+
+Replicas lag behind the primary, so reads stay on the primary:
+- for the rest of any request that is not a GET or HEAD, e.g. the fragment
+  rendered after a vote;
+- for REPLICA_STICKY_SECONDS after a request committed a write, through the
+  `read_primary_until` cookie set by ReadYourWritesMiddleware.
+
+For local testing, SQLite files can stand in for replicas:
+
+    DATABASE_REPLICA_URLS=sqlite:///replica1.db,sqlite:///replica2.db python -m app.db.replicas --every 2
+"""
+import argparse
+import logging
+import random
+import sqlite3
+import time
+from http.cookies import SimpleCookie
+from itertools import count
+from typing import Callable, Optional, Sequence
+
+from sqlalchemy import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import settings
+
+logger = logging.getLogger(__name__)
+
+STICKY_COOKIE = "read_primary_until"
+
+_turn = count()
+
+
+def round_robin(replicas: Sequence[AsyncEngine]) -> list[AsyncEngine]:
+    start = next(_turn) % len(replicas)
+    return [*replicas[start:], *replicas[:start]]
+
+
+def random_order(replicas: Sequence[AsyncEngine]) -> list[AsyncEngine]:
+    return random.sample(list(replicas), len(replicas))
+
+
+# Policies take the healthy replicas and return them in the order to try
+POLICIES: dict[str, Callable[[Sequence[AsyncEngine]], list[AsyncEngine]]] = {
+    "round_robin": round_robin,
+    "random": random_order,
+}
+
+
+class ReplicaRouter:
+    def __init__(
+        self,
+        primary: AsyncEngine,
+        replicas: Sequence[AsyncEngine] = (),
+        policy: Callable[[Sequence[AsyncEngine]], list[AsyncEngine]] = round_robin,
+        retry_seconds: float = 10,
+    ):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.policy = policy
+        self.retry_seconds = retry_seconds
+        self.fallbacks = 0
+        # engine -> monotonic time until which it is skipped
+        self._down_until: dict[AsyncEngine, float] = {}
+
+    def candidates(self, use_primary: bool = False) -> list[AsyncEngine]:
+        """Engines to try in order; the primary always comes last."""
+        if use_primary or not self.replicas:
+            return [self.primary]
+        now = time.monotonic()
+        healthy = [engine for engine in self.replicas if self._down_until.get(engine, 0) <= now]
+        return [*(self.policy(healthy) if healthy else []), self.primary]
+
+    def mark_down(self, engine: AsyncEngine):
+        logger.warning("Read replica %s failed, skipping it for %ss", engine.url.render_as_string(), self.retry_seconds)
+        self._down_until[engine] = time.monotonic() + self.retry_seconds
+
+    async def open_session(self, use_primary: bool = False) -> AsyncSession:
+        """A read session on the first engine that accepts a connection."""
+        for engine in self.candidates(use_primary):
+            session = AsyncSession(engine, expire_on_commit=False)
+            if engine is self.primary:
+                return session
+            try:
+                # Check a connection out now so a dead replica fails here, not mid-route
+                await session.connection()
+                return session
+            except (DBAPIError, OSError):
+                await session.close()
+                self.mark_down(engine)
+                self.fallbacks += 1
+        raise AssertionError("unreachable: the primary is always a candidate")
+
+    async def dispose(self):
+        for engine in self.replicas:
+            await engine.dispose()
+
+
+def reads_from_primary(request) -> bool:
+    """Whether this request has to see its own (or a recent) write."""
+    if request.method not in ("GET", "HEAD"):
+        return True
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def mark_write(state):
+    """Record on the request state that it committed, for ReadYourWritesMiddleware."""
+    state.read_primary_until = time.time() + settings.REPLICA_STICKY_SECONDS
+
+
+class ReadYourWritesMiddleware:
+    """Sets the sticky cookie on responses to requests that committed a write."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_with_cookie(message):
+            until = scope.get("state", {}).get("read_primary_until")
+            if message["type"] == "http.response.start" and until:
+                cookie = SimpleCookie()
+                cookie[STICKY_COOKIE] = f"{until:.3f}"
+                cookie[STICKY_COOKIE]["path"] = "/"
+                cookie[STICKY_COOKIE]["max-age"] = int(settings.REPLICA_STICKY_SECONDS) + 1
+                cookie[STICKY_COOKIE]["httponly"] = True
+                cookie[STICKY_COOKIE]["samesite"] = "lax"
+                header = cookie.output(header="").strip().encode("latin-1")
+                message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", header)]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+
+def copy_sqlite(primary_url: str, replica_urls: Sequence[str]):
+    source = sqlite3.connect(make_url(primary_url).database)
+    try:
+        for url in replica_urls:
+            target = sqlite3.connect(make_url(url).database)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+    finally:
+        source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy the primary SQLite database into the SQLite replicas.")
+    parser.add_argument("--every", type=float, help="keep copying every N seconds, simulating replication lag")
+    args = parser.parse_args()
+
+    urls = [url for url in settings.DATABASE_REPLICA_URLS if make_url(url).get_backend_name() == "sqlite"]
+    if make_url(settings.DATABASE_URL).get_backend_name() != "sqlite" or not urls:
+        parser.error("needs a SQLite DATABASE_URL and SQLite DATABASE_REPLICA_URLS")
+    while True:
+        copy_sqlite(settings.DATABASE_URL, urls)
+        print(f"Copied {settings.DATABASE_URL} to {len(urls)} replicas")
+        if not args.every:
+            return
+        time.sleep(args.every)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Question revisions, the versions behind the pages' ETags.
+
+Every write that changes how a question is displayed (a vote on it or on one of
+its tags, a new tag, the question being created) sets Question.revision to a
+revision higher than any stored one, in the same transaction. So a question
+page is unchanged as long as its question's revision is, and every listing is
+unchanged as long as the highest revision is, which is a lookup in
+ix_question_revision.
+
+On SQLite that is one more than the highest revision in the table: writers are
+serialized, so no two writes get the same revision. On PostgreSQL concurrent
+transactions would both see the same highest revision, so revisions come from
+a counter row instead (question_revision_counter, created by the migrations),
+taken with UPDATE ... RETURNING. The row stays locked until the transaction
+ends, so revisions are also committed in order and the highest one only grows.
+"""
+from sqlalchemy import Connection, Integer, func, select, text, update
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlmodel import Session
+
+from app.models import Question
+
+
+class _NextRevision(FunctionElement):
+    type = Integer()
+    inherit_cache = True
+
+
+# Aliased so it isn't correlated with the question row being updated
+_latest = Question.__table__.alias("latest")
+_max_plus_one = select(func.coalesce(func.max(_latest.c.revision), 0) + 1).scalar_subquery()
+# Built once: every vote writes it, and constructing it costs more than running it
+_next_revision = _NextRevision()
+
+
+@compiles(_NextRevision)
+def _compile_next_revision(element, compiler, **kw):
+    return compiler.process(_max_plus_one, **kw)
+
+
+@compiles(_NextRevision, "postgresql")
+def _compile_next_revision_postgresql(element, compiler, **kw):
+    # A subquery runs once per statement, so every row it updates shares one revision
+    return "(SELECT next_question_revision())"
+
+
+def create_revision_counter(conn: Connection):
+    """Create PostgreSQL's revision counter, starting from the highest stored revision; idempotent."""
+    if conn.dialect.name != "postgresql":
+        return
+    conn.execute(text("CREATE TABLE IF NOT EXISTS question_revision_counter (value INTEGER NOT NULL)"))
+    conn.execute(text(
+        "INSERT INTO question_revision_counter (value) "
+        "SELECT coalesce(max(revision), 0) FROM question "
+        "WHERE NOT EXISTS (SELECT 1 FROM question_revision_counter)"
+    ))
+    conn.execute(text(
+        "CREATE OR REPLACE FUNCTION next_question_revision() RETURNS INTEGER VOLATILE LANGUAGE sql AS "
+        "'UPDATE question_revision_counter SET value = value + 1 RETURNING value'"
+    ))
+
+
+def next_revision():
+    """SQL expression for a revision higher than any stored one, for use in an INSERT or UPDATE."""
+    return _next_revision
+
+
+def bump_question(session: Session, question_id: int):
+    """Mark a question as changed, without committing."""
+    session.execute(update(Question).where(Question.id == question_id).values(revision=next_revision()))
+
+
+def question_revision(question_id: int):
+    """Statement selecting a question's revision; no row if it doesn't exist."""
+    return select(Question.revision).where(Question.id == question_id)
+
+
+def latest_revision():
+    """Statement selecting the highest revision, the version of every question listing."""
+    return select(func.coalesce(func.max(Question.revision), 0))
@@ -5,30 +5,76 @@ from fastapi import FastAPI, status
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
+from .templating import precompile_templates, template_version, templates
 import uvicorn
 # from fastapi.staticfiles import StaticFiles
 # from fastapi.templating import Jinja2Templates
 
-from .routers import questions, tags, index, authentication
-from .db.database import create_db_and_tables
+from .routers import questions, tags, index, authentication, metrics, search, admin
+from .db.database import async_engine, create_db_and_tables, engine, read_engine, read_router
+from .db.instrumentation import QueryInstrumentationMiddleware
+from .db.replicas import ReadYourWritesMiddleware
+from .metrics import MetricsMiddleware
+from .services.live import live_hub
+from .services.rankings import start_ranking_rebase, stop_ranking_rebase
+from .services.related import start_related_questions, stop_related_questions
+from .services.tag_index import start_tag_index, stop_tag_index
+from .services.vote_buffer import start_vote_buffer, stop_vote_buffer
+from .traffic import TrafficCaptureMiddleware, start_traffic_capture, stop_traffic_capture
+from . import settings
 
 import logging
 
 logging.basicConfig()
-logger = logging.getLogger('sqlalchemy.engine')
-logger.setLevel(logging.DEBUG)
+if settings.SQL_ECHO:
+    # Every statement, synchronously; for debugging only
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
+if settings.QUERY_COUNT_HEADER:
+    # Query counts of streamed pages, which can't go in a header
+    logging.getLogger('app.db.instrumentation').setLevel(logging.INFO)
 
 app = FastAPI()
-templates = Jinja2Templates(directory="templates")
+app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(QueryInstrumentationMiddleware, header=settings.QUERY_COUNT_HEADER)
+if settings.TRAFFIC_CAPTURE_PATH:
+    app.add_middleware(TrafficCaptureMiddleware)
+# Added last so it runs outermost and times the other middleware too
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(questions.router)
 app.include_router(tags.router)
 app.include_router(index.router)
 app.include_router(authentication.router)
+app.include_router(metrics.router)
+app.include_router(search.router)
+app.include_router(admin.router)
 
 @app.on_event("startup")
 def on_startup():
     create_db_and_tables()
+    precompile_templates(templates.env)
+    template_version()
+    start_tag_index(engine, settings.TAG_INDEX_REFRESH_SECONDS)
+    start_related_questions(engine, settings.RELATED_REFRESH_SECONDS, settings.RELATED_REBUILD_SECONDS)
+    start_ranking_rebase(engine, settings.RANKING_REBASE_SECONDS)
+    if settings.VOTE_WRITE_BEHIND:
+        start_vote_buffer(engine, settings.VOTE_FLUSH_INTERVAL_MS, settings.VOTE_FLUSH_MAX_ENTRIES)
+    if settings.TRAFFIC_CAPTURE_PATH:
+        start_traffic_capture(settings.TRAFFIC_CAPTURE_PATH, settings.TRAFFIC_CAPTURE_MAX_MB)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Write buffered votes before the process exits
+    stop_vote_buffer()
+    stop_tag_index()
+    stop_related_questions()
+    stop_ranking_rebase()
+    stop_traffic_capture()
+    await live_hub.close()
+    await async_engine.dispose()
+    await read_engine.dispose()
+    await read_router.dispose()
 
 
 @app.exception_handler(RequestValidationError)
@@ -0,0 +1,251 @@
+"""
+In-process metrics in the Prometheus text format, served at /metrics.
+
+Deliberately small: counters, gauges and fixed-bucket histograms kept in
+memory under one lock each, no external agent or client library. Label values
+only ever come from bounded sets (route templates, template names, HTTP
+methods, status classes), and each metric caps its number of series at
+MAX_SERIES, folding anything beyond into an "other" series.
+"""
+import bisect
+import threading
+import time
+from typing import Callable, Iterable, Optional, Sequence
+
+MAX_SERIES = 200
+
+# Seconds; covers sub-millisecond template renders up to multi-second requests
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+HTTP_METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._series: dict[tuple[str, ...], object] = {}
+
+    def _key(self, labels: Sequence[str]) -> tuple[str, ...]:
+        key = tuple(labels)
+        if key not in self._series and len(self._series) >= MAX_SERIES:
+            return ("other",) * len(self.label_names)
+        return key
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield from super().render()
+        with self._lock:
+            series = list(self._series.items())
+        for labels, value in series:
+            yield f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels: str, value: float):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+
+class CallbackGauge(Metric):
+    """A gauge read from `callback` at scrape time, for values other objects already keep."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, callback: Callable[[], float]):
+        super().__init__(name, help)
+        self.callback = callback
+
+    def render(self) -> Iterable[str]:
+        yield from super().render()
+        yield f"{self.name} {_format_value(self.callback())}"
+
+
+class CallbackCounter(CallbackGauge):
+    kind = "counter"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *labels: str, value: float):
+        # Per-bucket counts (not cumulative) plus the +Inf overflow, then sum and count
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labels: str) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> Iterable[str]:
+        yield from super().render()
+        with self._lock:
+            series = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items()]
+        names = (*self.label_names, "le")
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_format_labels(names, (*labels, _format_value(bound)))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.label_names, labels)} {count}"
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Sequence[str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(*self.labels, value=time.perf_counter() - self.started)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def callback_gauge(self, name: str, help: str, callback: Callable[[], float]) -> CallbackGauge:
+        return self.register(CallbackGauge(name, help, callback))
+
+    def callback_counter(self, name: str, help: str, callback: Callable[[], float]) -> CallbackCounter:
+        return self.register(CallbackCounter(name, help, callback))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics.values() for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time to the end of the response body.", ("method", "route", "status")
+)
+http_requests_in_flight = registry.gauge("http_requests_in_flight", "Requests being handled.")
+db_queries_per_request = registry.histogram(
+    "db_queries_per_request", "SQL statements run per request.", ("route",), buckets=COUNT_BUCKETS
+)
+db_query_seconds_per_request = registry.histogram(
+    "db_query_seconds_per_request", "Time spent in SQL statements per request.", ("route",)
+)
+db_lock_errors = registry.counter(
+    "db_lock_errors_total", "SQL statements that failed because the database stayed locked past the busy timeout."
+)
+template_render_duration = registry.histogram(
+    "template_render_seconds", "Jinja render time per template, including the templates it extends or includes.",
+    ("template",),
+)
+password_hash_duration = registry.histogram(
+    "password_hash_seconds", "bcrypt time per operation, excluding the wait for a worker.", ("operation",),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1, 2),
+)
+vote_write_duration = registry.histogram(
+    "vote_write_seconds", "Time to record a vote click.", ("target", "mode")
+)
+vote_flush_duration = registry.histogram("vote_flush_seconds", "Time to write one batch of buffered votes.")
+vote_buffer_dropped = registry.counter(
+    "vote_buffer_dropped_total", "Buffered votes given up on after repeated failed flushes."
+)
+traffic_capture_dropped = registry.counter(
+    "traffic_capture_dropped_total", "Request traces left out of the capture file, by reason.", ("reason",)
+)
+related_pass_duration = registry.histogram(
+    "related_questions_pass_seconds", "Time to update the related questions, by kind of pass.", ("pass",),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+)
+
+
+def route_label(scope: dict) -> str:
+    # Route templates keep the label set bounded; raw paths would not
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """Records latency, status and in-flight requests for every HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status: Optional[int] = None
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_flight.dec()
+            method = scope["method"] if scope["method"] in HTTP_METHODS else "other"
+            status_class = f"{status // 100}xx" if status else "none"
+            http_request_duration.observe(
+                method, route_label(scope), status_class, value=time.perf_counter() - started
+            )
@@ -3,6 +3,8 @@ from .question import Question, QuestionPublic
 from .tag import Tag, TagPublic
 from .vote import QuestionVote
 from .link_tables import QuestionTagLink, QuestionTagVote
+from .related import RelatedQuestion
+from .ranking import RankingEpoch
 
 from sqlmodel import SQLModel
 
@@ -23,5 +25,7 @@ __all__ = [
     "TagPublic",
     "QuestionVote",
     "TagVote",
-    "QuestionTagLink"
+    "QuestionTagLink",
+    "RelatedQuestion",
+    "RankingEpoch",
 ]
@@ -1,12 +1,28 @@
 from typing import Optional, List
+from sqlalchemy import Index
 from sqlmodel import SQLModel, Field, Relationship
 from datetime import datetime
 
 class QuestionTagLink(SQLModel, table=True):
     question_id: Optional[int] = Field(default=None, foreign_key="question.id", primary_key=True)
     tag_id: Optional[int] = Field(default=None, foreign_key="tag.id", primary_key=True)
+    # Denormalized sum of QuestionTagVote.vote_value for this question-tag pair
+    vote_sum: int = Field(default=0)
+    # Same counts and scores as on Question; a question's tags are shown by wilson_score
+    up_count: int = Field(default=0)
+    down_count: int = Field(default=0)
+    hot_score: float = Field(default=0)
+    wilson_score: float = Field(default=0)
+    controversy_score: float = Field(default=0)
 
 class QuestionTagVote(SQLModel, table=True):
+    __table_args__ = (
+        # One vote per user and question-tag pair
+        Index("uq_questiontagvote_user_question_tag", "user_id", "question_id", "tag_id", unique=True),
+        # Covers per-(question, tag) sums without touching the table
+        Index("ix_questiontagvote_question_tag_value", "question_id", "tag_id", "vote_value"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id", nullable=False)
     question_id: int = Field(foreign_key="question.id")
@@ -1,18 +1,39 @@
 from typing import Optional, List
-from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
+from sqlmodel import SQLModel, Field, Relationship, Session
 
 from app.models.tag import TagPublic
 from app.models.user import User
 from app.utils.user_voted import Vote, user_voted
+from app.utils.vote_context import VoteContext
 
 from .link_tables import QuestionTagLink
 from .vote import QuestionVote
 # from .tag import Tag, TagPublic
 
 class Question(SQLModel, table=True):
+    __table_args__ = (
+        # "Most popular" listings are a range scan over this index
+        Index("ix_question_vote_sum_id", "vote_sum", "id"),
+        # The other rankings of list_questions, see app/services/rankings.py
+        Index("ix_question_hot_score_id", "hot_score", "id"),
+        Index("ix_question_wilson_score_id", "wilson_score", "id"),
+        Index("ix_question_controversy_score_id", "controversy_score", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     text: str
     created_by: Optional[int] = Field(default=None, foreign_key="user.id")
+    # Denormalized sum of QuestionVote.vote_value, kept in sync by the vote routes
+    vote_sum: int = Field(default=0)
+    # Vote counts and the scores derived from them, kept in sync by the vote routes
+    up_count: int = Field(default=0)
+    down_count: int = Field(default=0)
+    hot_score: float = Field(default=0)
+    wilson_score: float = Field(default=0)
+    controversy_score: float = Field(default=0)
+    # Bumped on every change to how the question displays, see app/db/revisions.py
+    revision: int = Field(default=0, index=True)
 
     # Relationships
     user: Optional["User"] = Relationship(back_populates="questions")
@@ -32,12 +53,24 @@ class QuestionPublic(SQLModel):
     voted: Vote = Vote.NEUTRAL  # Indicates if the current user has voted on this question
 
     @classmethod
-    def from_question(cls, question: Question, current_user: Optional[User] = None):
-        # vote_sum = sum(vote.vote_value for vote in question.votes)
-        tags_public = [TagPublic.from_tag(tag, question, current_user) for tag in question.tags]
-        tags_public.sort(key=lambda t: t.vote_sum, reverse=True)
+    def from_question(
+        cls,
+        question: Question,
+        current_user: Optional[User] = None,
+        vote_context: Optional[VoteContext] = None,
+    ):
+        """
+        Create QuestionPublic from Question. Listings should load one VoteContext
+        for the whole page and pass it in; otherwise one is loaded for this question.
+        """
+        if vote_context is None:
+            vote_context = VoteContext.load(Session.object_session(question), [question.id], current_user)
+
+        tags_public = [TagPublic.from_tag(tag, question, current_user, vote_context) for tag in question.tags]
+        # Best first: by Wilson score, which doesn't put one lucky upvote above 20 to 2
+        tags_public.sort(key=lambda t: (vote_context.tag_rank(question.id, t.id), t.vote_sum), reverse=True)
 
-        voted = user_voted(current_user, question)
+        voted = user_voted(current_user, question, vote_context=vote_context)
 
         return cls(
             id=question.id,
@@ -47,7 +80,18 @@ class QuestionPublic(SQLModel):
             tags=tags_public,
             voted=voted,
             # votes=question.votes,
-            # vote_sum=vote_sum
+            vote_sum=vote_context.question_sum(question.id),
+        )
+
+    def fragment_key(self) -> tuple:
+        """Everything questions/item.html shows, as the key of its cached fragment."""
+        return (
+            self.id,
+            self.text,
+            self.vote_sum,
+            self.voted.value,
+            self.user.username if self.user else None,
+            tuple((tag.id, tag.name, tag.vote_sum, tag.voted.value) for tag in self.tags),
         )
 
     class Config:
@@ -0,0 +1,7 @@
+from sqlmodel import SQLModel, Field
+
+class RankingEpoch(SQLModel, table=True):
+    # One row: the time (unix seconds) the stored hot scores are relative to,
+    # see app/services/rankings.py
+    id: int = Field(default=1, primary_key=True)
+    hot_epoch: float
@@ -0,0 +1,9 @@
+from sqlmodel import SQLModel, Field
+
+class RelatedQuestion(SQLModel, table=True):
+    # Written by app/services/related.py; a question's list is the rows with
+    # its question_id, read in position order straight off the primary key
+    question_id: int = Field(foreign_key="question.id", primary_key=True)
+    position: int = Field(primary_key=True)
+    related_id: int = Field(foreign_key="question.id")
+    score: float
@@ -1,14 +1,36 @@
+import unicodedata
 from typing import Optional, List
-from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
+from sqlmodel import SQLModel, Field, Relationship, Session
 
 from app.models.user import User
 from app.utils.user_voted import Vote, user_voted
+from app.utils.vote_context import VoteContext
 from .link_tables import QuestionTagLink
 # from .vote import TagVote
 
+def normalize_tag_name(name: str) -> str:
+    """The key that makes "Python", " python " and "PYTHON" one tag."""
+    return " ".join(unicodedata.normalize("NFKC", name).casefold().split())
+
+
+def _default_normalized_name(context) -> str:
+    return normalize_tag_name(context.get_current_parameters()["name"])
+
+
 class Tag(SQLModel, table=True):
+    __table_args__ = (
+        # Keyset pagination of list_tags
+        Index("ix_tag_name_id", "name", "id"),
+        Index("uq_tag_normalized_name", "normalized_name", unique=True),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
+    # normalize_tag_name(name), filled in on insert
+    normalized_name: Optional[str] = Field(
+        default=None, nullable=False, sa_column_kwargs={"default": _default_normalized_name}
+    )
 
     questions: List["Question"] = Relationship(back_populates="tags", link_model=QuestionTagLink)
     question_tag_votes: List["QuestionTagVote"] = Relationship(back_populates="tag")
@@ -23,21 +45,26 @@ class TagPublic(SQLModel):
     voted: Vote = Vote.NEUTRAL  # Indicates if the current user has voted on this tag
 
     @classmethod
-    def from_tag(cls, tag: Tag, question: Optional["Question"] = None, current_user: Optional[User] = None):
+    def from_tag(
+        cls,
+        tag: Tag,
+        question: Optional["Question"] = None,
+        current_user: Optional[User] = None,
+        vote_context: Optional[VoteContext] = None,
+    ):
         """
         Create TagPublic from Tag, optionally with vote sum for a specific question.
         If question is provided, vote_sum will be for that question-tag combination.
+        Pass a VoteContext loaded for the whole page to avoid per-tag queries.
         """
         vote_sum = 0
         if question:
-            # Calculate vote sum for this specific question-tag combination
-            vote_sum = sum(
-                vote.vote_value
-                for vote in tag.question_tag_votes
-                if vote.question_id == question.id
-            )
-
-        voted = user_voted(current_user, question, tag)
+            if vote_context is None:
+                vote_context = VoteContext.load(Session.object_session(question), [question.id], current_user)
+            # Vote sum for this specific question-tag combination
+            vote_sum = vote_context.tag_sum(question.id, tag.id)
+
+        voted = user_voted(current_user, question, tag, vote_context)
 
         return cls(
             id=tag.id,
@@ -1,8 +1,16 @@
 from typing import Optional
+from sqlalchemy import Index
 from sqlmodel import SQLModel, Field, Relationship
 from datetime import datetime
 
 class QuestionVote(SQLModel, table=True):
+    __table_args__ = (
+        # One vote per user and question
+        Index("uq_questionvote_user_question", "user_id", "question_id", unique=True),
+        # Covers per-question sums without touching the table
+        Index("ix_questionvote_question_value", "question_id", "vote_value"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id", nullable=False)
     question_id: int = Field(foreign_key="question.id")
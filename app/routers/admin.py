@@ -0,0 +1,57 @@
+import io
+import tempfile
+from dataclasses import asdict
+from typing import Annotated, Literal
+
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
+from sqlmodel import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.db.database import engine
+from app.models.user import UserPublic
+from app.routers.authentication import get_admin_user
+from app.services import bulk
+from app.services.leaderboard import leaderboard
+from app.services.tag_index import tag_index
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+)
+
+Format = Literal["jsonl", "csv"]
+# Uploads bigger than this go to a temporary file instead of memory
+SPOOL_BYTES = 8 * 1024 * 1024
+
+
+@router.get("/export")
+def export(admin: Annotated[UserPublic, Depends(get_admin_user)], format: Format = "jsonl"):
+    """Every question and vote as a bulk import file, streamed as it is read."""
+    return StreamingResponse(
+        bulk.export_chunks(engine, format),
+        media_type=bulk.FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="export.{format}"'},
+    )
+
+
+@router.post("/import")
+async def import_file(request: Request, admin: Annotated[UserPublic, Depends(get_admin_user)], format: Format = "jsonl"):
+    """Import a bulk file sent as the request body; returns what was imported and skipped."""
+    with tempfile.SpooledTemporaryFile(SPOOL_BYTES) as spool:
+        async for chunk in request.stream():
+            spool.write(chunk)
+        spool.seek(0)
+        report = await run_in_threadpool(_import, spool, format)
+    return asdict(report)
+
+
+def _import(spool, format: str) -> bulk.ImportReport:
+    file = io.TextIOWrapper(spool, encoding="utf-8", newline="")
+    report = bulk.import_file(engine, file, format)
+    # Leave the spool to be closed by the with block that owns it
+    file.detach()
+    leaderboard.invalidate()
+    with Session(engine) as session:
+        tag_index.reload(session)
+    return report
@@ -2,9 +2,13 @@ from urllib.parse import urlparse, parse_qs
 from datetime import datetime, timedelta, timezone
 from fastapi import APIRouter, Form, Header
 from pydantic import BaseModel
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import or_, select
 
-from app.db.database import SessionDep
+from app import settings
+from app.db.database import AsyncSessionDep, ReadSessionDep
+from app.services import passwords
+from app.services.user_cache import user_cache
 from app.models.user import UserPublic
 from ..models import User
 from fastapi.responses import HTMLResponse, JSONResponse
@@ -14,9 +18,9 @@ import jwt
 from jwt.exceptions import InvalidTokenError
 
 from fastapi.templating import Jinja2Templates
+from app.templating import templates
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from typing import Annotated
-from passlib.context import CryptContext
 
 # Custom OAuth2 scheme that checks cookies instead of Authorization header
 class OAuth2PasswordBearerWithCookie(OAuth2PasswordBearer):
@@ -36,7 +40,6 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 15
 REFRESH_TOKEN_EXPIRE_DAYS = 7
 
-templates = Jinja2Templates(directory="templates")
 
 class Token(BaseModel):
     access_token: str
@@ -48,35 +51,42 @@ class TokenData(BaseModel):
     username: str | None = None
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 oauth2_scheme = OAuth2PasswordBearerWithCookie(tokenUrl="auth/token", auto_error=False)
 
 router = APIRouter(
     tags=["auth"],
     prefix="/auth",
 )
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await passwords.password_hasher.verify(plain_password, hashed_password)
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await passwords.password_hasher.hash(password)
 
 
-def get_user(session: SessionDep, username: str | None = None, email: str | None = None):
+async def get_user(session: AsyncSessionDep, username: str | None = None, email: str | None = None):
 
     statement = select(User).where(or_(User.username == username, User.email == email))
-    user = session.exec(statement).first()
+    user = (await session.exec(statement)).first()
     return user
 
 
-def authenticate_user(session: SessionDep, username: str, email: str, password: str):
-    user = get_user(session, username, email)
+async def authenticate_user(session: ReadSessionDep, writer: AsyncSessionDep, username: str, email: str, password: str):
+    user = await get_user(session, username, email)
+    # Give the connection back before bcrypt runs; on SQLite a held writer
+    # would make every other write wait for the hash
+    await session.close()
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    verified, new_hash = await passwords.password_hasher.verify_and_update(password, user.hashed_password)
+    if not verified:
         return False
+    if new_hash:
+        # Stored with an outdated work factor; upgrade it while we have the password
+        await writer.execute(User.__table__.update().where(User.id == user.id).values(hashed_password=new_hash))
+        await writer.commit()
+        user.hashed_password = new_hash
     return user
 
 def create_token(data: dict, expires_delta: timedelta):
@@ -98,13 +108,27 @@ def create_token_pair(user_id: int):
     return access_token, refresh_token
 
 
-async def get_current_user(session: SessionDep, token: Annotated[str, Depends(oauth2_scheme)]):
+async def get_current_user(
+    session: ReadSessionDep,
+    request: Request,
+    token: Annotated[str, Depends(oauth2_scheme)],
+) -> UserPublic | None:
+    # Resolved at most once per request, however many dependencies ask
+    if hasattr(request.state, "current_user"):
+        return request.state.current_user
+    request.state.current_user = user = await load_current_user(session, token)
+    return user
 
 
+async def load_current_user(session: ReadSessionDep, token: str | None) -> UserPublic | None:
     # Handle case where no token is provided (optional authentication)
     if not token:
         return None
 
+    user = user_cache.get(token)
+    if user is not None:
+        return user
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username = payload.get("sub")
@@ -113,15 +137,15 @@ async def get_current_user(session: SessionDep, token: Annotated[str, Depends(oa
         token_data = TokenData(username=username)
     except InvalidTokenError:
         return None
-    user = get_user(session, username=token_data.username)
+    user = await get_user(session, username=token_data.username)
     if user is None:
         return None
-    return user
+    return user_cache.put(token, user, payload.get("exp"))
 
 
 async def get_required_current_user(
-    current_user: Annotated[User | None, Depends(get_current_user)],
-):
+    current_user: Annotated[UserPublic | None, Depends(get_current_user)],
+) -> UserPublic:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -136,16 +160,24 @@ async def get_required_current_user(
     return current_user
 
 async def get_optional_current_user(
-    current_user: Annotated[User | None, Depends(get_current_user)],
-):
+    current_user: Annotated[UserPublic | None, Depends(get_current_user)],
+) -> UserPublic | None:
+    return current_user
+
+async def get_admin_user(
+    current_user: Annotated[UserPublic, Depends(get_required_current_user)],
+) -> UserPublic:
+    if current_user.username not in settings.ADMIN_USERNAMES:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admins only")
     return current_user
 
 @router.post("/token")
 async def login_for_access_token(
-    session: SessionDep,
+    session: ReadSessionDep,
+    writer: AsyncSessionDep,
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
 ) -> Token:
-    user = authenticate_user(session, form_data.username, form_data.username, form_data.password)
+    user = await authenticate_user(session, writer, form_data.username, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -195,7 +227,8 @@ async def get_register_page(request: Request):
 
 @router.post("/users/register", response_class=HTMLResponse, status_code=status.HTTP_201_CREATED)
 async def register_user(
-    session: SessionDep,
+    session: ReadSessionDep,
+    writer: AsyncSessionDep,
     request: Request,
     username: str = Form(min_length=3, max_length=50, description="Username must be between 3 and 50 characters"),
     password: str = Form(min_length=8, max_length=128, description="Password must be between 8 and 128 characters"),
@@ -203,21 +236,29 @@ async def register_user(
 ):
     form_data = await request.form()
     # Check if the user already exists
-    existing_user = session.exec(select(User).where(or_(User.email == email, User.username == username))).first()
+    existing_user = (await session.exec(select(User).where(or_(User.email == email, User.username == username)))).first()
+    # Not held while hashing, see authenticate_user
+    await session.close()
 
-    if existing_user:
+    def already_exists():
         return templates.TemplateResponse("users/register.html", {"request": request, "error": "User already exists!", "form_data": form_data}, status_code=status.HTTP_400_BAD_REQUEST)
 
+    if existing_user:
+        return already_exists()
+
     new_user = User(
         username=username,
         email=email,
-        hashed_password=get_password_hash(password),
+        hashed_password=await get_password_hash(password),
     )
 
-
-    session.add(new_user)
-    session.commit()
-    session.refresh(new_user)
+    writer.add(new_user)
+    try:
+        await writer.commit()
+    except IntegrityError:
+        # Registered by a concurrent request while this one was hashing
+        await writer.rollback()
+        return already_exists()
 
     return templates.TemplateResponse("users/register.html", {"request": request, "success": "User registered successfully!", "form_data": form_data}, status_code=status.HTTP_201_CREATED)
 
@@ -229,13 +270,14 @@ async def get_login_page(request: Request):
 
 @router.post("/users/login", response_class=HTMLResponse)
 async def login_user(
-    session: SessionDep,
+    session: ReadSessionDep,
+    writer: AsyncSessionDep,
     request: Request,
     username: str = Form(...),
     password: str = Form(...),
 ):
     form_data = await request.form()
-    user = authenticate_user(session, username, username, password=password)
+    user = await authenticate_user(session, writer, username, username, password=password)
     if not user:
         return templates.TemplateResponse("users/login.html", {"request": request, "error": "Invalid username or password", "form_data": form_data}, status_code=status.HTTP_401_UNAUTHORIZED)
 
@@ -273,14 +315,14 @@ async def login_user(
 
 @router.get("/users/me/", response_model=UserPublic)
 async def read_users_me(
-    current_user: Annotated[User, Depends(get_required_current_user)],
+    current_user: Annotated[UserPublic, Depends(get_required_current_user)],
 ):
     return current_user
 
 
 @router.get("/users/me/items/")
 async def read_own_items(
-    current_user: Annotated[User, Depends(get_required_current_user)],
+    current_user: Annotated[UserPublic, Depends(get_required_current_user)],
 ):
     return [{"item_id": "Foo", "owner": current_user.username}]
 
@@ -288,7 +330,11 @@ async def read_own_items(
 async def logout(request: Request):
     response = templates.TemplateResponse("users/login.html", {
         "request": request,
-        "success": "Logged out successfully!"
+        "success": "Logged out successfully!",
+        "form_data": {},
     })
+    token = request.cookies.get("access_token")
+    if token:
+        user_cache.invalidate_token(token)
     response.delete_cookie(key="access_token")
     return response
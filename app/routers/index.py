@@ -1,41 +1,40 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.templating import Jinja2Templates
+from app.templating import templates
 
-from app.models.user import User
-from app.models.vote import QuestionVote
+from app import settings
+from app.models.user import User, UserPublic
 from app.routers.authentication import get_optional_current_user
+from app.services.leaderboard import leaderboard, with_user_votes
+from app.utils.http_cache import cache_headers, make_etag, not_modified
+from app.utils.streaming import StreamingTemplateResponse
 from ..models import Question, Tag, QuestionPublic
-from ..db.database import SessionDep
+from ..db.database import AsyncSessionDep, ReadSessionDep
 from sqlmodel import select
 from sqlalchemy.orm import selectinload
-from sqlalchemy import func, desc
+from sqlalchemy import desc
 
 router = APIRouter(
     tags=["index"],
 )
 
-templates = Jinja2Templates(directory="templates")
 
 @router.get("/")
-def render_front_page(request: Request, session: SessionDep, current_user: User | None = Depends(get_optional_current_user)):
-    # Get questions to display on homepage
-    statement = (
-        select(Question, func.coalesce(func.sum(QuestionVote.vote_value), 0).label("vote_sum"))
-        .outerjoin(QuestionVote)
-        .group_by(Question.id)
-        .limit(15)
-        .order_by(desc("vote_sum"))
-    )
-    results = session.exec(statement).all()
-    questions = []
+async def render_front_page(request: Request, session: ReadSessionDep, current_user: UserPublic | None = Depends(get_optional_current_user)):
+    # Most popular questions come from the in-process leaderboard cache;
+    # only the current user's own votes are looked up per request
+    questions = await session.run_sync(leaderboard.get)
+    if current_user:
+        questions = await session.run_sync(with_user_votes, questions, current_user)
 
-    for q, vote_sum in results:
-        question_public = QuestionPublic.from_question(q, current_user)
-        question_public.vote_sum = vote_sum if vote_sum is not None else 0
-        questions.append(question_public)
+    # The cached entries may be older than the database, so the page's
+    # version is what is about to be shown
+    etag = make_etag("front", [q.fragment_key() for q in questions], current_user.id if current_user else None)
+    if response := not_modified(request, etag, current_user):
+        return response
 
-    return templates.TemplateResponse("index.html", {
-        "request": request,
-        "questions": questions,
-        "current_user": current_user
-    })
+    # limit: the live updates stream watches the same top questions
+    context = {"questions": questions, "current_user": current_user, "limit": leaderboard.size}
+    if settings.STREAM_HTML:
+        return StreamingTemplateResponse(request, "index.html", context, headers=cache_headers(etag, current_user))
+    return templates.TemplateResponse("index.html", {"request": request, **context}, headers=cache_headers(etag, current_user))
@@ -1,19 +1,33 @@
-from fastapi import APIRouter, Depends, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Form, Response
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from app.templating import templates
 
+from app import settings
+from app.db.database import read_router
+from app.db.replicas import reads_from_primary
+from app.db.revisions import latest_revision, next_revision, question_revision
+from app.metrics import vote_write_duration
 from app.models.link_tables import QuestionTagVote
 from app.models.tag import TagPublic
-from app.models.user import User
+from app.models.user import User, UserPublic
 from app.routers.authentication import get_optional_current_user, get_required_current_user
+from app.services import rankings, search, vote_buffer, votes
+from app.services.leaderboard import leaderboard
+from app.services.live import live_hub
+from app.services.related import related_questions
+from app.services.tag_index import tag_index
 from app.utils.user_voted import Vote, user_voted
+from app.utils.http_cache import cache_headers, make_etag, not_modified
+from app.utils.pagination import Keyset, Page
+from app.utils.streaming import PendingValue, StreamingTemplateResponse
+from app.utils.vote_context import VoteContext
 from ..models import Question, Tag, QuestionPublic, QuestionVote
-from ..db.database import SessionDep
+from ..db.database import AsyncSessionDep, ReadSessionDep
 from sqlmodel import desc, func, select
 from sqlalchemy.orm import selectinload
 from typing import Annotated
 
-templates = Jinja2Templates(directory="templates")
 
 router = APIRouter(
     prefix="/questions",
@@ -21,88 +35,238 @@ router = APIRouter(
 )
 
 @router.get("/add" , response_class=HTMLResponse)
-def add_question_form(request: Request, current_user: User = Depends(get_required_current_user)):
+async def add_question_form(request: Request, current_user: UserPublic = Depends(get_required_current_user)):
     return templates.TemplateResponse("questions/add.html", {"request": request, "current_user": current_user})
 
+def live_events_response(question_ids: list[int]) -> Response:
+    """SSE stream of vote totals for some questions, see app/services/live.py."""
+    if not settings.LIVE_UPDATES:
+        raise HTTPException(status_code=404, detail="Live updates are disabled")
+    if not live_hub.has_room():
+        # The page still works, it just won't update itself
+        return Response(status_code=503, headers={"Retry-After": "30"})
+    return StreamingResponse(
+        live_hub.events(question_ids, settings.LIVE_KEEPALIVE_SECONDS, settings.LIVE_MAX_CONNECTION_SECONDS),
+        media_type="text/event-stream",
+        # Proxies must pass events through as they come
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
+
+@router.get("/events", name="question_list_events")
+async def question_list_events(session: ReadSessionDep, cursor: str | None = None, limit: int = Query(5, ge=1, le=50), sort: str = "top"):
+    """Live totals for the questions of one list page; the session is closed before streaming."""
+    keyset = question_keyset(cursor, limit, sort)
+    page = keyset.page((await session.exec(keyset.apply(select(Question)))).all())
+    return live_events_response([question.id for question in page.items])
+
+@router.get("/{item_id}/events", name="question_events")
+async def question_events(item_id: int):
+    return live_events_response([item_id])
+
+@router.get("/scroll", response_class=HTMLResponse)
+async def scroll_questions(session: ReadSessionDep, request: Request, cursor: str | None = None, limit: int = Query(5, ge=1, le=50), sort: str = "top"):
+    """Infinite-scroll fragment: the next items plus a sentinel that loads the page after them."""
+    etag = make_etag("questions", sort, (await session.exec(latest_revision())).one())
+    if response := not_modified(request, etag, None):
+        return response
+    page = await question_page(session, cursor, limit, sort)
+
+    return templates.TemplateResponse("questions/list_items.html", {
+        "questions": page.items,
+        "scroll_cursor": page.next_cursor,
+        "limit": limit,
+        "sort": sort,
+        "request": request
+    }, headers=cache_headers(etag, None))
+
 @router.get("/{item_id}",  response_class=HTMLResponse, name="question")
-def read_question(session: SessionDep, request: Request, item_id: int, current_user: User | None = Depends(get_optional_current_user)):
+async def read_question(session: ReadSessionDep, request: Request, item_id: int, current_user: UserPublic | None = Depends(get_optional_current_user)):
+
+    revision = (await session.exec(question_revision(item_id))).first()
+    if revision is None:
+        raise HTTPException(status_code=404, detail="Question not found")
+    etag = make_etag("question", item_id, revision, current_user.id if current_user else None)
+    if response := not_modified(request, etag, current_user):
+        return response
 
     statement = (
-        select(Question, func.sum(QuestionVote.vote_value).label("vote_sum"))
+        select(Question)
         .where(Question.id == item_id)
-        .outerjoin(QuestionVote)
         .options(selectinload(Question.user), selectinload(Question.tags))
-        .group_by(Question.id)
-        .order_by(desc("vote_sum"))
-        .limit(1)
     )
-    result = session.exec(statement).first()
-
-    question, vote_sum = result if result else (None, 0)
+    question = (await session.exec(statement)).first()
 
     if not question:
         raise HTTPException(status_code=404, detail="Question not found")
 
-    question_public = QuestionPublic.from_question(question, current_user)
-    question_public.vote_sum = vote_sum if vote_sum is not None else 0
+    vote_context = await session.run_sync(
+        VoteContext.load, [question.id], current_user, question_sums={question.id: question.vote_sum}
+    )
+    question_public = QuestionPublic.from_question(question, current_user, vote_context)
+    # Precomputed by app/services/related.py; a change bumps the revision
+    related = (await session.exec(related_questions(item_id))).all()
 
     return templates.TemplateResponse("questions/index.html", {
         "request": request,
         "question": question_public,
+        "related": related,
         "current_user": current_user
-    })
+    }, headers=cache_headers(etag, current_user))
 
-@router.get("/")
-def list_questions(session: SessionDep,request: Request, skip: int = 0, limit: int = 5):
-    statement = (
-        select(Question, func.sum(QuestionVote.vote_value).label("vote_sum"))
-        .outerjoin(QuestionVote)
-        .group_by(Question.id)
-        .offset(skip)
-        .limit(limit)
-        .order_by(desc("vote_sum"))
+async def question_page(session: ReadSessionDep, cursor: str | None, limit: int, sort: str = "top") -> Page[QuestionPublic]:
+    """Questions ranked by `sort`, keyset-paginated on (score, id)."""
+    keyset = question_keyset(cursor, limit, sort)
+    statement = keyset.apply(
+        select(Question).options(selectinload(Question.user), selectinload(Question.tags))
     )
-    results = session.exec(statement).all()
-    response = [QuestionPublic] * len(results)
-
-    for i, (q, vote_sum) in enumerate(results):
-        response[i] = QuestionPublic.from_question(q)
-        response[i].vote_sum = vote_sum if vote_sum is not None else 0
+    page = keyset.page((await session.exec(statement)).all())
+    vote_context = await session.run_sync(
+        VoteContext.load,
+        [q.id for q in page.items],
+        question_sums={q.id: q.vote_sum for q in page.items},
+    )
+    page.items = [QuestionPublic.from_question(q, vote_context=vote_context) for q in page.items]
+    return page
+
+def question_keyset(cursor: str | None, limit: int, sort: str = "top") -> Keyset:
+    # Every ranking has a (score, id) index, see app/services/rankings.py
+    column = rankings.SORTS.get(sort)
+    if column is None:
+        raise HTTPException(status_code=400, detail="Unknown sort")
+    return Keyset([column, Question.id], lambda q: (getattr(q, column.key), q.id), cursor, limit, descending=True)
+
+def streamed_question_page(session, cursor: str | None, limit: int, sort: str = "top") -> dict:
+    """
+    Template context for question_page's page, with the questions loaded
+    STREAM_FETCH_SIZE rows at a time while the template renders them. The
+    cursors are filled in once the rows are through. Takes over `session`
+    and closes it when done.
+    """
+    keyset = question_keyset(cursor, limit, sort)
+    next_cursor, prev_cursor = PendingValue(), PendingValue()
+
+    async def questions():
+        async with session:
+            statement = keyset.apply(
+                select(Question).options(selectinload(Question.user), selectinload(Question.tags))
+            )
+            if keyset.backwards:
+                # Read in reverse index order and flipped, so it can't go out row by row
+                page = keyset.page((await session.exec(statement)).all())
+                batches, has_more = [page.items], page.prev_cursor is not None
+            else:
+                result = await session.stream_scalars(statement, execution_options={"yield_per": settings.STREAM_FETCH_SIZE})
+                batches, has_more = result.partitions(), False
+
+            first = last = None
+            emitted = 0
+            async for batch in _aiter(batches):
+                if not keyset.backwards and emitted + len(batch) > limit:
+                    # The extra row only says there is a next page
+                    has_more = True
+                    batch = batch[:limit - emitted]
+                if batch:
+                    vote_context = await session.run_sync(
+                        VoteContext.load, [q.id for q in batch], question_sums={q.id: q.vote_sum for q in batch}
+                    )
+                    for question in batch:
+                        yield QuestionPublic.from_question(question, vote_context=vote_context)
+                    first = first or batch[0]
+                    last = batch[-1]
+                    emitted += len(batch)
+                if has_more:
+                    break
+            if first is not None:
+                next_cursor.value, prev_cursor.value = keyset.cursors(first, last, has_more)
+
+    return {
+        "questions": questions(), "next_cursor": next_cursor, "prev_cursor": prev_cursor, "cursor": cursor, "limit": limit,
+        "sort": sort,
+    }
+
+async def _aiter(iterable):
+    if hasattr(iterable, "__aiter__"):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
 
-    return templates.TemplateResponse("questions/list.html", {"questions": response, "request": request})
+@router.get("/")
+async def list_questions(request: Request, cursor: str | None = None, limit: int = Query(5, ge=1, le=50), sort: str = "top"):
+    # Not a dependency: a streamed page reads from it after the route returned,
+    # and the ETag must come from the same replica as the rows
+    session = await read_router.open_session(use_primary=reads_from_primary(request))
+    try:
+        etag = make_etag("questions", sort, (await session.exec(latest_revision())).one())
+        if response := not_modified(request, etag, None):
+            return response
+        if settings.STREAM_HTML:
+            context = streamed_question_page(session, cursor, limit, sort)
+            session = None
+            return StreamingTemplateResponse(
+                request, "questions/list.html", context, headers=cache_headers(etag, None)
+            )
+        page = await question_page(session, cursor, limit, sort)
+    finally:
+        if session is not None:
+            await session.close()
+
+    return templates.TemplateResponse("questions/list.html", {
+        "questions": page.items,
+        "next_cursor": page.next_cursor,
+        "prev_cursor": page.prev_cursor,
+        "cursor": cursor,
+        "limit": limit,
+        "sort": sort,
+        "request": request
+    }, headers=cache_headers(etag, None))
 
 @router.post("/", response_class=RedirectResponse)
-def create_question(session: SessionDep, text: Annotated[str, Form()], current_user: User = Depends(get_required_current_user)):
+async def create_question(session: AsyncSessionDep, text: Annotated[str, Form()], current_user: UserPublic = Depends(get_required_current_user)):
     question = Question(text=text, created_by=current_user.id)
+    question.revision = next_revision()
     session.add(question)
-    session.commit()
-    session.refresh(question)
+    await session.flush()
+    await session.run_sync(search.index_question, question.id)
+    await session.commit()
+    await session.refresh(question)
+    leaderboard.update_question(question.id, question.vote_sum)
     # redirect to the newly created question
     return RedirectResponse(url=f"/questions/{question.id}", status_code=303)
 
 @router.post("/{item_id}/tags/{tag_id}", status_code=201, response_model=QuestionPublic)
-def add_tag_to_question(session: SessionDep, item_id: int, tag_id: int):
-    question = session.exec(select(Question).where(Question.id == item_id).options(selectinload(Question.tags))).first()
+async def add_tag_to_question(session: AsyncSessionDep, item_id: int, tag_id: int):
+    question = (await session.exec(
+        select(Question)
+        .where(Question.id == item_id)
+        .options(selectinload(Question.user), selectinload(Question.tags))
+    )).first()
 
     if not question:
         raise HTTPException(status_code=404, detail="Question not found")
     # Fetch the tag from the database by its id or unique attribute
-    db_tag = session.get(Tag, tag_id)
+    db_tag = await session.get(Tag, tag_id)
     if not db_tag:
         raise HTTPException(status_code=404, detail="Tag not found")
 
     if db_tag not in question.tags:
         question.tags.append(db_tag)
+        question.revision = next_revision()
         session.add(question)
-        session.commit()
-        session.refresh(question)
+        await session.flush()
+        await session.run_sync(search.index_question, question.id)
+        await session.commit()
+        leaderboard.question_changed(question.id)
+        tag_index.used(db_tag.id)
 
-    return question
+    vote_context = await session.run_sync(VoteContext.load, [question.id])
+    return QuestionPublic.from_question(question, vote_context=vote_context)
 
 @router.post("/{item_id}/vote/up", status_code=201, response_model=QuestionPublic)
-def vote_question_up(session: SessionDep, request: Request, item_id: int, current_user: User = Depends(get_required_current_user)):
+async def vote_question_up(session: AsyncSessionDep, read_session: ReadSessionDep, request: Request, item_id: int, current_user: UserPublic = Depends(get_required_current_user)):
 
-    question = vote_question(session, item_id, 1, current_user)
+    question = await vote_question(session, read_session, item_id, 1, current_user)
 
     return templates.TemplateResponse("questions/item.html", {
         "request": request,
@@ -110,66 +274,54 @@ def vote_question_up(session: SessionDep, request: Request, item_id: int, curren
     })
 
 @router.post("/{item_id}/vote/down", status_code=201, response_model=QuestionPublic)
-def vote_question_down(session: SessionDep, request: Request, item_id: int, current_user: User = Depends(get_required_current_user)):
-    question = vote_question(session, item_id, -1, current_user)
+async def vote_question_down(session: AsyncSessionDep, read_session: ReadSessionDep, request: Request, item_id: int, current_user: UserPublic = Depends(get_required_current_user)):
+    question = await vote_question(session, read_session, item_id, -1, current_user)
 
     return templates.TemplateResponse("questions/item.html", {
         "request": request,
         "question": question
     })
 
-def vote_question(session: SessionDep, item_id: int, vote_value: int, current_user: User = Depends(get_required_current_user)):
+async def vote_question(session: AsyncSessionDep, read_session: ReadSessionDep, item_id: int, vote_value: int, current_user: UserPublic = Depends(get_required_current_user)):
 
-    question = session.get(Question, item_id)
+    # The buffer and the vote service share the cast_* signatures
+    writer = vote_buffer.vote_buffer or votes
+    with vote_write_duration.time("question", "buffered" if vote_buffer.vote_buffer else "direct"):
+        result = await session.run_sync(writer.cast_question_vote, current_user.id, item_id, vote_value)
 
-    if not question:
+    if not result:
         raise HTTPException(status_code=404, detail="Question not found")
+    leaderboard.update_question(item_id, result.vote_sum)
+    live_hub.publish_question(item_id, result.vote_sum)
+
+    # The vote is committed; render from a reader and leave the writer to the next vote
+    question = (await read_session.exec(
+        select(Question)
+        .where(Question.id == item_id)
+        .options(selectinload(Question.user), selectinload(Question.tags))
+    )).first()
+    vote_context = await read_session.run_sync(
+        VoteContext.load,
+        [item_id],
+        current_user,
+        question_sums={item_id: result.vote_sum},
+        question_votes={item_id: result.voted.value},
+    )
 
-    if user_voted(current_user, question) is not Vote.NEUTRAL:
-        # remove existing vote if it exists
-        existing_vote = session.exec(
-            select(QuestionVote)
-            .where(QuestionVote.question_id == item_id, QuestionVote.user_id == current_user.id)
-        ).first()
-        if existing_vote:
-            session.delete(existing_vote)
-            session.commit()
-            # Recalculate vote sum after deletion
-            vote_sum = session.exec(
-                select(func.sum(QuestionVote.vote_value))
-                .where(QuestionVote.question_id == item_id)
-            ).first() or 0
-            questionPublic = QuestionPublic.from_question(question, current_user)
-            questionPublic.vote_sum = vote_sum or 0
-            return questionPublic
-
-    vote = QuestionVote(question_id=question.id, vote_value=vote_value, user_id=current_user.id)
-
-    session.add(vote)
-    session.commit()
-    session.refresh(question)
-
-    vote_sum = session.exec(
-        select(func.sum(QuestionVote.vote_value))
-        .where(QuestionVote.question_id == item_id)
-    ).first() or 0
-
-    questionPublic = QuestionPublic.from_question(question, current_user)
-    questionPublic.vote_sum = vote_sum or 0
-
-    return questionPublic
+    return QuestionPublic.from_question(question, current_user, vote_context)
 
 
 # Question-tag specific voting endpoints
 @router.post("/{question_id}/tag/{tag_id}/vote/up", response_class=HTMLResponse)
-def vote_question_tag_up(
-    session: SessionDep,
+async def vote_question_tag_up(
+    session: AsyncSessionDep,
+    read_session: ReadSessionDep,
     request: Request,
     question_id: int,
     tag_id: int,
-    current_user: User = Depends(get_required_current_user)
+    current_user: UserPublic = Depends(get_required_current_user)
 ):
-    question, tag = vote_question_tag(session, question_id, tag_id, 1, current_user)
+    question, tag = await vote_question_tag(session, read_session, question_id, tag_id, 1, current_user)
     return templates.TemplateResponse("tags/item.html", {
         "request": request,
         "tag": tag,
@@ -177,84 +329,40 @@ def vote_question_tag_up(
     })
 
 @router.post("/{question_id}/tag/{tag_id}/vote/down", response_class=HTMLResponse)
-def vote_question_tag_down(
-    session: SessionDep,
+async def vote_question_tag_down(
+    session: AsyncSessionDep,
+    read_session: ReadSessionDep,
     request: Request,
     question_id: int,
     tag_id: int,
-    current_user: User = Depends(get_required_current_user)
+    current_user: UserPublic = Depends(get_required_current_user)
 ):
-    question, tag = vote_question_tag(session, question_id, tag_id, -1, current_user)
+    question, tag = await vote_question_tag(session, read_session, question_id, tag_id, -1, current_user)
     return templates.TemplateResponse("tags/item.html", {
         "request": request,
         "tag": tag,
         "question": question
     })
 
-def vote_question_tag(
-    session: SessionDep,
+async def vote_question_tag(
+    session: AsyncSessionDep,
+    read_session: ReadSessionDep,
     question_id: int,
     tag_id: int,
     vote_value: int,
-    current_user: User
+    current_user: UserPublic
 ):
-    # Verify question and tag exist
-    question = session.get(Question, question_id)
-    tag = session.get(Tag, tag_id)
-    tagPublic = TagPublic.from_tag(tag, question, current_user)
+    writer = vote_buffer.vote_buffer or votes
+    with vote_write_duration.time("question_tag", "buffered" if vote_buffer.vote_buffer else "direct"):
+        result = await session.run_sync(writer.cast_question_tag_vote, current_user.id, question_id, tag_id, vote_value)
 
-    if not question:
-        raise HTTPException(status_code=404, detail="Question not found")
-    if not tag:
-        raise HTTPException(status_code=404, detail="Tag not found")
-
-    if user_voted(current_user, question, tag) is not Vote.NEUTRAL:
-        # remove existing vote if it exists
-        existing_vote = session.exec(
-            select(QuestionTagVote)
-            .where(
-                QuestionTagVote.question_id == question_id,
-                QuestionTagVote.tag_id == tag_id,
-                QuestionTagVote.user_id == current_user.id
-            )
-        ).first()
-        if existing_vote:
-            session.delete(existing_vote)
-            session.commit()
-            # Recalculate vote sum after deletion
-            vote_sum = session.exec(
-                select(func.sum(QuestionTagVote.vote_value))
-                .where(
-                    QuestionTagVote.question_id == question_id,
-                    QuestionTagVote.tag_id == tag_id
-                )
-            ).first() or 0
-            tagPublic.vote_sum = vote_sum or 0
-            tagPublic.voted = Vote.NEUTRAL
-            return question, tagPublic
-
-    # Create vote on this specific question-tag combination
-    vote = QuestionTagVote(
-        user_id=current_user.id,
-        question_id=question_id,
-        tag_id=tag_id,
-        vote_value=vote_value
-    )
+    if not result:
+        raise HTTPException(status_code=404, detail="Tag not found on question")
+    leaderboard.update_question_tag(question_id, tag_id, result.vote_sum)
+    live_hub.publish_tag(question_id, tag_id, result.vote_sum)
 
-    session.add(vote)
-    session.commit()
-
-    # Calculate vote sum for this specific question-tag combination
-    vote_sum = session.exec(
-        select(func.sum(QuestionTagVote.vote_value))
-        .where(
-            QuestionTagVote.question_id == question_id,
-            QuestionTagVote.tag_id == tag_id
-        )
-    ).first() or 0
-
-    tagPublic.voted = Vote(vote_value)
-    tagPublic.vote_sum = vote_sum or 0
+    question = await read_session.get(Question, question_id)
+    tag = await read_session.get(Tag, tag_id)
+    tagPublic = TagPublic(id=tag.id, name=tag.name, vote_sum=result.vote_sum, voted=result.voted)
 
     return question, tagPublic
-
@@ -0,0 +1,64 @@
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import HTMLResponse
+from app.templating import templates
+
+from app import settings
+from app.db.revisions import latest_revision
+from app.models.user import UserPublic
+from app.routers.authentication import get_optional_current_user
+from app.services import search
+from app.utils.http_cache import cache_headers, make_etag, not_modified
+from app.utils.vote_context import VoteContext
+from ..models import Question, QuestionPublic
+from ..db.database import ReadSessionDep
+from sqlmodel import select
+from sqlalchemy.orm import selectinload
+
+
+router = APIRouter(
+    prefix="/search",
+    tags=["search"],
+)
+
+@router.get("/", response_class=HTMLResponse, name="search")
+async def search_page(session: ReadSessionDep, request: Request, q: str = Query("", max_length=200), current_user: UserPublic | None = Depends(get_optional_current_user)):
+    # New tags always come with a question, so the revision covers them too
+    etag = make_etag("search", (await session.exec(latest_revision())).one(), current_user.id if current_user else None)
+    if response := not_modified(request, etag, current_user):
+        return response
+
+    tags = await session.run_sync(search.search_tags, q)
+    ids = await session.run_sync(search.search_question_ids, q, settings.SEARCH_RESULTS)
+    found = {question.id: question for question in (await session.exec(
+        select(Question).where(Question.id.in_(ids)).options(selectinload(Question.user), selectinload(Question.tags))
+    )).all()}
+    questions = [found[question_id] for question_id in ids if question_id in found]
+    vote_context = await session.run_sync(
+        VoteContext.load, ids, current_user, question_sums={question.id: question.vote_sum for question in questions}
+    )
+
+    return templates.TemplateResponse("search/index.html", {
+        "request": request,
+        "q": q,
+        "tags": tags,
+        "questions": [QuestionPublic.from_question(question, current_user, vote_context) for question in questions],
+        "current_user": current_user,
+    }, headers=cache_headers(etag, current_user))
+
+@router.get("/suggestions", response_class=HTMLResponse)
+async def search_suggestions(session: ReadSessionDep, request: Request, q: str = Query("", max_length=200)):
+    """Typeahead fragment for the search box."""
+    etag = make_etag("search-suggestions", (await session.exec(latest_revision())).one())
+    if response := not_modified(request, etag, None):
+        return response
+
+    tags = await session.run_sync(search.search_tags, q, settings.SEARCH_SUGGESTIONS)
+    ids = await session.run_sync(search.search_question_ids, q, settings.SEARCH_SUGGESTIONS, True)
+    texts = dict((await session.exec(select(Question.id, Question.text).where(Question.id.in_(ids)))).all())
+
+    return templates.TemplateResponse("search/suggestions.html", {
+        "request": request,
+        "q": q,
+        "tags": tags,
+        "questions": [(question_id, texts[question_id]) for question_id in ids if question_id in texts],
+    }, headers=cache_headers(etag, None))
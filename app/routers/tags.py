@@ -1,24 +1,41 @@
-from fastapi import APIRouter, Depends, Form, HTTPException, Request
+from fastapi import APIRouter, Depends, Form, HTTPException, Query, Request, Response
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
+from app.templating import templates
 
-from app.models.user import User
+from app import settings
+from app.db.revisions import next_revision
+from app.models.user import User, UserPublic
 from app.routers.authentication import get_required_current_user
+from app.services import search
+from app.services.leaderboard import leaderboard
+from app.services.tag_index import tag_index
+from app.utils.pagination import Keyset
+from app.utils.vote_context import VoteContext
 from ..models import Tag, TagPublic, Question, QuestionTagVote
-from ..db.database import SessionDep
+from ..models.tag import normalize_tag_name
+from ..db.database import AsyncSessionDep, ReadSessionDep
 from sqlmodel import func, select
 from sqlalchemy.orm import selectinload
 
-templates = Jinja2Templates(directory="templates")
 
 router = APIRouter(
     prefix="/tags",
     tags=["tags"],
 )
 
+@router.get("/suggestions", response_class=HTMLResponse)
+def tag_suggestions(request: Request, name: str = ""):
+    # Answered from the in-memory index, without a database session. `name`
+    # is the tag input's own name, which htmx sends as the parameter
+    return templates.TemplateResponse("tags/suggestions.html", {
+        "request": request,
+        "tags": tag_index.suggest(name, settings.TAG_SUGGESTIONS),
+    })
+
 @router.get("/{item_id}", response_model=TagPublic)
-def read_tag(session: SessionDep, item_id: int):
-    tag = session.exec(select(Tag).where(Tag.id == item_id).options(selectinload(Tag.questions))).first()
+async def read_tag(session: ReadSessionDep, item_id: int):
+    tag = (await session.exec(select(Tag).where(Tag.id == item_id))).first()
 
     if not tag:
         raise HTTPException(status_code=404, detail="Tag not found")
@@ -26,44 +43,73 @@ def read_tag(session: SessionDep, item_id: int):
     return tag
 
 @router.get("/")
-def list_tags(session: SessionDep, skip: int = 0, limit: int = 5):
-    tags = session.exec(select(Tag).offset(skip).limit(limit)).all()
-    return tags
+async def list_tags(session: ReadSessionDep, request: Request, response: Response, cursor: str | None = None, limit: int = Query(5, ge=1, le=100)):
+    # Cursors for the neighbouring pages are sent in a Link header
+    keyset = Keyset([Tag.name, Tag.id], lambda t: (t.name, t.id), cursor, limit)
+    page = keyset.page((await session.exec(keyset.apply(select(Tag)))).all())
+
+    links = []
+    if page.next_cursor:
+        links.append(f'<{request.url.include_query_params(cursor=page.next_cursor)}>; rel="next"')
+    if page.prev_cursor:
+        links.append(f'<{request.url.include_query_params(cursor=page.prev_cursor)}>; rel="prev"')
+    if links:
+        response.headers["Link"] = ", ".join(links)
+    return page.items
 
 @router.post("/")
-def create_tag(session: SessionDep, request: Request, name: str = Form(...), question_id: int = Form(...), current_user: User = Depends(get_required_current_user)):
+async def create_tag(session: AsyncSessionDep, request: Request, name: str = Form(...), question_id: int = Form(...), current_user: UserPublic = Depends(get_required_current_user)):
     # First, check if the question exists
-    question = session.get(Question, question_id)
+    question = (await session.exec(
+        select(Question).where(Question.id == question_id).options(selectinload(Question.tags))
+    )).first()
     if not question:
         raise HTTPException(status_code=404, detail="Question not found")
 
-    # Check if tag with this name already exists
-    existing_tag = session.exec(select(Tag).where(Tag.name == name)).first()
+    name = " ".join(name.split())
+    if not name:
+        raise HTTPException(status_code=400, detail="Tag name is empty")
+
+    # Check if tag with this name already exists, ignoring case and spacing
+    existing_tag = (await session.exec(select(Tag).where(Tag.normalized_name == normalize_tag_name(name)))).first()
 
     if existing_tag:
         # Tag exists, just add it to the question if not already connected
         if existing_tag not in question.tags:
             question.tags.append(existing_tag)
+            question.revision = next_revision()
             session.add(question)
-            session.commit()
-            session.refresh(existing_tag)
+            await session.flush()
+            await session.run_sync(search.index_question, question.id)
+            await session.commit()
+            leaderboard.question_changed(question.id)
+            tag_index.used(existing_tag.id)
+        vote_context = await session.run_sync(VoteContext.load, [question.id], current_user)
         return templates.TemplateResponse("tags/item.html", {
             "request": request,
-            "tag": TagPublic.from_tag(existing_tag)
+            "tag": TagPublic.from_tag(existing_tag, question, current_user, vote_context),
+            "question": question
         })
     else:
         # Create new tag and connect it to the question
         tag = Tag(name=name)
         session.add(tag)
-        session.flush()  # Flush to get the tag ID
+        await session.flush()  # Flush to get the tag ID
 
         # Add the tag to the question
         question.tags.append(tag)
+        question.revision = next_revision()
         session.add(question)
-        session.commit()
-        session.refresh(tag)
+        await session.flush()
+        await session.run_sync(search.index_tag, tag.id, tag.name)
+        await session.run_sync(search.index_question, question.id)
+        await session.commit()
+        leaderboard.question_changed(question.id)
+        tag_index.add(tag.id, tag.name)
 
+        # A brand-new tag has no votes yet
         return templates.TemplateResponse("tags/item.html", {
             "request": request,
-            "tag": TagPublic.from_tag(tag)
+            "tag": TagPublic.from_tag(tag, question, current_user, VoteContext()),
+            "question": question
         })
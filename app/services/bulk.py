@@ -0,0 +1,394 @@
+"""
+Bulk import and export of questions, tags and votes as JSONL or CSV.
+
+    python -m app.services.bulk export dump.jsonl
+    python -m app.services.bulk import dump.jsonl
+
+The same files go through POST /admin/import and GET /admin/export. A file
+is a sequence of records, one per line or CSV row:
+
+    {"kind": "question", "id": 7, "text": "What is a closure?", "tags": ["python", "functions"], "user": "alice"}
+    {"kind": "vote", "question_id": 7, "user": "bob", "value": 1, "created_at": "2024-05-01T12:00:00"}
+    {"kind": "vote", "question_id": 7, "tag": "python", "user": "carol", "value": -1}
+
+Question ids only tie votes to questions within the file; imported questions
+get new ids, so votes must come after their question. CSV files have the
+CSV_FIELDS columns, with the tags joined by "|".
+
+Imports skip the routes' one-row-at-a-time path:
+- questions are inserted IMPORT_BATCH at a time with executemany, one
+  transaction per batch together with their tag links and search entries
+- tag names are resolved through an in-memory normalized name -> id map
+  loaded once; missing tags are inserted per batch
+- votes are inserted IMPORT_BATCH at a time, one transaction each; votes on
+  questions still waiting in their batch are held until it is written. A
+  vote the database already has, or that the file repeats, is left alone and
+  counted as skipped
+- at the end the vote sums, counts and ranking scores of every question that
+  got votes are recomputed from the vote rows, which bumps their revisions
+Users the file names but the database doesn't know are created with a
+password nobody knows. Malformed records are skipped and reported.
+
+Exports read through server-side cursors (yield_per) and fetch tags per
+batch, so memory stays flat whatever the size of the database.
+"""
+import argparse
+import csv
+import io
+import json
+import secrets
+import sys
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import IO, Iterable, Iterator, Optional
+
+from sqlalchemy import Engine, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import Session, select
+
+from app import settings
+from app.db.revisions import next_revision
+from app.models import Question, QuestionTagLink, QuestionTagVote, QuestionVote, Tag, User
+from app.models.tag import normalize_tag_name
+from app.services import rankings, search
+from app.services.passwords import pwd_context
+
+FORMATS = {"jsonl": "application/x-ndjson", "csv": "text/csv"}
+CSV_FIELDS = ["kind", "id", "text", "tags", "user", "question_id", "tag", "value", "created_at"]
+MAX_REPORTED_ERRORS = 20
+# Export responses are sent in chunks of about this many bytes
+EXPORT_CHUNK = 64 * 1024
+
+
+@dataclass
+class ImportReport:
+    questions: int = 0
+    tags: int = 0
+    votes: int = 0
+    users: int = 0
+    skipped: int = 0
+    seconds: float = 0
+    errors: list[str] = field(default_factory=list)
+
+    def skip(self, line: int, message: str):
+        self.skip_many(1, f"line {line}: {message}")
+
+    def skip_many(self, count: int, message: str):
+        self.skipped += count
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(message)
+
+
+def read_records(lines: Iterable[str], format: str) -> Iterator[tuple[int, Optional[dict]]]:
+    """(line number, record) pairs; the record is None for a line that doesn't parse."""
+    if format == "csv":
+        for line, row in enumerate(csv.DictReader(lines), 2):
+            record = {key: value for key, value in row.items() if key and value not in (None, "")}
+            if "tags" in record:
+                record["tags"] = record["tags"].split("|")
+            yield line, record
+        return
+    for line, text in enumerate(lines, 1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError:
+            record = None
+        yield line, record if isinstance(record, dict) else None
+
+
+def _insert_ignoring_duplicates(session: Session, model):
+    dialect = {"sqlite": sqlite, "postgresql": postgresql}[session.get_bind().dialect.name]
+    return dialect.insert(model.__table__).on_conflict_do_nothing()
+
+
+class Importer:
+    def __init__(self, engine: Engine, batch_size: int = 5000):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.report = ImportReport()
+
+        # Normalized tag name -> id, username -> id, question id in the file -> id
+        self.tag_ids: dict[str, int] = {}
+        self.user_ids: dict[str, int] = {}
+        self.question_ids: dict[str, int] = {}
+        # (question id, tag id) of the imported questions, for their tag votes
+        self.links: set[tuple[int, int]] = set()
+        self.voted: set[int] = set()
+        self._questions: list[tuple[int, Optional[str], str, list[str], Optional[str]]] = []
+        # File ids of self._questions, and the votes on them waiting for their ids
+        self._batched_ids: set[str] = set()
+        self._held_votes: list[tuple[int, dict]] = []
+        self._votes: list[tuple[str, int, Optional[int], int, datetime]] = []
+        self._duplicate_votes = 0
+        self._password_hash: Optional[str] = None
+
+    def run(self, records: Iterable[tuple[int, Optional[dict]]]) -> ImportReport:
+        started = time.perf_counter()
+        with Session(self.engine) as session:
+            self.tag_ids = dict(session.execute(select(Tag.normalized_name, Tag.id)).all())
+            self.user_ids = dict(session.execute(select(User.username, User.id)).all())
+        for line, record in records:
+            if record is None:
+                self.report.skip(line, "not a JSON object")
+            elif record.get("kind") == "question":
+                self._add_question(line, record)
+            elif record.get("kind") == "vote":
+                self._add_vote(line, record)
+            else:
+                self.report.skip(line, f"unknown kind {record.get('kind')!r}")
+        self._flush_questions()
+        self._flush_votes()
+        if self._duplicate_votes:
+            self.report.skip_many(self._duplicate_votes, f"votes already in the database or repeated in the file: {self._duplicate_votes}")
+        self._rescore()
+        self.report.seconds = round(time.perf_counter() - started, 2)
+        return self.report
+
+    def _add_question(self, line: int, record: dict):
+        text = record.get("text")
+        if not isinstance(text, str) or not text.strip():
+            self.report.skip(line, "question without text")
+            return
+        tags = record.get("tags") or []
+        if isinstance(tags, str):
+            tags = tags.split("|")
+        # As create_tag stores them
+        names = [" ".join(str(name).split()) for name in tags]
+        file_id = str(record["id"]) if record.get("id") is not None else None
+        self._questions.append((line, file_id, text, [name for name in names if name], record.get("user")))
+        if file_id is not None:
+            self._batched_ids.add(file_id)
+        if len(self._questions) >= self.batch_size:
+            self._flush_questions()
+
+    def _add_vote(self, line: int, record: dict):
+        if str(record.get("question_id")) in self._batched_ids:
+            # Its question doesn't have an id yet
+            self._held_votes.append((line, record))
+            return
+        question_id = self.question_ids.get(str(record.get("question_id")))
+        if question_id is None:
+            self.report.skip(line, "vote on a question that isn't in the file before it")
+            return
+        try:
+            value = int(record.get("value"))
+            created_at = datetime.fromisoformat(record["created_at"]) if record.get("created_at") else datetime.utcnow()
+        except (TypeError, ValueError):
+            self.report.skip(line, "bad value or created_at")
+            return
+        user = record.get("user")
+        if value not in (1, -1) or not user:
+            self.report.skip(line, "vote needs a user and a value of 1 or -1")
+            return
+        tag_id = None
+        if record.get("tag"):
+            tag_id = self.tag_ids.get(normalize_tag_name(str(record["tag"])))
+            if (question_id, tag_id) not in self.links:
+                self.report.skip(line, "vote on a tag the question doesn't have")
+                return
+        if created_at.tzinfo is not None:
+            # Stored as naive UTC
+            created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+        self._votes.append((str(user), question_id, tag_id, value, created_at))
+        if len(self._votes) >= self.batch_size:
+            self._flush_votes()
+
+    def _ensure_users(self, session: Session, usernames: Iterable[str]):
+        missing = {name for name in usernames if name and name not in self.user_ids}
+        if not missing:
+            return
+        if self._password_hash is None:
+            self._password_hash = pwd_context.hash(secrets.token_urlsafe(32))
+        rows = session.execute(
+            insert(User.__table__).returning(User.id, User.username, sort_by_parameter_order=True),
+            [{"username": name, "email": f"{name}@imported.invalid", "hashed_password": self._password_hash} for name in sorted(missing)],
+        ).all()
+        self.user_ids.update((username, user_id) for user_id, username in rows)
+        self.report.users += len(rows)
+
+    def _flush_questions(self):
+        if not self._questions:
+            return
+        batch, self._questions = self._questions, []
+        self._batched_ids.clear()
+        with Session(self.engine) as session:
+            self._ensure_users(session, (user for *_, user in batch))
+            new_tags = {}
+            for *_, names, _ in batch:
+                for name in names:
+                    normalized = normalize_tag_name(name)
+                    if normalized not in self.tag_ids:
+                        new_tags.setdefault(normalized, name)
+            if new_tags:
+                rows = session.execute(
+                    insert(Tag.__table__).returning(Tag.id, Tag.name, Tag.normalized_name, sort_by_parameter_order=True),
+                    [{"name": name, "normalized_name": normalized} for normalized, name in new_tags.items()],
+                ).all()
+                self.tag_ids.update((normalized, tag_id) for tag_id, _, normalized in rows)
+                search.index_tags(session, [(tag_id, name) for tag_id, name, _ in rows])
+                self.report.tags += len(rows)
+
+            ids = session.execute(
+                insert(Question.__table__).values(revision=next_revision()).returning(Question.id, sort_by_parameter_order=True),
+                [{"text": text, "created_by": self.user_ids.get(user)} for _, _, text, _, user in batch],
+            ).scalars().all()
+            links = []
+            for question_id, (_, file_id, _, names, _) in zip(ids, batch):
+                if file_id is not None:
+                    self.question_ids[file_id] = question_id
+                for tag_id in {self.tag_ids[normalize_tag_name(name)] for name in names}:
+                    links.append({"question_id": question_id, "tag_id": tag_id})
+                    self.links.add((question_id, tag_id))
+            if links:
+                session.execute(insert(QuestionTagLink.__table__), links)
+            # One writer inserts them all in a row, so their ids are one range
+            search.index_question_range(session, min(ids), max(ids))
+            session.commit()
+        self.report.questions += len(ids)
+        held, self._held_votes = self._held_votes, []
+        for line, record in held:
+            self._add_vote(line, record)
+
+    def _flush_votes(self):
+        if not self._votes:
+            return
+        batch, self._votes = self._votes, []
+        with Session(self.engine) as session:
+            self._ensure_users(session, (user for user, *_ in batch))
+            question_votes = [
+                {"user_id": self.user_ids[user], "question_id": question_id, "vote_value": value, "created_at": created_at}
+                for user, question_id, tag_id, value, created_at in batch if tag_id is None
+            ]
+            tag_votes = [
+                {"user_id": self.user_ids[user], "question_id": question_id, "tag_id": tag_id, "vote_value": value, "created_at": created_at}
+                for user, question_id, tag_id, value, created_at in batch if tag_id is not None
+            ]
+            for model, rows in ((QuestionVote, question_votes), (QuestionTagVote, tag_votes)):
+                if rows:
+                    inserted = session.execute(_insert_ignoring_duplicates(session, model), rows).rowcount
+                    self.report.votes += inserted
+                    self._duplicate_votes += len(rows) - inserted
+            session.commit()
+        self.voted.update(question_id for _, question_id, *_ in batch)
+
+    def _rescore(self):
+        voted = sorted(self.voted)
+        for start in range(0, len(voted), self.batch_size):
+            with Session(self.engine) as session:
+                rankings.rescore(session, voted[start:start + self.batch_size])
+                session.commit()
+
+
+def import_file(engine: Engine, file: IO[str], format: str, batch_size: int = settings.IMPORT_BATCH) -> ImportReport:
+    return Importer(engine, batch_size).run(read_records(file, format))
+
+
+def export_records(session: Session, batch_size: int = 5000) -> Iterator[dict]:
+    """Every question, then every vote, as import records."""
+    questions = session.execute(
+        select(Question.id, Question.text, User.username)
+        .outerjoin(User, User.id == Question.created_by)
+        .order_by(Question.id).execution_options(yield_per=batch_size)
+    )
+    for partition in questions.partitions():
+        tags = defaultdict(list)
+        for question_id, name in session.execute(
+            select(QuestionTagLink.question_id, Tag.name)
+            .join(Tag, Tag.id == QuestionTagLink.tag_id)
+            .where(QuestionTagLink.question_id.in_([row.id for row in partition]))
+        ):
+            tags[question_id].append(name)
+        for question_id, text, username in partition:
+            record = {"kind": "question", "id": question_id, "text": text, "tags": tags[question_id]}
+            if username is not None:
+                record["user"] = username
+            yield record
+
+    votes = session.execute(
+        select(QuestionVote.question_id, User.username, QuestionVote.vote_value, QuestionVote.created_at)
+        .join(User, User.id == QuestionVote.user_id)
+        .order_by(QuestionVote.id).execution_options(yield_per=batch_size)
+    )
+    for question_id, username, value, created_at in votes:
+        yield {"kind": "vote", "question_id": question_id, "user": username, "value": value, "created_at": created_at.isoformat()}
+
+    tag_votes = session.execute(
+        select(QuestionTagVote.question_id, Tag.name, User.username, QuestionTagVote.vote_value, QuestionTagVote.created_at)
+        .join(Tag, Tag.id == QuestionTagVote.tag_id)
+        .join(User, User.id == QuestionTagVote.user_id)
+        .order_by(QuestionTagVote.id).execution_options(yield_per=batch_size)
+    )
+    for question_id, name, username, value, created_at in tag_votes:
+        yield {
+            "kind": "vote", "question_id": question_id, "tag": name, "user": username,
+            "value": value, "created_at": created_at.isoformat(),
+        }
+
+
+def format_records(records: Iterable[dict], format: str) -> Iterator[str]:
+    if format == "jsonl":
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+        return
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS)
+    writer.writeheader()
+    for record in records:
+        if "tags" in record:
+            record = {**record, "tags": "|".join(record["tags"])}
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def export_chunks(engine: Engine, format: str) -> Iterator[bytes]:
+    """The export file in chunks of about EXPORT_CHUNK bytes, for a streamed response."""
+    with Session(engine) as session:
+        pending, size = [], 0
+        for text in format_records(export_records(session), format):
+            pending.append(text)
+            size += len(text)
+            if size >= EXPORT_CHUNK:
+                yield "".join(pending).encode()
+                pending, size = [], 0
+        yield "".join(pending).encode()
+
+
+def format_of(path: str, format: Optional[str]) -> str:
+    return format or ("csv" if path.endswith(".csv") else "jsonl")
+
+
+def main():
+    from app.db.database import engine
+
+    parser = argparse.ArgumentParser(description="Import or export questions, tags and votes as JSONL or CSV.")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("path", help="file to read or write, - for stdin/stdout")
+    parser.add_argument("--format", choices=list(FORMATS), help="default: from the file extension, else jsonl")
+    args = parser.parse_args()
+    format = format_of(args.path, args.format)
+
+    if args.action == "import":
+        file = sys.stdin if args.path == "-" else open(args.path, newline="", encoding="utf-8")
+        with file:
+            report = import_file(engine, file, format)
+        print(json.dumps(asdict(report), indent=2))
+        return
+
+    started = time.perf_counter()
+    file = sys.stdout if args.path == "-" else open(args.path, "w", newline="", encoding="utf-8")
+    records = 0
+    with file, Session(engine) as session:
+        for text in format_records(export_records(session), format):
+            file.write(text)
+            records += 1
+    print(f"Exported {records} records in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Cached "most popular questions" list for the front page.
+
+The top questions are rendered into QuestionPublic objects once and kept in
+process memory. Votes update cached scores in place; a vote that could change
+which questions make the list drops the cache instead, and LEADERBOARD_TTL_SECONDS
+bounds staleness from writes made by other workers. Refreshing reads only the
+denormalized counters, so anonymous front-page hits never touch the vote tables;
+logged-in users get their own votes overlaid per request.
+"""
+import logging
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import desc
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
+
+from app import settings
+from app.metrics import registry
+from app.models import Question, QuestionPublic, User
+from app.utils.vote_context import VoteContext
+
+logger = logging.getLogger(__name__)
+
+
+def _rank(question: QuestionPublic) -> tuple[int, int]:
+    # Same order as the front page query: vote_sum desc, id desc
+    return question.vote_sum, question.id
+
+
+class Leaderboard:
+    def __init__(self, size: int = 15, ttl_seconds: float = 5):
+        self.size = size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # Replaced, never mutated, so readers can keep using a list they got
+        self._entries: Optional[tuple[QuestionPublic, ...]] = None
+        self._expires_at = 0.0
+        self._refreshing = False
+
+    def get(self, session: Session) -> tuple[QuestionPublic, ...]:
+        """Return the top questions with vote_sum set and voted left NEUTRAL."""
+        entries = self._entries
+        if entries is not None and time.monotonic() < self._expires_at:
+            self.hits += 1
+            return entries
+
+        # The lock is never held across a query: under AsyncSession.run_sync
+        # another coroutine on the same thread could otherwise block on it
+        with self._lock:
+            if self._refreshing and entries is not None:
+                # Someone else is already refreshing; the stale list will do
+                self.hits += 1
+                return entries
+            self._refreshing = True
+        try:
+            self.misses += 1
+            loaded = self._load(session)
+        finally:
+            with self._lock:
+                self._refreshing = False
+        with self._lock:
+            self._entries = loaded
+            self._expires_at = time.monotonic() + self.ttl_seconds
+        logger.debug("Front page leaderboard refreshed (hits=%d, misses=%d)", self.hits, self.misses)
+        return loaded
+
+    def _load(self, session: Session) -> tuple[QuestionPublic, ...]:
+        results = session.exec(
+            select(Question)
+            .options(selectinload(Question.user), selectinload(Question.tags))
+            .order_by(desc(Question.vote_sum), desc(Question.id))
+            .limit(self.size)
+        ).all()
+        vote_context = VoteContext.load(session, [q.id for q in results], question_sums={q.id: q.vote_sum for q in results})
+        return tuple(QuestionPublic.from_question(q, vote_context=vote_context) for q in results)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+
+    def update_question(self, question_id: int, vote_sum: int):
+        """Record a question's new score, e.g. after a vote or when it was created."""
+        with self._lock:
+            entries = self._entries
+            if entries is None:
+                return
+            positions = {q.id: i for i, q in enumerate(entries)}
+            lowest = _rank(entries[-1]) if entries else None
+
+            if question_id not in positions:
+                # A question outside the list can only get in by beating the last entry
+                if len(entries) < self.size or (vote_sum, question_id) > lowest:
+                    self._entries = None
+                return
+
+            updated = list(entries)
+            updated[positions[question_id]] = entries[positions[question_id]].model_copy(update={"vote_sum": vote_sum})
+            if len(entries) == self.size and (vote_sum, question_id) < lowest:
+                # It may have fallen behind a question we don't have cached
+                self._entries = None
+                return
+            updated.sort(key=_rank, reverse=True)
+            self._entries = tuple(updated)
+
+    def update_question_tag(self, question_id: int, tag_id: int, vote_sum: int):
+        with self._lock:
+            entries = self._entries
+            if entries is None:
+                return
+            for i, question in enumerate(entries):
+                if question.id != question_id:
+                    continue
+                # Tags keep their order; it comes from their stored Wilson
+                # scores, which the next refresh picks up
+                tags = [tag.model_copy(update={"vote_sum": vote_sum}) if tag.id == tag_id else tag for tag in question.tags]
+                updated = list(entries)
+                updated[i] = question.model_copy(update={"tags": tags})
+                self._entries = tuple(updated)
+                return
+
+    def question_changed(self, question_id: int):
+        """Drop the cache if it holds this question, e.g. after its tags changed."""
+        entries = self._entries
+        if entries is not None and any(q.id == question_id for q in entries):
+            self.invalidate()
+
+
+def with_user_votes(session: Session, questions: tuple[QuestionPublic, ...], current_user: User) -> list[QuestionPublic]:
+    """Copy cached questions and overlay the current user's votes on them."""
+    vote_context = VoteContext.load_user_votes(session, [q.id for q in questions], current_user)
+    return [
+        q.model_copy(update={
+            "voted": vote_context.question_vote(q.id),
+            "tags": [tag.model_copy(update={"voted": vote_context.tag_vote(q.id, tag.id)}) for tag in q.tags],
+        })
+        for q in questions
+    ]
+
+
+leaderboard = Leaderboard(ttl_seconds=settings.LEADERBOARD_TTL_SECONDS)
+
+registry.callback_counter("leaderboard_hits_total", "Front page loads served from the cache.", lambda: leaderboard.hits)
+registry.callback_counter("leaderboard_misses_total", "Front page loads that queried the database.", lambda: leaderboard.misses)
@@ -0,0 +1,243 @@
+"""
+Live vote totals for open pages, pushed as Server-Sent Events.
+
+The vote routes publish the new total of a question or of a tag on a question,
+and a flusher task hands it to the subscribers of that question. A question
+is pushed at most once per LIVE_PUSH_INTERVAL_MS: the first vote after a quiet
+spell goes out at once, later ones wait for the interval to end and only the
+latest total of each item is sent. Votes on questions nobody is watching are
+dropped at once.
+
+A subscriber is one SSE response waiting on an asyncio.Event; there is no
+thread or queue per connection. It keeps only the latest unsent total per
+item, so a client that reads slowly skips intermediate totals instead of
+building a backlog. Connections are closed after LIVE_MAX_CONNECTION_SECONDS
+(browsers reconnect on their own), which rebalances them across workers and
+keeps them from holding up a graceful shutdown.
+
+Each worker only pushes the votes it took itself; pages connected to other
+workers see those totals on their next load.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import AsyncIterator, Iterable, Optional
+
+from app import settings
+from app.metrics import registry
+from app.templating import templates
+
+logger = logging.getLogger(__name__)
+
+# (question id, tag id or None for the question itself)
+ItemKey = tuple[int, Optional[int]]
+
+
+def _event(name: str, data: str) -> str:
+    lines = "".join(f"data: {line}\n" for line in data.splitlines() or [""])
+    return f"event: {name}\n{lines}\n"
+
+
+class Subscriber:
+    def __init__(self, question_ids: frozenset[int]):
+        self.question_ids = question_ids
+        # Event name -> latest unsent data
+        self._pending: dict[str, str] = {}
+        self._ready = asyncio.Event()
+        self.closed = False
+
+    def offer(self, name: str, data: str) -> bool:
+        """Queue an update; False if it replaced one the client never got."""
+        replaced = name in self._pending
+        self._pending[name] = data
+        self._ready.set()
+        return not replaced
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    async def wait(self):
+        await self._ready.wait()
+
+    def take(self) -> dict[str, str]:
+        pending, self._pending = self._pending, {}
+        self._ready.clear()
+        return pending
+
+
+class LiveHub:
+    def __init__(self, interval_ms: int = 500, max_subscribers: int = 10000):
+        self.interval = interval_ms / 1000
+        self.max_subscribers = max_subscribers
+        self.pushed = 0
+        self.dropped = 0
+
+        # Only touched on the event loop
+        self._subscribers: dict[int, set[Subscriber]] = defaultdict(set)
+        self._count = 0
+        self._flusher: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        # question -> when it was last pushed
+        self._pushed_at: dict[int, float] = {}
+        # Publishing may come from threadpool routes, so the pending totals
+        # have a lock; it is never held across an await
+        self._lock = threading.Lock()
+        self._changed: dict[ItemKey, int] = {}
+
+    def __len__(self):
+        return self._count
+
+    def has_room(self) -> bool:
+        return self._count < self.max_subscribers
+
+    def subscribe(self, question_ids: Iterable[int]) -> Optional[Subscriber]:
+        """Watch some questions; None if this worker has no room for another subscriber."""
+        if not self.has_room():
+            return None
+        if self._flusher is None or self._flusher.done():
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self._flusher = self._loop.create_task(self._flush_forever())
+        subscriber = Subscriber(frozenset(question_ids))
+        for question_id in subscriber.question_ids:
+            self._subscribers[question_id].add(subscriber)
+        self._count += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        for question_id in subscriber.question_ids:
+            watchers = self._subscribers.get(question_id)
+            if watchers is not None:
+                watchers.discard(subscriber)
+                if not watchers:
+                    del self._subscribers[question_id]
+        self._count -= 1
+
+    def publish_question(self, question_id: int, vote_sum: int):
+        self._publish((question_id, None), vote_sum)
+
+    def publish_tag(self, question_id: int, tag_id: int, vote_sum: int):
+        self._publish((question_id, tag_id), vote_sum)
+
+    def _publish(self, key: ItemKey, vote_sum: int):
+        if key[0] not in self._subscribers or self._loop is None:
+            return
+        with self._lock:
+            self._changed[key] = vote_sum
+        self._loop.call_soon_threadsafe(self._wake.set)
+
+    @staticmethod
+    def _render(key: ItemKey, vote_sum: int) -> tuple[str, str]:
+        question_id, tag_id = key
+        if tag_id is None:
+            html = templates.get_template("questions/score.html").render(
+                question={"id": question_id, "vote_sum": vote_sum}
+            )
+            return f"question-{question_id}", html
+        html = templates.get_template("tags/score.html").render(
+            question={"id": question_id}, tag={"id": tag_id, "vote_sum": vote_sum}
+        )
+        return f"tag-{question_id}-{tag_id}", html
+
+    def flush(self) -> Optional[float]:
+        """
+        Push the totals whose question is due; returns the seconds until the
+        next held back one is, or None if nothing is left.
+        """
+        now = time.monotonic()
+        due: dict[ItemKey, int] = {}
+        next_due = None
+        with self._lock:
+            for key, vote_sum in list(self._changed.items()):
+                ready_at = self._pushed_at.get(key[0], 0) + self.interval
+                if ready_at <= now:
+                    due[key] = self._changed.pop(key)
+                else:
+                    next_due = min(next_due or ready_at, ready_at)
+        for question_id in {key[0] for key in due}:
+            self._pushed_at[question_id] = now
+        # Forget questions that have been quiet for an interval
+        for question_id, pushed_at in list(self._pushed_at.items()):
+            if pushed_at + self.interval <= now:
+                del self._pushed_at[question_id]
+
+        for key, vote_sum in due.items():
+            watchers = self._subscribers.get(key[0])
+            if not watchers:
+                continue
+            # Rendered once, whatever the number of subscribers
+            name, data = self._render(key, vote_sum)
+            for subscriber in watchers:
+                if subscriber.offer(name, data):
+                    self.pushed += 1
+                else:
+                    self.dropped += 1
+        return None if next_due is None else next_due - now
+
+    async def _flush_forever(self):
+        while True:
+            try:
+                delay = self.flush()
+            except Exception:
+                logger.exception("Pushing live vote totals failed")
+                delay = self.interval
+            if delay is None:
+                await self._wake.wait()
+                self._wake.clear()
+            else:
+                await asyncio.sleep(delay)
+
+    async def events(
+        self, question_ids: Iterable[int], keepalive_seconds: float, max_seconds: float
+    ) -> AsyncIterator[str]:
+        """
+        SSE body with the totals of some questions and their tags. Subscribes
+        once the body starts and unsubscribes when the client goes away.
+        """
+        subscriber = self.subscribe(question_ids)
+        if subscriber is None:
+            return
+        deadline = time.monotonic() + max_seconds
+        try:
+            # Reconnect after a second once the connection is closed
+            yield "retry: 1000\n\n"
+            while not subscriber.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    async with asyncio.timeout(min(keepalive_seconds, remaining)):
+                        await subscriber.wait()
+                except TimeoutError:
+                    # Comment line; lets proxies and the server notice dead connections
+                    yield ": keepalive\n\n"
+                    continue
+                pending = subscriber.take()
+                if pending:
+                    yield "".join(_event(name, data) for name, data in pending.items())
+        finally:
+            self.unsubscribe(subscriber)
+
+    async def close(self):
+        """End every subscription and stop the flusher."""
+        for watchers in list(self._subscribers.values()):
+            for subscriber in list(watchers):
+                subscriber.close()
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+
+
+live_hub = LiveHub(settings.LIVE_PUSH_INTERVAL_MS, settings.LIVE_MAX_SUBSCRIBERS)
+
+registry.callback_gauge("live_subscribers", "Open live vote update streams.", lambda: len(live_hub))
+registry.callback_counter("live_updates_pushed_total", "Vote totals handed to live streams.", lambda: live_hub.pushed)
+registry.callback_counter(
+    "live_updates_dropped_total",
+    "Vote totals replaced by a newer one before a slow stream sent them.",
+    lambda: live_hub.dropped,
+)
@@ -0,0 +1,114 @@
+"""
+Password hashing off the event loop.
+
+bcrypt takes a few hundred milliseconds per hash by design, so calling it from
+an async route stalls every other request on the worker. Hashes and checks run
+on a small dedicated thread pool instead (bcrypt releases the GIL while it
+works). At most PASSWORD_HASH_WORKERS run at once and at most
+PASSWORD_HASH_MAX_QUEUE wait behind them; beyond that callers get a 503 rather
+than piling up.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from app import settings
+from app.metrics import password_hash_duration, registry
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Hashes made with fewer rounds than BCRYPT_ROUNDS are reported as needing an
+# update, so raising the work factor upgrades users as they log in
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+)
+
+
+class PasswordHasher:
+    def __init__(self, context: CryptContext, workers: int = 2, max_queue: int = 64):
+        self.context = context
+        self.workers = workers
+        self.max_queue = max_queue
+        self.completed = 0
+        self.rejected = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        # Only touched from the event loop thread
+        self._in_flight = 0
+        # Updated from the worker threads
+        self._lock = threading.Lock()
+        self._running = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Jobs submitted but not yet picked up by a worker."""
+        return max(self._in_flight - self._running, 0)
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(self.context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._submit(self.context.verify, password, hashed_password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+        """Check a password; also return a new hash if the stored one uses outdated settings."""
+        return await self._submit(self.context.verify_and_update, password, hashed_password)
+
+    async def _submit(self, fn: Callable[..., T], *args) -> T:
+        if self._in_flight >= self.workers + self.max_queue:
+            self.rejected += 1
+            logger.warning("Password hash queue full (%d waiting), rejecting request", self.queue_depth)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many logins in progress, please retry",
+                headers={"Retry-After": "1"},
+            )
+
+        self._in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._run, fn, args)
+        finally:
+            self._in_flight -= 1
+
+    def _run(self, fn: Callable[..., T], args: tuple) -> T:
+        with self._lock:
+            self._running += 1
+        try:
+            with password_hash_duration.time(fn.__name__):
+                return fn(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self.completed += 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+password_hasher = PasswordHasher(
+    pwd_context,
+    workers=settings.PASSWORD_HASH_WORKERS,
+    max_queue=settings.PASSWORD_HASH_MAX_QUEUE,
+)
+
+registry.callback_gauge(
+    "password_hash_queue_depth", "Password hashes waiting for a worker.", lambda: password_hasher.queue_depth
+)
+registry.callback_gauge("password_hash_running", "Password hashes being computed.", lambda: password_hasher.running)
+registry.callback_counter(
+    "password_hash_rejected_total", "Logins answered with 503 because the queue was full.", lambda: password_hasher.rejected
+)
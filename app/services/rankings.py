@@ -0,0 +1,300 @@
+"""
+Hot, best and controversial rankings of questions, and of the tags on a question.
+
+Every Question and QuestionTagLink row stores its up and down vote counts and
+three scores derived from them, so a ranked listing is a range scan over a
+(score, id) index, like the all-time vote_sum one:
+
+- wilson_score ("best"): the lower bound of the 95% Wilson score interval of
+  the upvote share, so 90 up and 10 down ranks above 1 up and 0 down
+- controversy_score: many votes, evenly split, rank highest
+- hot_score: the sum of the votes, each weighing half as much every
+  RANKING_HOT_HALF_LIFE_HOURS after it was cast
+
+Decaying the hot scores as time passes would mean rewriting every row all the
+time. Instead a vote cast at t is stored with the weight
+2 ** ((t - epoch) / half_life): newer votes weigh exponentially more, which
+orders questions exactly like the decayed sums do, as decaying all of them to
+the present divides every score by the same factor. The vote routes add the
+new vote's weight and take away the weight of the vote it replaced, so the
+score stays exact without reading any vote rows.
+
+The weights grow over time, so a batch pass every RANKING_REBASE_SECONDS
+moves the epoch (RankingEpoch) forward and scales all hot scores down by the
+same factor once new votes weigh more than 2 ** REBASE_AFTER_HALF_LIVES. That
+doesn't change any order, so no revisions are bumped.
+
+    python -m app.services.rankings   # recompute all counts and scores from the vote rows
+"""
+import argparse
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import Engine, insert, update
+from sqlmodel import Session, select
+
+from app import settings
+from app.db.revisions import next_revision
+from app.models import Question, QuestionTagLink, QuestionTagVote, QuestionVote, RankingEpoch
+
+logger = logging.getLogger(__name__)
+
+# 95% confidence
+Z = 1.96
+REBASE_AFTER_HALF_LIVES = 32
+BATCH = 10_000
+
+# list_questions' ?sort= -> the column it ranks by
+SORTS = {
+    "top": Question.vote_sum,
+    "hot": Question.hot_score,
+    "best": Question.wilson_score,
+    "controversial": Question.controversy_score,
+}
+
+
+def wilson_lower_bound(ups: int, downs: int) -> float:
+    total = ups + downs
+    if total == 0:
+        return 0.0
+    share = ups / total
+    z2 = Z * Z
+    spread = Z * math.sqrt((share * (1 - share) + z2 / (4 * total)) / total)
+    return (share + z2 / (2 * total) - spread) / (1 + z2 / total)
+
+
+def controversy(ups: int, downs: int) -> float:
+    if ups <= 0 or downs <= 0:
+        return 0.0
+    return float(ups + downs) ** (min(ups, downs) / max(ups, downs))
+
+
+def derived_scores(ups: int, downs: int) -> dict:
+    """Column values of the scores that only depend on the counts."""
+    return {"wilson_score": wilson_lower_bound(ups, downs), "controversy_score": controversy(ups, downs)}
+
+
+def hot_weight(voted_at: datetime, epoch: float) -> float:
+    """Weight of a vote cast at voted_at (naive UTC, as stored) in the hot scores."""
+    seconds = voted_at.replace(tzinfo=timezone.utc).timestamp()
+    return 2.0 ** ((seconds - epoch) / (settings.RANKING_HOT_HALF_LIFE_HOURS * 3600))
+
+
+def hot_epoch(session: Session) -> float:
+    """The epoch of the stored hot scores, set to now if there is none yet."""
+    global _known_epoch
+    epoch = session.execute(select(RankingEpoch.hot_epoch)).scalar()
+    if epoch is None:
+        epoch = time.time()
+        session.execute(insert(RankingEpoch).values(id=1, hot_epoch=epoch))
+    _known_epoch = epoch
+    return epoch
+
+
+# The epoch as this process last saw it. Votes don't read it: their UPDATE
+# only matches while it is still current (epoch_is), and re-reads it if not
+_known_epoch: Optional[float] = None
+
+
+def known_epoch(session: Session) -> float:
+    return hot_epoch(session) if _known_epoch is None else _known_epoch
+
+
+_stored_epoch = select(RankingEpoch.hot_epoch).scalar_subquery()
+
+
+def epoch_is(epoch: float):
+    """WHERE condition that holds as long as the stored epoch is `epoch`."""
+    return _stored_epoch == epoch
+
+
+def epoch_moved(session: Session) -> bool:
+    """Re-read the epoch after an UPDATE with epoch_is matched nothing; False if it hadn't moved."""
+    before = _known_epoch
+    return hot_epoch(session) != before
+
+
+def vote_changes(model, previous: int, previous_at: Optional[datetime], new_value: int, voted_at: datetime, epoch: float) -> dict:
+    """UPDATE values that replace a row's previous vote (0: none) with new_value in its counts and hot score."""
+    hot = 0.0
+    if previous:
+        hot -= previous * hot_weight(previous_at, epoch)
+    if new_value:
+        hot += new_value * hot_weight(voted_at, epoch)
+    return {
+        "up_count": model.up_count + (new_value == 1) - (previous == 1),
+        "down_count": model.down_count + (new_value == -1) - (previous == -1),
+        "hot_score": model.hot_score + hot,
+    }
+
+
+def rebuild(session: Session) -> tuple[int, int]:
+    """
+    Recompute every count and score from the vote rows with a new epoch.
+    Returns the number of questions and question-tag pairs with votes. The caller commits.
+    """
+    epoch = time.time()
+    if session.execute(update(RankingEpoch).values(hot_epoch=epoch)).rowcount == 0:
+        session.execute(insert(RankingEpoch).values(id=1, hot_epoch=epoch))
+
+    # key -> [ups, downs, hot]
+    questions: dict[int, list] = defaultdict(lambda: [0, 0, 0.0])
+    statement = select(QuestionVote.question_id, QuestionVote.vote_value, QuestionVote.created_at)
+    for question_id, vote_value, created_at in session.execute(statement.execution_options(yield_per=BATCH)):
+        _count(questions[question_id], vote_value, hot_weight(created_at, epoch))
+    links: dict[tuple[int, int], list] = defaultdict(lambda: [0, 0, 0.0])
+    statement = select(QuestionTagVote.question_id, QuestionTagVote.tag_id, QuestionTagVote.vote_value, QuestionTagVote.created_at)
+    for question_id, tag_id, vote_value, created_at in session.execute(statement.execution_options(yield_per=BATCH)):
+        _count(links[question_id, tag_id], vote_value, hot_weight(created_at, epoch))
+
+    zeros = {"up_count": 0, "down_count": 0, "hot_score": 0, "wilson_score": 0, "controversy_score": 0}
+    session.execute(update(Question).values(**zeros))
+    session.execute(update(QuestionTagLink).values(**zeros))
+    _write(session, Question, [{"id": question_id, **_scores(counts)} for question_id, counts in questions.items()])
+    _write(session, QuestionTagLink, [
+        {"question_id": question_id, "tag_id": tag_id, **_scores(counts)} for (question_id, tag_id), counts in links.items()
+    ])
+    # Rankings and the order of tags on the pages may all have moved
+    session.execute(update(Question).values(revision=next_revision()))
+    return len(questions), len(links)
+
+
+def rescore(session: Session, question_ids: list[int]):
+    """
+    Recompute the vote sums, counts and scores of some questions and of their
+    tags from the vote rows, e.g. after a bulk import, and bump their
+    revisions. Keep question_ids to a few thousand. The caller commits.
+    """
+    epoch = hot_epoch(session)
+    questions = {question_id: [0, 0, 0.0] for question_id in question_ids}
+    statement = select(QuestionVote.question_id, QuestionVote.vote_value, QuestionVote.created_at)
+    statement = statement.where(QuestionVote.question_id.in_(question_ids)).execution_options(yield_per=BATCH)
+    for question_id, vote_value, created_at in session.execute(statement):
+        _count(questions[question_id], vote_value, hot_weight(created_at, epoch))
+    links: dict[tuple[int, int], list] = defaultdict(lambda: [0, 0, 0.0])
+    statement = select(QuestionTagVote.question_id, QuestionTagVote.tag_id, QuestionTagVote.vote_value, QuestionTagVote.created_at)
+    statement = statement.where(QuestionTagVote.question_id.in_(question_ids)).execution_options(yield_per=BATCH)
+    for question_id, tag_id, vote_value, created_at in session.execute(statement):
+        _count(links[question_id, tag_id], vote_value, hot_weight(created_at, epoch))
+
+    # Votes are +1 or -1, so the sums follow from the counts
+    _write(session, Question, [
+        {"id": question_id, "vote_sum": counts[0] - counts[1], **_scores(counts)} for question_id, counts in questions.items()
+    ])
+    session.execute(
+        update(QuestionTagLink).where(QuestionTagLink.question_id.in_(question_ids))
+        .values(vote_sum=0, up_count=0, down_count=0, hot_score=0, wilson_score=0, controversy_score=0)
+    )
+    _write(session, QuestionTagLink, [
+        {"question_id": question_id, "tag_id": tag_id, "vote_sum": counts[0] - counts[1], **_scores(counts)}
+        for (question_id, tag_id), counts in links.items()
+    ])
+    session.execute(update(Question).where(Question.id.in_(question_ids)).values(revision=next_revision()))
+
+
+def _count(counts: list, vote_value: int, weight: float):
+    if vote_value == 1:
+        counts[0] += 1
+    elif vote_value == -1:
+        counts[1] += 1
+    counts[2] += vote_value * weight
+
+
+def _scores(counts: list) -> dict:
+    ups, downs, hot = counts
+    return {"up_count": ups, "down_count": downs, "hot_score": hot, **derived_scores(ups, downs)}
+
+
+def _write(session: Session, model, rows: list[dict]):
+    # Bulk UPDATE by primary key, executemany in chunks
+    for start in range(0, len(rows), BATCH):
+        session.execute(update(model), rows[start:start + BATCH])
+
+
+def rebase(session: Session) -> bool:
+    """
+    Move the epoch to now and scale the hot scores to match, if new votes have
+    come to weigh more than 2 ** REBASE_AFTER_HALF_LIVES. The caller commits.
+    """
+    epoch = hot_epoch(session)
+    now = time.time()
+    half_life = settings.RANKING_HOT_HALF_LIFE_HOURS * 3600
+    if (now - epoch) / half_life < REBASE_AFTER_HALF_LIVES:
+        return False
+    # Conditional, so two workers can't both scale the scores down
+    moved = session.execute(
+        update(RankingEpoch).where(RankingEpoch.hot_epoch == epoch).values(hot_epoch=now)
+    ).rowcount
+    if not moved:
+        return False
+    factor = 2.0 ** ((epoch - now) / half_life)
+    for model in (Question, QuestionTagLink):
+        session.execute(update(model).where(model.hot_score != 0).values(hot_score=model.hot_score * factor))
+    return True
+
+
+class RankingRebaseJob:
+    def __init__(self, engine: Engine, interval_seconds: float):
+        self.engine = engine
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ranking-rebase", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with Session(self.engine) as session:
+                    if rebase(session):
+                        session.commit()
+                        logger.info("Rebased hot scores")
+            except Exception:
+                logger.exception("Rebasing hot scores failed")
+            self._stop.wait(self.interval_seconds)
+
+
+job: Optional[RankingRebaseJob] = None
+
+
+def start_ranking_rebase(engine: Engine, interval_seconds: float):
+    """Check every interval_seconds whether the hot scores need rebasing; 0 disables it."""
+    global job
+    if interval_seconds <= 0:
+        return
+    job = RankingRebaseJob(engine, interval_seconds)
+    job.start()
+
+
+def stop_ranking_rebase():
+    global job
+    if job:
+        job.stop()
+        job = None
+
+
+def main():
+    from app.db.database import engine
+
+    argparse.ArgumentParser(description="Recompute vote counts and ranking scores from the vote rows.").parse_args()
+    with Session(engine) as session:
+        started = time.perf_counter()
+        questions, links = rebuild(session)
+        session.commit()
+    print(f"Rescored {questions} questions and {links} question-tag pairs in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""
+Related questions from tag co-occurrence.
+
+Each question is a sparse vector over its tags. A tag weighs its inverse
+document frequency (a tag on a handful of questions says more than one on half
+of them) times a factor from the tag's votes on that question, so a tag the
+community agrees with counts more and a downvoted one less. A question's
+related questions are the RELATED_QUESTIONS others with the highest cosine
+similarity. They are stored in the RelatedQuestion side table, so
+read_question gets them with one primary key range lookup.
+
+A job keeps the vectors and a tag -> questions inverted index in memory. It
+runs as its own process, `python -m app.services.related --watch SECONDS`, or
+in single-worker setups as a thread of the web worker if
+RELATED_REFRESH_SECONDS is set. Questions sharing a tag are found through the
+inverted index; for a tag on more than RELATED_MAX_POSTINGS questions only the
+ones where it weighs most are visited, so very common tags don't make a pass quadratic (their low
+IDF makes them count little anyway).
+
+Changes are found through Question.revision (app/db/revisions.py), which new
+tags and tag votes bump. On every pass the job reloads the tags of questions
+whose revision moved since the last pass and recomputes their lists and those of questions that now rank them differently. Only lists
+that changed are written, and their questions' revisions are bumped so the
+pages' ETags change. A full rebuild every RELATED_REBUILD_SECONDS also
+refreshes the IDF weights of questions that didn't change.
+"""
+import argparse
+import heapq
+import logging
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from operator import itemgetter
+from typing import Iterable, Optional
+
+from sqlalchemy import Engine, delete, insert, update
+from sqlmodel import Session, select
+
+from app import settings
+from app.db.revisions import latest_revision, next_revision
+from app.metrics import registry, related_pass_duration
+from app.models import Question, QuestionTagLink, RelatedQuestion
+
+logger = logging.getLogger(__name__)
+
+# Keeps IN lists and write transactions short
+CHUNK = 500
+
+# (score, question id), best first
+Related = list[tuple[float, int]]
+
+
+def vote_factor(vote_sum: int) -> float:
+    """How a tag's votes on a question scale its weight there: 1 without votes."""
+    return 1 + math.log1p(vote_sum) if vote_sum >= 0 else 1 / (1 - vote_sum)
+
+
+class RelatedIndex:
+    def __init__(self, size: int = 5, max_postings: int = 100):
+        self.size = size
+        self.max_postings = max_postings
+        # Last revision seen by a pass
+        self.watermark = 0
+        # question -> tag -> vote_sum, as last loaded
+        self._tag_votes: dict[int, dict[int, int]] = {}
+        # question -> tag -> weight, unit length
+        self._vectors: dict[int, dict[int, float]] = {}
+        # tag -> question -> weight
+        self._postings: dict[int, dict[int, float]] = defaultdict(dict)
+        # tag -> its max_postings heaviest postings, computed when first needed
+        self._heaviest: dict[int, list[tuple[int, float]]] = {}
+        self._related: dict[int, Related] = {}
+        # question -> questions whose lists show it
+        self._shown_in: dict[int, set[int]] = defaultdict(set)
+        self.restored = False
+        # question -> the revision this index's last write gave it, so the
+        # next pass can skip questions that only changed by that write
+        self.written_revisions: dict[int, int] = {}
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def related(self, question_id: int) -> Related:
+        return self._related.get(question_id, [])
+
+    def _vector(self, tag_votes: dict[int, int], document_frequency, questions: int) -> dict[int, float]:
+        weights = {
+            tag_id: math.log(1 + questions / document_frequency(tag_id)) * vote_factor(vote_sum)
+            for tag_id, vote_sum in tag_votes.items()
+        }
+        norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1
+        return {tag_id: weight / norm for tag_id, weight in weights.items()}
+
+    def _file(self, question_id: int, vector: dict[int, float]):
+        self._vectors[question_id] = vector
+        for tag_id, weight in vector.items():
+            self._postings[tag_id][question_id] = weight
+            self._heaviest.pop(tag_id, None)
+
+    def _unfile(self, question_id: int):
+        for tag_id in self._vectors.pop(question_id, {}):
+            postings = self._postings[tag_id]
+            postings.pop(question_id, None)
+            if not postings:
+                del self._postings[tag_id]
+            self._heaviest.pop(tag_id, None)
+
+    def _heaviest_postings(self, tag_id: int) -> list[tuple[int, float]]:
+        heaviest = self._heaviest.get(tag_id)
+        if heaviest is None:
+            postings = self._postings.get(tag_id, {})
+            if len(postings) <= self.max_postings:
+                heaviest = list(postings.items())
+            else:
+                # Ties go to newer questions
+                heaviest = heapq.nlargest(self.max_postings, postings.items(), key=lambda item: (item[1], item[0]))
+            self._heaviest[tag_id] = heaviest
+        return heaviest
+
+    def _scores(self, question_id: int) -> dict[int, float]:
+        scores: dict[int, float] = {}
+        get = scores.get
+        for tag_id, weight in self._vectors.get(question_id, {}).items():
+            for other_id, other_weight in self._heaviest_postings(tag_id):
+                scores[other_id] = get(other_id, 0.0) + weight * other_weight
+        scores.pop(question_id, None)
+        return scores
+
+    def _top(self, question_id: int) -> Related:
+        best = heapq.nlargest(self.size, self._scores(question_id).items(), key=itemgetter(1))
+        return [(score, other_id) for other_id, score in best]
+
+    def _set_related(self, question_id: int, related: Related) -> bool:
+        """Store a new list; True if it shows different questions than before."""
+        old = self._related.get(question_id, [])
+        if [other_id for _, other_id in old] == [other_id for _, other_id in related]:
+            self._related[question_id] = related
+            return False
+        for _, other_id in old:
+            self._shown_in[other_id].discard(question_id)
+        for _, other_id in related:
+            self._shown_in[other_id].add(question_id)
+        if related:
+            self._related[question_id] = related
+        else:
+            self._related.pop(question_id, None)
+        return True
+
+    def restore(self, rows: Iterable[tuple[int, int, float]]):
+        """Take stored (question id, related id, score) rows, in list order, as the current lists."""
+        lists: dict[int, Related] = defaultdict(list)
+        for question_id, related_id, score in rows:
+            lists[question_id].append((score, related_id))
+        for question_id, related in lists.items():
+            self._set_related(question_id, related)
+        self.restored = True
+
+    def rebuild(self, rows: Iterable[tuple[int, int, int]]) -> dict[int, Related]:
+        """
+        Recompute everything from (question id, tag id, vote_sum) rows; returns
+        the lists that changed.
+        """
+        tag_votes: dict[int, dict[int, int]] = defaultdict(dict)
+        for question_id, tag_id, vote_sum in rows:
+            tag_votes[question_id][tag_id] = vote_sum
+        document_frequency = Counter(tag_id for votes in tag_votes.values() for tag_id in votes)
+
+        self._tag_votes = dict(tag_votes)
+        self._vectors = {}
+        self._postings = defaultdict(dict)
+        self._heaviest = {}
+        for question_id, votes in tag_votes.items():
+            self._file(question_id, self._vector(votes, document_frequency.__getitem__, len(tag_votes)))
+
+        changed = {}
+        for question_id in set(self._related) | set(self._vectors):
+            related = self._top(question_id)
+            if self._set_related(question_id, related):
+                changed[question_id] = related
+        return changed
+
+    def update(self, tag_votes: dict[int, dict[int, int]]) -> dict[int, Related]:
+        """
+        Apply the current tags of some questions ({} for none); returns the
+        lists that changed.
+        """
+        moved = [
+            question_id for question_id, votes in tag_votes.items()
+            if self._tag_votes.get(question_id, {}) != votes
+        ]
+        for question_id in moved:
+            self._unfile(question_id)
+            votes = tag_votes[question_id]
+            if votes:
+                self._tag_votes[question_id] = votes
+                self._file(question_id, self._vector(
+                    votes, lambda tag_id: len(self._postings.get(tag_id, ())) + 1, len(self._vectors) + 1
+                ))
+            else:
+                self._tag_votes.pop(question_id, None)
+
+        # The moved questions' own lists, the lists that showed them, and the
+        # lists they now belong in
+        stale = set(moved)
+        for question_id in moved:
+            stale |= self._shown_in.get(question_id, set())
+            for other_id, score in self._scores(question_id).items():
+                others = self._related.get(other_id, [])
+                if len(others) < self.size or score > others[-1][0]:
+                    stale.add(other_id)
+
+        changed = {}
+        for question_id in stale:
+            related = self._top(question_id)
+            if self._set_related(question_id, related):
+                changed[question_id] = related
+        return changed
+
+
+def related_questions(question_id: int):
+    """Statement selecting (id, text) of a question's related questions, best first."""
+    return (
+        select(Question.id, Question.text)
+        .join(RelatedQuestion, RelatedQuestion.related_id == Question.id)
+        .where(RelatedQuestion.question_id == question_id)
+        .order_by(RelatedQuestion.position)
+    )
+
+
+def _chunks(items: list, size: int = CHUNK) -> Iterable[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def load_tag_votes(session: Session, question_ids: list[int]) -> dict[int, dict[int, int]]:
+    tag_votes: dict[int, dict[int, int]] = {question_id: {} for question_id in question_ids}
+    for chunk in _chunks(question_ids):
+        rows = session.exec(
+            select(QuestionTagLink.question_id, QuestionTagLink.tag_id, QuestionTagLink.vote_sum)
+            .where(QuestionTagLink.question_id.in_(chunk))
+        ).all()
+        for question_id, tag_id, vote_sum in rows:
+            tag_votes[question_id][tag_id] = vote_sum
+    return tag_votes
+
+
+def store(session: Session, lists: dict[int, Related]) -> dict[int, int]:
+    """
+    Write changed lists and bump their questions' revisions, a transaction per
+    chunk; returns the new revisions.
+    """
+    revisions = {}
+    for chunk in _chunks(sorted(lists)):
+        session.execute(delete(RelatedQuestion).where(RelatedQuestion.question_id.in_(chunk)))
+        rows = [
+            {"question_id": question_id, "position": position, "related_id": related_id, "score": score}
+            for question_id in chunk
+            for position, (score, related_id) in enumerate(lists[question_id])
+        ]
+        if rows:
+            session.execute(insert(RelatedQuestion), rows)
+        revisions.update(session.execute(
+            update(Question).where(Question.id.in_(chunk)).values(revision=next_revision())
+            .returning(Question.id, Question.revision)
+        ).all())
+        session.commit()
+    return revisions
+
+
+def rebuild(session: Session, index: RelatedIndex) -> int:
+    """Recompute every list from scratch; returns how many were rewritten."""
+    with related_pass_duration.time("rebuild"):
+        watermark = session.execute(latest_revision()).scalar_one()
+        rows = session.exec(
+            select(QuestionTagLink.question_id, QuestionTagLink.tag_id, QuestionTagLink.vote_sum)
+        ).all()
+        if not index.restored:
+            # Start from the stored lists so a restart only rewrites what changed
+            index.restore(session.exec(
+                select(RelatedQuestion.question_id, RelatedQuestion.related_id, RelatedQuestion.score)
+                .order_by(RelatedQuestion.question_id, RelatedQuestion.position)
+            ).all())
+        changed = index.rebuild(rows)
+        index.written_revisions = store(session, changed)
+        index.watermark = watermark
+    return len(changed)
+
+
+def refresh(session: Session, index: RelatedIndex) -> int:
+    """Catch up with questions changed since the last pass; returns how many lists were rewritten."""
+    with related_pass_duration.time("refresh"):
+        watermark = session.execute(latest_revision()).scalar_one()
+        question_ids = [
+            question_id
+            for question_id, revision in session.exec(
+                select(Question.id, Question.revision).where(Question.revision > index.watermark)
+            ).all()
+            if index.written_revisions.get(question_id) != revision
+        ]
+        changed = index.update(load_tag_votes(session, question_ids))
+        index.written_revisions = store(session, changed)
+        index.watermark = watermark
+    return len(changed)
+
+
+class RelatedQuestionsJob:
+    def __init__(self, engine: Engine, index: RelatedIndex, refresh_seconds: float, rebuild_seconds: float):
+        self.engine = engine
+        self.index = index
+        self.refresh_seconds = refresh_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="related-questions", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def run(self):
+        """Rebuild, then refresh until stopped; start() runs this in a thread."""
+        rebuilt_at = None
+        while not self._stop.is_set():
+            try:
+                with Session(self.engine) as session:
+                    if rebuilt_at is None or time.monotonic() - rebuilt_at >= self.rebuild_seconds:
+                        rebuild(session, self.index)
+                        rebuilt_at = time.monotonic()
+                    else:
+                        refresh(session, self.index)
+            except Exception:
+                logger.exception("Updating related questions failed")
+            self._stop.wait(self.refresh_seconds)
+
+
+related_index = RelatedIndex(settings.RELATED_QUESTIONS, settings.RELATED_MAX_POSTINGS)
+job: Optional[RelatedQuestionsJob] = None
+
+registry.callback_gauge(
+    "related_questions_indexed", "Questions with tags in the related questions index.", lambda: len(related_index)
+)
+
+
+def start_related_questions(engine: Engine, refresh_seconds: float, rebuild_seconds: float):
+    """Build the index in the background and keep it current; refresh_seconds 0 disables it."""
+    global job
+    if refresh_seconds <= 0:
+        return
+    job = RelatedQuestionsJob(engine, related_index, refresh_seconds, rebuild_seconds)
+    job.start()
+
+
+def stop_related_questions():
+    global job
+    if job:
+        job.stop()
+        job = None
+
+
+def main():
+    from app.db.database import engine
+
+    parser = argparse.ArgumentParser(description="Recompute the related questions.")
+    parser.add_argument("question_id", type=int, nargs="?", help="print a question's related questions afterwards")
+    parser.add_argument(
+        "--watch", type=float, metavar="SECONDS",
+        help="keep them current: catch up with changes every SECONDS and rebuild every RELATED_REBUILD_SECONDS",
+    )
+    args = parser.parse_args()
+
+    RelatedQuestion.__table__.create(engine, checkfirst=True)
+    if args.watch:
+        RelatedQuestionsJob(engine, related_index, args.watch, settings.RELATED_REBUILD_SECONDS).run()
+        return
+    with Session(engine) as session:
+        started = time.perf_counter()
+        changed = rebuild(session, related_index)
+        print(f"Rebuilt related questions for {len(related_index)} questions in {time.perf_counter() - started:.1f}s, {changed} lists changed")
+        if args.question_id:
+            for question_id, text in session.exec(related_questions(args.question_id)).all():
+                print(f"question {question_id}: {text}")
+
+
+if __name__ == "__main__":
+    main()
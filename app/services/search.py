@@ -0,0 +1,417 @@
+"""
+Full-text search over question texts and tag names.
+
+On SQLite the index is two FTS5 tables, question_search(text, tags) with the
+question id as rowid and tag_search(name) with the tag id; on PostgreSQL it is
+a tsvector table for questions and an expression GIN index on tag names. The
+tables live outside the SQLModel metadata and are created (and filled from
+existing rows) by the migrations. Routes that create questions or change a
+question's tags call index_question/index_tag in the same transaction (bulk
+imports index_question_range/index_tags);
+`python -m app.services.search --rebuild` refills the index from scratch.
+
+Queries match every word; typeahead queries match the last one as a prefix
+(of at least MIN_PREFIX letters) so results can follow typing. Ranking blends
+text relevance with votes: the relevance is scaled by up to
+1 + SEARCH_VOTE_WEIGHT, reaching half of that boost at VOTE_HALF_BOOST votes.
+
+Scoring every match costs time in proportion to the matches, so how the
+SEARCH_CANDIDATES candidates are picked depends on how common the words are,
+counted up to SEARCH_SCORED_MATCHES questions per word:
+- if a word is in at most that many questions, the query is selective:
+  every match is scored and the most relevant are the candidates. bm25()
+  counts every match of each word it scores, so on SQLite only the selective
+  words are scored and the common ones only filter (their inverse document
+  frequency is small anyway); PostgreSQL's ts_rank scores the whole query
+- otherwise every word is common, and the candidates are the most-voted
+  matches, found along ix_question_vote_sum_id. On SQLite the walk stops
+  after VOTE_WALK questions and the newest matches make up any shortfall; the
+  candidates are then scored with BM25 without the inverse document frequency
+"""
+import argparse
+import re
+import unicodedata
+
+from sqlalchemy import Connection, text
+from sqlmodel import Session, select
+
+from app import settings
+from app.models import Question, QuestionTagLink, Tag
+
+# Vote count at which a question gets half of the vote boost
+VOTE_HALF_BOOST = 10
+MAX_QUERY_WORDS = 8
+BM25_K1 = 1.2
+BM25_B = 0.75
+# bm25 weight of a word found in the tags, relative to one in the text
+TAG_WEIGHT = 2.0
+# Shorter prefixes expand to too many words to be fast
+MIN_PREFIX = 2
+# Most-voted questions looked at for a query of common words on SQLite; each
+# costs a lookup of its indexed text
+VOTE_WALK = 500
+
+# Words as FTS5's unicode61 tokenizer splits them
+_WORD = re.compile(r"[^\W_]+")
+
+
+def query_words(query: str) -> list[str]:
+    return _WORD.findall(query.lower())[:MAX_QUERY_WORDS]
+
+
+def fold(value: str) -> str:
+    """Lowercase and without diacritics, as unicode61 with remove_diacritics compares words."""
+    value = value.lower()
+    if value.isascii():
+        return value
+    return "".join(char for char in unicodedata.normalize("NFKD", value) if not unicodedata.combining(char))
+
+
+class Fts5Backend:
+    def create(self, conn: Connection) -> bool:
+        """Create the index tables if missing; True if they had to be created."""
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'question_search'")).first()
+        if exists:
+            return False
+        options = "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'"
+        conn.execute(text(f"CREATE VIRTUAL TABLE question_search USING fts5(text, tags, {options})"))
+        conn.execute(text(f"CREATE VIRTUAL TABLE tag_search USING fts5(name, {options})"))
+        return True
+
+    _FILL = (
+        "INSERT INTO question_search (rowid, text, tags) "
+        "SELECT question.id, question.text, coalesce(group_concat(tag.name, ' '), '') FROM question "
+        "LEFT JOIN questiontaglink ON questiontaglink.question_id = question.id "
+        "LEFT JOIN tag ON tag.id = questiontaglink.tag_id "
+        "{where} GROUP BY question.id"
+    )
+
+    def rebuild(self, session: Session):
+        session.execute(text("DELETE FROM question_search"))
+        session.execute(text(self._FILL.format(where="")))
+        session.execute(text("DELETE FROM tag_search"))
+        session.execute(text("INSERT INTO tag_search (rowid, name) SELECT id, name FROM tag"))
+
+    def index_range(self, session: Session, first_id: int, last_id: int):
+        ids = {"first": first_id, "last": last_id}
+        session.execute(text("DELETE FROM question_search WHERE rowid BETWEEN :first AND :last"), ids)
+        session.execute(text(self._FILL.format(where="WHERE question.id BETWEEN :first AND :last")), ids)
+
+    def index_tags(self, session: Session, tags: list[tuple[int, str]]):
+        session.execute(text("DELETE FROM tag_search WHERE rowid = :id"), [{"id": tag_id} for tag_id, _ in tags])
+        session.execute(
+            text("INSERT INTO tag_search (rowid, name) VALUES (:id, :name)"),
+            [{"id": tag_id, "name": name} for tag_id, name in tags],
+        )
+
+    def index_question(self, session: Session, question_id: int, question_text: str, tags: list[str]):
+        session.execute(text("DELETE FROM question_search WHERE rowid = :id"), {"id": question_id})
+        session.execute(
+            text("INSERT INTO question_search (rowid, text, tags) VALUES (:id, :text, :tags)"),
+            {"id": question_id, "text": question_text, "tags": " ".join(tags)},
+        )
+
+    def index_tag(self, session: Session, tag_id: int, name: str):
+        session.execute(text("DELETE FROM tag_search WHERE rowid = :id"), {"id": tag_id})
+        session.execute(text("INSERT INTO tag_search (rowid, name) VALUES (:id, :name)"), {"id": tag_id, "name": name})
+
+    @staticmethod
+    def match(words: list[str], prefix: bool) -> str:
+        # Quoted, so words are never read as FTS5 operators
+        return " ".join(f'"{word}"' for word in words) + ("*" if prefix else "")
+
+    def is_selective(self, session: Session, word: str, prefix: bool) -> bool:
+        # Matches come off the index in rowid order, so the LIMIT stops the count
+        count = session.execute(text(
+            "SELECT count(*) FROM (SELECT 1 FROM question_search WHERE question_search MATCH :match LIMIT :limit)"
+        ), {"match": self.match([word], prefix), "limit": settings.SEARCH_SCORED_MATCHES + 1}).scalar()
+        return count <= settings.SEARCH_SCORED_MATCHES
+
+    def question_ids(self, session: Session, words: list[str], prefix: bool, limit: int) -> list[int]:
+        last = len(words) - 1
+        selective = [i for i, word in enumerate(words) if self.is_selective(session, word, prefix and i == last)]
+        if not selective:
+            return self.voted_question_ids(session, words, prefix, limit)
+
+        # bm25() counts every match of each word it scores, so only the
+        # selective ones are scored; it is lower for better matches
+        return list(session.execute(text(
+            "SELECT hits.id FROM ("
+            "  SELECT rowid AS id, -bm25(question_search, 1.0, :tag_weight) AS relevance"
+            "  FROM question_search WHERE question_search MATCH :scored"
+            # The unary + keeps FTS5 from looking up each rowid of the list
+            "  AND +rowid IN (SELECT rowid FROM question_search WHERE question_search MATCH :match)"
+            "  ORDER BY relevance DESC LIMIT :candidates"
+            ") AS hits JOIN question ON question.id = hits.id "
+            "ORDER BY hits.relevance"
+            "  * (1 + :weight * max(question.vote_sum, 0) * 1.0 / (max(question.vote_sum, 0) + :half)) DESC,"
+            "  question.id DESC "
+            "LIMIT :limit"
+        ), {
+            "scored": self.match([words[i] for i in selective], prefix and selective[-1] == last),
+            "match": self.match(words, prefix),
+            "candidates": settings.SEARCH_CANDIDATES,
+            "tag_weight": TAG_WEIGHT,
+            "weight": settings.SEARCH_VOTE_WEIGHT,
+            "half": VOTE_HALF_BOOST,
+            "limit": limit,
+        }).scalars())
+
+    def voted_question_ids(self, session: Session, words: list[str], prefix: bool, limit: int) -> list[int]:
+        """Best of the most-voted matches of a query whose words are all common."""
+        # Walked questions aren't matched by the index, so their words are
+        # found here, as whole words (the last as a prefix for typeahead)
+        words = [fold(word) for word in words]
+        patterns = [
+            (word, re.compile(r"(?<![^\W_])" + re.escape(word) + ("" if prefix and i == len(words) - 1 else r"(?![^\W_])")))
+            for i, word in enumerate(words)
+        ]
+        # id -> (vote_sum, hits of each word, length in words)
+        candidates: dict[int, tuple[int, list[float], int]] = {}
+
+        def count(word: str, pattern: re.Pattern, value: str) -> int:
+            # Most walked texts don't have the word at all
+            return len(pattern.findall(value)) if word in value else 0
+
+        def add(rows):
+            for question_id, vote_sum, question_text, tags in rows:
+                if question_id in candidates:
+                    continue
+                question_text, tags = fold(question_text), fold(tags)
+                hits = []
+                for word, pattern in patterns:
+                    hits.append(count(word, pattern, question_text) + TAG_WEIGHT * count(word, pattern, tags))
+                    if not hits[-1]:
+                        break
+                else:
+                    candidates[question_id] = (vote_sum, hits, question_text.count(" ") + tags.count(" ") + 2)
+
+        # LIKE leaves out the texts without every word, cheaply but only
+        # ignoring ASCII case: texts that have a word only with diacritics or
+        # in non-ASCII capitals are left to the newest matches below
+        contains = "".join(
+            f" AND (content.c0 LIKE :like{i} OR content.c1 LIKE :like{i})" for i in range(len(words))
+        )
+        add(session.execute(text(
+            # FTS5 keeps the indexed columns in question_search_content (id,
+            # c0, c1), where they are cheaper to read than through question_search
+            "SELECT question.id, question.vote_sum, content.c0, content.c1 FROM ("
+            "  SELECT id, vote_sum FROM question ORDER BY vote_sum DESC, id DESC LIMIT :walk"
+            ") AS question JOIN question_search_content AS content ON content.id = question.id "
+            "WHERE 1" + contains + " LIMIT :candidates"
+        ), {
+            "walk": VOTE_WALK,
+            "candidates": settings.SEARCH_CANDIDATES,
+            # Words are letters and digits only, so have no LIKE wildcards
+            **{f"like{i}": f"%{word}%" for i, word in enumerate(words)},
+        }).all())
+        if len(candidates) < settings.SEARCH_CANDIDATES:
+            # Common words can still be rare among the most voted questions
+            add(session.execute(text(
+                "SELECT question.id, question.vote_sum, content.c0, content.c1 FROM ("
+                "  SELECT rowid AS id FROM question_search WHERE question_search MATCH :match"
+                "  ORDER BY rowid DESC LIMIT :missing"
+                ") AS hits JOIN question ON question.id = hits.id "
+                "JOIN question_search_content AS content ON content.id = hits.id"
+            ), {"match": self.match(words, prefix), "missing": settings.SEARCH_CANDIDATES - len(candidates)}).all())
+
+        if not candidates:
+            return []
+        average_length = sum(length for _, _, length in candidates.values()) / len(candidates)
+        scored = []
+        for question_id, (vote_sum, hits, length) in candidates.items():
+            # bm25() without the inverse document frequency, which common words barely have
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+            relevance = sum(hit * (BM25_K1 + 1) / (hit + norm) for hit in hits)
+            votes = max(vote_sum, 0)
+            scored.append((relevance * (1 + settings.SEARCH_VOTE_WEIGHT * votes / (votes + VOTE_HALF_BOOST)), question_id))
+        scored.sort(reverse=True)
+        return [question_id for _, question_id in scored[:limit]]
+
+    def tag_ids(self, session: Session, words: list[str], prefix: bool, limit: int) -> list[int]:
+        return list(session.execute(
+            text("SELECT rowid FROM tag_search WHERE tag_search MATCH :match ORDER BY rank LIMIT :limit"),
+            {"match": self.match(words, prefix), "limit": limit},
+        ).scalars())
+
+
+class PostgresBackend:
+    def create(self, conn: Connection) -> bool:
+        exists = conn.execute(text("SELECT to_regclass('question_search')")).scalar()
+        if exists:
+            return False
+        conn.execute(text(
+            "CREATE TABLE question_search ("
+            "  question_id INTEGER PRIMARY KEY REFERENCES question (id),"
+            "  document TSVECTOR NOT NULL)"
+        ))
+        conn.execute(text("CREATE INDEX ix_question_search_document ON question_search USING gin (document)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_tag_name_search ON tag USING gin (to_tsvector('simple', name))"))
+        return True
+
+    _DOCUMENT = "setweight(to_tsvector('simple', {text}), 'A') || setweight(to_tsvector('simple', {tags}), 'B')"
+
+    _FILL = (
+        "INSERT INTO question_search (question_id, document) "
+        "SELECT question.id, " + _DOCUMENT.format(text="question.text", tags="coalesce(string_agg(tag.name, ' '), '')") +
+        " FROM question "
+        "LEFT JOIN questiontaglink ON questiontaglink.question_id = question.id "
+        "LEFT JOIN tag ON tag.id = questiontaglink.tag_id "
+        "{where} GROUP BY question.id"
+    )
+
+    def rebuild(self, session: Session):
+        session.execute(text("DELETE FROM question_search"))
+        session.execute(text(self._FILL.format(where="")))
+
+    def index_range(self, session: Session, first_id: int, last_id: int):
+        session.execute(text(
+            self._FILL.format(where="WHERE question.id BETWEEN :first AND :last")
+            + " ON CONFLICT (question_id) DO UPDATE SET document = EXCLUDED.document"
+        ), {"first": first_id, "last": last_id})
+
+    def index_tags(self, session: Session, tags: list[tuple[int, str]]):
+        # Covered by the expression index on tag
+        pass
+
+    def index_question(self, session: Session, question_id: int, question_text: str, tags: list[str]):
+        session.execute(text(
+            "INSERT INTO question_search (question_id, document) "
+            "VALUES (:id, " + self._DOCUMENT.format(text=":text", tags=":tags") + ") "
+            "ON CONFLICT (question_id) DO UPDATE SET document = EXCLUDED.document"
+        ), {"id": question_id, "text": question_text, "tags": " ".join(tags)})
+
+    def index_tag(self, session: Session, tag_id: int, name: str):
+        # Covered by the expression index on tag
+        pass
+
+    @staticmethod
+    def match(words: list[str], prefix: bool) -> str:
+        return " & ".join(words) + (":*" if prefix else "")
+
+    def is_selective(self, session: Session, word: str, prefix: bool) -> bool:
+        count = session.execute(text(
+            "SELECT count(*) FROM ("
+            "  SELECT 1 FROM question_search WHERE document @@ to_tsquery('simple', :match) LIMIT :limit"
+            ") AS hits"
+        ), {"match": self.match([word], prefix), "limit": settings.SEARCH_SCORED_MATCHES + 1}).scalar()
+        return count <= settings.SEARCH_SCORED_MATCHES
+
+    def question_ids(self, session: Session, words: list[str], prefix: bool, limit: int) -> list[int]:
+        last = len(words) - 1
+        if any(self.is_selective(session, word, prefix and i == last) for i, word in enumerate(words)):
+            # The GIN index finds the few matches, which are all scored
+            order = "relevance DESC"
+        else:
+            # ts_rank() is only worked out for the rows kept, past the LIMIT
+            order = "question.vote_sum DESC, question.id DESC"
+        return list(session.execute(text(
+            "SELECT hits.id FROM ("
+            "  SELECT question.id, question.vote_sum, ts_rank(question_search.document, query) AS relevance"
+            "  FROM question_search JOIN question ON question.id = question_search.question_id,"
+            "  to_tsquery('simple', :match) AS query"
+            f"  WHERE question_search.document @@ query ORDER BY {order} LIMIT :candidates"
+            ") AS hits "
+            "ORDER BY hits.relevance * (1 + :weight * greatest(hits.vote_sum, 0)::float"
+            "  / (greatest(hits.vote_sum, 0) + :half)) DESC, hits.id DESC "
+            "LIMIT :limit"
+        ), {
+            "match": self.match(words, prefix),
+            "candidates": settings.SEARCH_CANDIDATES,
+            "weight": settings.SEARCH_VOTE_WEIGHT,
+            "half": VOTE_HALF_BOOST,
+            "limit": limit,
+        }).scalars())
+
+    def tag_ids(self, session: Session, words: list[str], prefix: bool, limit: int) -> list[int]:
+        return list(session.execute(text(
+            "SELECT id FROM tag WHERE to_tsvector('simple', name) @@ to_tsquery('simple', :match) "
+            "ORDER BY name LIMIT :limit"
+        ), {"match": self.match(words, prefix), "limit": limit}).scalars())
+
+
+BACKENDS = {"sqlite": Fts5Backend(), "postgresql": PostgresBackend()}
+
+
+def backend_for(bind) -> Fts5Backend | PostgresBackend:
+    return BACKENDS[bind.dialect.name]
+
+
+def create_search_index(conn: Connection) -> bool:
+    return backend_for(conn).create(conn)
+
+
+def rebuild(session: Session):
+    backend_for(session.get_bind()).rebuild(session)
+
+
+def index_question(session: Session, question_id: int):
+    """Reindex a question's text and tag names, without committing."""
+    question_text = session.exec(select(Question.text).where(Question.id == question_id)).one()
+    tags = session.exec(
+        select(Tag.name).join(QuestionTagLink, QuestionTagLink.tag_id == Tag.id)
+        .where(QuestionTagLink.question_id == question_id)
+    ).all()
+    backend_for(session.get_bind()).index_question(session, question_id, question_text, list(tags))
+
+
+def index_question_range(session: Session, first_id: int, last_id: int):
+    """Reindex the questions with ids first_id to last_id in one statement, e.g. after a bulk import, without committing."""
+    backend_for(session.get_bind()).index_range(session, first_id, last_id)
+
+
+def index_tag(session: Session, tag_id: int, name: str):
+    backend_for(session.get_bind()).index_tag(session, tag_id, name)
+
+
+def index_tags(session: Session, tags: list[tuple[int, str]]):
+    """Index many (id, name) tags at once, without committing."""
+    if tags:
+        backend_for(session.get_bind()).index_tags(session, tags)
+
+
+def search_question_ids(session: Session, query: str, limit: int = 20, prefix: bool = False) -> list[int]:
+    """Ids of the best matching questions, best first. `prefix` for typeahead."""
+    words = query_words(query)
+    if not words:
+        return []
+    prefix = prefix and len(words[-1]) >= MIN_PREFIX
+    return backend_for(session.get_bind()).question_ids(session, words, prefix, limit)
+
+
+def search_tags(session: Session, query: str, limit: int = 10, prefix: bool = True) -> list[Tag]:
+    words = query_words(query)
+    if not words:
+        return []
+    prefix = prefix and len(words[-1]) >= MIN_PREFIX
+    ids = backend_for(session.get_bind()).tag_ids(session, words, prefix, limit)
+    tags = {tag.id: tag for tag in session.exec(select(Tag).where(Tag.id.in_(ids))).all()}
+    return [tags[tag_id] for tag_id in ids if tag_id in tags]
+
+
+def main():
+    from app.db.database import engine
+
+    parser = argparse.ArgumentParser(description="Maintain the full-text search index.")
+    parser.add_argument("--rebuild", action="store_true", help="refill the index from the question and tag tables")
+    parser.add_argument("query", nargs="?", help="print the best matches for a query")
+    args = parser.parse_args()
+
+    with engine.begin() as conn:
+        create_search_index(conn)
+    with Session(engine) as session:
+        if args.rebuild:
+            rebuild(session)
+            session.commit()
+            print("Search index rebuilt")
+        if args.query:
+            for tag in search_tags(session, args.query):
+                print(f"tag {tag.id}: {tag.name}")
+            ids = search_question_ids(session, args.query)
+            texts = dict(session.exec(select(Question.id, Question.text).where(Question.id.in_(ids))).all())
+            for question_id in ids:
+                print(f"question {question_id}: {texts[question_id]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+In-memory prefix index of tag names for the tag input's typeahead.
+
+Every tag is filed under its normalized name and under each later word of it
+("machine learning" also under "learning") in one sorted array, so the tags
+starting with a prefix are a contiguous slice found by bisection. Matches are
+ordered by how many questions use the tag. Suggestions never touch the
+database: the index is loaded at startup, updated in place when this worker
+creates or attaches a tag, and reloaded every TAG_INDEX_REFRESH_SECONDS in a
+background thread to pick up other workers' tags and exact usage counts.
+Suggestions for one or two letters, which match a large share of the tags,
+are cached until the index next changes.
+"""
+import bisect
+import heapq
+import logging
+import re
+import threading
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from sqlalchemy import Engine, func
+from sqlmodel import Session, select
+
+from app.metrics import registry
+from app.models import QuestionTagLink, Tag
+from app.models.tag import normalize_tag_name
+
+logger = logging.getLogger(__name__)
+
+# Suggestions for prefixes shorter than this are cached, since they match a
+# large share of all tags. There are only as many as distinct short prefixes
+CACHED_PREFIX_LENGTH = 3
+
+# Where a later word of a tag name starts
+_WORD_START = re.compile(r"(?<=[\s\-_./+])\w")
+
+
+@dataclass
+class IndexedTag:
+    id: int
+    name: str
+    uses: int
+    normalized_name: str = ""
+
+    def __post_init__(self):
+        self.normalized_name = self.normalized_name or normalize_tag_name(self.name)
+
+
+def _keys(normalized_name: str) -> set[str]:
+    return {normalized_name, *(normalized_name[m.start():] for m in _WORD_START.finditer(normalized_name))}
+
+
+class TagIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Sorted (key, tag id) pairs. Replaced, never mutated, so readers can
+        # keep bisecting a list they got
+        self._entries: list[tuple[str, int]] = []
+        self._tags: dict[int, IndexedTag] = {}
+        # Tags added while a reload was reading the database, kept by the reload
+        self._added_during_load: Optional[dict[int, IndexedTag]] = None
+        self._short_prefixes: dict[tuple[str, int], list[IndexedTag]] = {}
+
+    def __len__(self):
+        return len(self._tags)
+
+    def load(self, rows: Iterable[tuple[int, str, int]]):
+        """Replace the index with (id, name, uses) rows."""
+        tags = {tag_id: IndexedTag(tag_id, name, uses) for tag_id, name, uses in rows}
+        with self._lock:
+            if self._added_during_load:
+                tags.update({tag_id: tag for tag_id, tag in self._added_during_load.items() if tag_id not in tags})
+            self._added_during_load = None
+            self._tags = tags
+            self._entries = sorted((key, tag.id) for tag in tags.values() for key in _keys(tag.normalized_name))
+            self._short_prefixes = {}
+
+    def reload(self, session: Session):
+        with self._lock:
+            self._added_during_load = {}
+        try:
+            # Counting the links on their own is several times faster than
+            # joining them to the tags: they have no index by tag
+            uses = dict(session.exec(
+                select(QuestionTagLink.tag_id, func.count()).group_by(QuestionTagLink.tag_id)
+            ).all())
+            rows = [(tag_id, name, uses.get(tag_id, 0)) for tag_id, name in session.exec(select(Tag.id, Tag.name)).all()]
+        except Exception:
+            with self._lock:
+                self._added_during_load = None
+            raise
+        self.load(rows)
+
+    def add(self, tag_id: int, name: str, uses: int = 1):
+        """File a tag this worker just created."""
+        tag = IndexedTag(tag_id, name, uses)
+        with self._lock:
+            if tag_id in self._tags:
+                return
+            self._tags[tag_id] = tag
+            entries = list(self._entries)
+            for key in _keys(tag.normalized_name):
+                bisect.insort(entries, (key, tag_id))
+            self._entries = entries
+            self._short_prefixes = {}
+            if self._added_during_load is not None:
+                self._added_during_load[tag_id] = tag
+
+    def used(self, tag_id: int, delta: int = 1):
+        """Count a question newly tagged (or untagged, with a negative delta)."""
+        tag = self._tags.get(tag_id)
+        if tag is not None:
+            tag.uses += delta
+
+    def suggest(self, prefix: str, limit: int = 10) -> list[IndexedTag]:
+        """Tags with a word starting with `prefix`; exact matches first, then most used."""
+        prefix = normalize_tag_name(prefix)
+        if not prefix:
+            return []
+        if len(prefix) < CACHED_PREFIX_LENGTH:
+            cache = self._short_prefixes
+            if (prefix, limit) not in cache:
+                cache[(prefix, limit)] = self._suggest(prefix, limit)
+            return cache[(prefix, limit)]
+        return self._suggest(prefix, limit)
+
+    def _suggest(self, prefix: str, limit: int) -> list[IndexedTag]:
+        entries, tags = self._entries, self._tags
+        start = bisect.bisect_left(entries, (prefix,))
+        end = bisect.bisect_left(entries, (prefix + "\U0010ffff",), start)
+        # A tag can be filed under several of the matching keys
+        matches = {tag_id: tags[tag_id] for _, tag_id in entries[start:end] if tag_id in tags}
+        return heapq.nsmallest(
+            limit, matches.values(), key=lambda tag: (tag.normalized_name != prefix, -tag.uses, len(tag.name), tag.id)
+        )
+
+
+tag_index = TagIndex()
+
+registry.callback_gauge("tag_index_tags", "Tags in the typeahead index.", lambda: len(tag_index))
+
+
+class TagIndexRefresher:
+    def __init__(self, engine: Engine, interval_seconds: float):
+        self.engine = engine
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="tag-index", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            try:
+                with Session(self.engine) as session:
+                    tag_index.reload(session)
+            except Exception:
+                logger.exception("Reloading the tag index failed, keeping the old one")
+
+
+refresher: Optional[TagIndexRefresher] = None
+
+
+def start_tag_index(engine: Engine, refresh_seconds: float):
+    """Load the index now and keep reloading it every `refresh_seconds` (0: never)."""
+    global refresher
+    with Session(engine) as session:
+        tag_index.reload(session)
+    if refresh_seconds > 0:
+        refresher = TagIndexRefresher(engine, refresh_seconds)
+        refresher.start()
+
+
+def stop_tag_index():
+    global refresher
+    if refresher:
+        refresher.stop()
+        refresher = None
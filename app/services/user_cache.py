@@ -0,0 +1,96 @@
+"""
+Verified access token -> current user snapshot.
+
+Nearly every page resolves the current user, which meant a JWT decode and a
+user query per request. Tokens that decoded and matched a user are cached as
+UserPublic snapshots for USER_CACHE_TTL_SECONDS (never past the token's own
+expiry), least recently used first out once USER_CACHE_SIZE is reached.
+Call invalidate_token on logout and invalidate_user after changing a user.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app import settings
+from app.metrics import registry
+from app.models.user import User, UserPublic
+
+
+class UserCache:
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 30):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+        # Never held across I/O, see the note in Leaderboard.get
+        self._lock = threading.Lock()
+        # token -> (expires_at, snapshot), oldest use first
+        self._entries: OrderedDict[str, tuple[float, UserPublic]] = OrderedDict()
+        # user id -> tokens cached for that user
+        self._tokens_by_user: dict[int, set[str]] = {}
+
+    def get(self, token: str) -> Optional[UserPublic]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, user = entry
+            if time.monotonic() >= expires_at:
+                self._remove(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return user
+
+    def put(self, token: str, user: User | UserPublic, token_expires_at: Optional[float] = None) -> UserPublic:
+        """Cache a snapshot of `user` for `token`; token_expires_at is the JWT `exp` (unix time)."""
+        snapshot = UserPublic(id=user.id, email=user.email, username=user.username)
+        expires_at = time.monotonic() + self.ttl_seconds
+        if token_expires_at is not None:
+            expires_at = min(expires_at, time.monotonic() + token_expires_at - time.time())
+        with self._lock:
+            self._remove(token)
+            self._entries[token] = (expires_at, snapshot)
+            self._tokens_by_user.setdefault(snapshot.id, set()).add(token)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+        return snapshot
+
+    def invalidate_token(self, token: str):
+        with self._lock:
+            self._remove(token)
+
+    def invalidate_user(self, user_id: int):
+        """Drop every cached token of a user, e.g. after their username or email changed."""
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def _remove(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        tokens = self._tokens_by_user.get(entry[1].id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[entry[1].id]
+
+
+user_cache = UserCache(max_size=settings.USER_CACHE_SIZE, ttl_seconds=settings.USER_CACHE_TTL_SECONDS)
+
+registry.callback_counter("user_cache_hits_total", "Current user lookups served from the cache.", lambda: user_cache.hits)
+registry.callback_counter("user_cache_misses_total", "Current user lookups that decoded the token.", lambda: user_cache.misses)
+
+
+def invalidate_user(user_id: int):
+    user_cache.invalidate_user(user_id)
@@ -0,0 +1,245 @@
+"""
+Opt-in write-behind mode for votes (VOTE_WRITE_BEHIND=1).
+
+Clicks are resolved against an in-process buffer keyed by (user, question, tag),
+so repeated toggles by the same user collapse into one pending row. A background
+thread writes the buffer to QuestionVote/QuestionTagVote in a single transaction
+every VOTE_FLUSH_INTERVAL_MS, or sooner once VOTE_FLUSH_MAX_ENTRIES are pending.
+Responses carry the optimistic total: the stored counter plus pending deltas.
+
+A flush swaps the pending entries out and writes them without holding the
+buffer's lock, so clicks carry on meanwhile; only the COMMIT itself holds it.
+A batch that fails is merged back and retried with the next one; after
+MAX_FLUSH_FAILURES failures in a row its votes are dropped and counted in
+vote_buffer_dropped_total, so an unwritable database can't grow the buffer
+without bound.
+
+Votes still pending when the process is killed without a shutdown are lost.
+"""
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import Engine
+from sqlmodel import Session, select
+
+from app.metrics import vote_buffer_dropped, vote_flush_duration
+from app.models import Question, QuestionTagLink, QuestionTagVote, QuestionVote
+from app.services import votes
+from app.services.votes import VoteResult
+from app.utils.user_voted import Vote
+
+logger = logging.getLogger(__name__)
+
+MAX_FLUSH_FAILURES = 5
+
+
+@dataclass
+class PendingVote:
+    baseline: int  # stored vote when the entry was created
+    value: int  # vote to store on the next flush
+
+
+class VoteBuffer:
+    def __init__(self, engine: Engine, flush_interval_ms: int = 200, max_entries: int = 500):
+        self.engine = engine
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_entries = max_entries
+        self.flushed_batches = 0
+        self.flushed_votes = 0
+
+        # Guards the dicts below. Flushes hold it to swap out a batch and
+        # around their COMMIT, so clicks never see a half-committed batch.
+        self._lock = threading.Lock()
+        # One flush at a time: the flush thread, or stop() after it
+        self._flush_lock = threading.Lock()
+        self._failures = 0
+        # Bumped by every commit; clicks that read stored state across one retry
+        self._generation = 0
+        # (question_id, tag_id | None, user_id) -> PendingVote
+        self._pending: dict[tuple[int, Optional[int], int], PendingVote] = {}
+        # The batch a running flush is writing, same keys
+        self._flushing: dict[tuple[int, Optional[int], int], PendingVote] = {}
+        # (question_id, tag_id | None) -> sum of value changes pending or being written
+        self._deltas: dict[tuple[int, Optional[int]], int] = {}
+        # (question_id, tag_id | None) -> stored counter, valid until the next flush
+        self._stored_sums: dict[tuple[int, Optional[int]], int] = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def cast_question_vote(self, session: Session, user_id: int, question_id: int, vote_value: int) -> VoteResult | None:
+        return self._cast(session, user_id, question_id, None, vote_value)
+
+    def cast_question_tag_vote(
+        self, session: Session, user_id: int, question_id: int, tag_id: int, vote_value: int
+    ) -> VoteResult | None:
+        return self._cast(session, user_id, question_id, tag_id, vote_value)
+
+    def _cast(self, session: Session, user_id: int, question_id: int, tag_id: Optional[int], vote_value: int) -> VoteResult | None:
+        target = (question_id, tag_id)
+        key = (question_id, tag_id, user_id)
+        while True:
+            # Stored state is read without holding the lock: under
+            # AsyncSession.run_sync another coroutine on the same thread
+            # could otherwise block on it. A flush in between bumps the
+            # generation and the click is resolved again.
+            with self._lock:
+                generation = self._generation
+                stored_sum = self._stored_sums.get(target)
+                entry = self._pending.get(key) or self._flushing.get(key)
+
+            if stored_sum is None:
+                stored_sum = self._stored_sum(session, question_id, tag_id)
+                if stored_sum is None:
+                    session.rollback()
+                    return None
+            stored_vote = self._stored_vote(session, user_id, question_id, tag_id) if entry is None else None
+
+            with self._lock:
+                if self._generation != generation:
+                    continue
+                stored_sum = self._stored_sums.setdefault(target, stored_sum)
+                entry = self._pending.get(key)
+                if entry is None:
+                    # A vote in the batch being written counts as stored
+                    writing = self._flushing.get(key)
+                    if writing is not None:
+                        stored_vote = writing.value
+                    entry = self._pending[key] = PendingVote(baseline=stored_vote, value=stored_vote)
+
+                new_value = votes.toggle(entry.value, vote_value)
+                self._deltas[target] = self._deltas.get(target, 0) + new_value - entry.value
+                entry.value = new_value
+                vote_sum = stored_sum + self._deltas[target]
+
+                if len(self._pending) >= self.max_entries:
+                    self._wake.set()
+                break
+
+        # Don't hold the read transaction open until the next flush
+        session.rollback()
+        return VoteResult(vote_sum=vote_sum, voted=Vote(new_value))
+
+    def _stored_sum(self, session: Session, question_id: int, tag_id: Optional[int]) -> int | None:
+        if tag_id is None:
+            return session.exec(select(Question.vote_sum).where(Question.id == question_id)).first()
+        return session.exec(
+            select(QuestionTagLink.vote_sum)
+            .where(QuestionTagLink.question_id == question_id, QuestionTagLink.tag_id == tag_id)
+        ).first()
+
+    def _stored_vote(self, session: Session, user_id: int, question_id: int, tag_id: Optional[int]) -> int:
+        if tag_id is None:
+            statement = select(QuestionVote.vote_value).where(
+                QuestionVote.user_id == user_id, QuestionVote.question_id == question_id
+            )
+        else:
+            statement = select(QuestionTagVote.vote_value).where(
+                QuestionTagVote.user_id == user_id,
+                QuestionTagVote.question_id == question_id,
+                QuestionTagVote.tag_id == tag_id,
+            )
+        return session.exec(statement).first() or 0
+
+    def flush(self) -> int:
+        """Write all pending votes in one transaction. Returns the number of rows written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._flushing = batch
+            changed = {key: entry for key, entry in batch.items() if entry.value != entry.baseline}
+            try:
+                if changed:
+                    with vote_flush_duration.time(), Session(self.engine) as session:
+                        for (question_id, tag_id, user_id), entry in changed.items():
+                            if tag_id is None:
+                                votes.set_question_vote(session, user_id, question_id, entry.value)
+                            else:
+                                votes.set_question_tag_vote(session, user_id, question_id, tag_id, entry.value)
+                        # Clicks reading the counters must not see the commit
+                        # land between their read and their update of the deltas
+                        with self._lock:
+                            session.commit()
+                            self._committed()
+                else:
+                    with self._lock:
+                        self._committed()
+            except Exception:
+                with self._lock:
+                    self._failed(batch)
+                raise
+            self._failures = 0
+            self.flushed_batches += bool(changed)
+            self.flushed_votes += len(changed)
+            return len(changed)
+
+    def _committed(self):
+        # The stored counters now include the batch: re-read them, and keep
+        # only the deltas of clicks that came in while it was written
+        self._flushing = {}
+        self._generation += 1
+        self._stored_sums.clear()
+        self._deltas.clear()
+        for (question_id, tag_id, _), entry in self._pending.items():
+            target = (question_id, tag_id)
+            self._deltas[target] = self._deltas.get(target, 0) + entry.value - entry.baseline
+
+    def _failed(self, batch: dict):
+        self._flushing = {}
+        self._failures += 1
+        give_up = self._failures >= MAX_FLUSH_FAILURES
+        dropped = 0
+        for key, entry in batch.items():
+            newer = self._pending.get(key)
+            if newer is not None:
+                # Clicked again meanwhile, on top of a value that was never stored
+                newer.baseline = entry.baseline
+            elif not give_up:
+                self._pending[key] = entry
+            else:
+                dropped += entry.value != entry.baseline
+        if give_up:
+            logger.error("Dropping %d buffered votes after %d failed flushes", dropped, self._failures)
+            vote_buffer_dropped.inc(amount=dropped)
+            self._failures = 0
+            self._committed()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing buffered votes failed, retrying on the next interval")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="vote-buffer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flush thread and write whatever is still pending."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+
+vote_buffer: Optional[VoteBuffer] = None
+
+
+def start_vote_buffer(engine: Engine, flush_interval_ms: int, max_entries: int) -> VoteBuffer:
+    global vote_buffer
+    vote_buffer = VoteBuffer(engine, flush_interval_ms, max_entries)
+    vote_buffer.start()
+    return vote_buffer
+
+
+def stop_vote_buffer():
+    global vote_buffer
+    if vote_buffer:
+        vote_buffer.stop()
+        vote_buffer = None
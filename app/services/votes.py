@@ -0,0 +1,163 @@
+"""
+Vote toggling for questions and question-tag pairs.
+
+A click is resolved in one short write transaction that relies on the unique
+vote indexes: the user's previous vote is deleted with RETURNING, the new vote
+(if any) is inserted and the denormalized counter is bumped with RETURNING, so
+the new total and vote state come back without re-reading the vote tables.
+The question's revision is bumped in the same transaction (app/db/revisions.py).
+The same update moves the vote counts and hot score, and the counts it returns
+give the Wilson and controversy scores (app/services/rankings.py).
+
+Clicking the same direction again removes the vote, clicking the other
+direction flips it.
+"""
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import delete, insert, update
+from sqlmodel import Session
+
+from app.db.revisions import bump_question, next_revision
+from app.models import Question, QuestionTagLink, QuestionTagVote, QuestionVote
+from app.services import rankings
+from app.utils.user_voted import Vote
+
+
+@dataclass
+class VoteResult:
+    vote_sum: int
+    voted: Vote
+
+
+def toggle(previous: int, vote_value: int) -> int:
+    return 0 if previous == vote_value else vote_value
+
+
+def _update_counters(session: Session, model, where: tuple, previous: int, previous_at, new_value: int, voted_at: datetime, **values):
+    """
+    Move the row's vote_sum, counts and hot score from the previous vote to
+    the new one. Returns (vote_sum, up_count, down_count), or None if there is no such row.
+    """
+    while True:
+        epoch = rankings.known_epoch(session)
+        row = session.execute(
+            update(model.__table__)
+            .where(*where, rankings.epoch_is(epoch))
+            .values(
+                vote_sum=model.vote_sum + new_value - previous,
+                **rankings.vote_changes(model, previous, previous_at, new_value, voted_at, epoch),
+                **values,
+            )
+            .returning(model.vote_sum, model.up_count, model.down_count)
+        ).first()
+        # No row, or the hot scores were rebased since this process last looked
+        if row is not None or not rankings.epoch_moved(session):
+            return row
+
+
+def _write_question_vote(session: Session, user_id: int, question_id: int, resolve) -> VoteResult | None:
+    previous, previous_at = session.execute(
+        delete(QuestionVote)
+        .where(QuestionVote.user_id == user_id, QuestionVote.question_id == question_id)
+        .returning(QuestionVote.vote_value, QuestionVote.created_at)
+    ).first() or (0, None)
+    new_value = resolve(previous)
+    voted_at = datetime.utcnow()
+
+    row = _update_counters(
+        session, Question, (Question.id == question_id,), previous, previous_at, new_value, voted_at,
+        revision=next_revision(),
+    )
+    if row is None:
+        return None
+    vote_sum, ups, downs = row
+    # Core, not ORM: it's a third statement on the hottest write path
+    session.execute(update(Question.__table__).where(Question.id == question_id).values(**rankings.derived_scores(ups, downs)))
+
+    if new_value:
+        session.execute(insert(QuestionVote).values(
+            user_id=user_id,
+            question_id=question_id,
+            vote_value=new_value,
+            created_at=voted_at,
+        ))
+    return VoteResult(vote_sum=vote_sum, voted=Vote(new_value))
+
+
+def _write_question_tag_vote(session: Session, user_id: int, question_id: int, tag_id: int, resolve) -> VoteResult | None:
+    previous, previous_at = session.execute(
+        delete(QuestionTagVote)
+        .where(
+            QuestionTagVote.user_id == user_id,
+            QuestionTagVote.question_id == question_id,
+            QuestionTagVote.tag_id == tag_id,
+        )
+        .returning(QuestionTagVote.vote_value, QuestionTagVote.created_at)
+    ).first() or (0, None)
+    new_value = resolve(previous)
+    voted_at = datetime.utcnow()
+
+    link = (QuestionTagLink.question_id == question_id, QuestionTagLink.tag_id == tag_id)
+    row = _update_counters(session, QuestionTagLink, link, previous, previous_at, new_value, voted_at)
+    if row is None:
+        return None
+    vote_sum, ups, downs = row
+    session.execute(update(QuestionTagLink.__table__).where(*link).values(**rankings.derived_scores(ups, downs)))
+    bump_question(session, question_id)
+
+    if new_value:
+        session.execute(insert(QuestionTagVote).values(
+            user_id=user_id,
+            question_id=question_id,
+            tag_id=tag_id,
+            vote_value=new_value,
+            created_at=voted_at,
+        ))
+    return VoteResult(vote_sum=vote_sum, voted=Vote(new_value))
+
+
+def apply_question_vote(session: Session, user_id: int, question_id: int, vote_value: int) -> VoteResult | None:
+    """Apply a vote click without committing. Returns None if the question doesn't exist."""
+    return _write_question_vote(session, user_id, question_id, lambda previous: toggle(previous, vote_value))
+
+
+def apply_question_tag_vote(
+    session: Session, user_id: int, question_id: int, tag_id: int, vote_value: int
+) -> VoteResult | None:
+    """Apply a vote click without committing. Returns None if the tag isn't on the question."""
+    return _write_question_tag_vote(
+        session, user_id, question_id, tag_id, lambda previous: toggle(previous, vote_value)
+    )
+
+
+def set_question_vote(session: Session, user_id: int, question_id: int, vote_value: int) -> VoteResult | None:
+    """Store vote_value (0 removes the vote) without committing, whatever the previous vote was."""
+    return _write_question_vote(session, user_id, question_id, lambda previous: vote_value)
+
+
+def set_question_tag_vote(
+    session: Session, user_id: int, question_id: int, tag_id: int, vote_value: int
+) -> VoteResult | None:
+    """Store vote_value (0 removes the vote) without committing, whatever the previous vote was."""
+    return _write_question_tag_vote(session, user_id, question_id, tag_id, lambda previous: vote_value)
+
+
+def cast_question_vote(session: Session, user_id: int, question_id: int, vote_value: int) -> VoteResult | None:
+    result = apply_question_vote(session, user_id, question_id, vote_value)
+    if result is None:
+        session.rollback()
+        return None
+    session.commit()
+    return result
+
+
+def cast_question_tag_vote(
+    session: Session, user_id: int, question_id: int, tag_id: int, vote_value: int
+) -> VoteResult | None:
+    result = apply_question_tag_vote(session, user_id, question_id, tag_id, vote_value)
+    if result is None:
+        session.rollback()
+        return None
+    session.commit()
+    return result
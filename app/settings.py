@@ -0,0 +1,154 @@
+"""
+Runtime settings, read once from the environment at import time.
+"""
+import os
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Buffer votes in memory and write them in batches instead of one
+# transaction per click (see app/services/vote_buffer.py)
+VOTE_WRITE_BEHIND = env_bool("VOTE_WRITE_BEHIND")
+VOTE_FLUSH_INTERVAL_MS = int(os.getenv("VOTE_FLUSH_INTERVAL_MS", "200"))
+VOTE_FLUSH_MAX_ENTRIES = int(os.getenv("VOTE_FLUSH_MAX_ENTRIES", "500"))
+
+# How long the cached front page leaderboard may lag behind votes cast on
+# other workers; votes on this worker update it immediately
+LEADERBOARD_TTL_SECONDS = float(os.getenv("LEADERBOARD_TTL_SECONDS", "5"))
+
+# Sync URL of the primary database; the async engine derives its driver from
+# it (aiosqlite for SQLite, asyncpg for Postgres)
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///database.db")
+
+# bcrypt work factor for new hashes; stored hashes with fewer rounds are
+# rehashed the next time their user logs in
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Threads hashing passwords, and how many requests may wait for one before
+# logins are answered with 503 (see app/services/passwords.py)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+
+# Verified access tokens remembered with a snapshot of their user, so most
+# requests skip the JWT decode and the user query (app/services/user_cache.py)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "30"))
+
+# Connection tuning, see app/db/profiles.py. "production" enables WAL and the
+# pragmas below on SQLite; "default" keeps SQLite's stock settings
+DATABASE_PROFILE = os.getenv("DATABASE_PROFILE", "production")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_SIZE_KIB = int(os.getenv("DB_CACHE_SIZE_KIB", str(64 * 1024)))
+# Read pool size; SQLite writes go through a single connection regardless
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# Comma-separated sync URLs of read replicas for GET routes (app/db/replicas.py).
+# DATABASE_READ_POLICY is round_robin or random; a failing replica is skipped
+# for REPLICA_RETRY_SECONDS; clients that just wrote read from the primary for
+# REPLICA_STICKY_SECONDS
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+DATABASE_READ_POLICY = os.getenv("DATABASE_READ_POLICY", "round_robin")
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", "10"))
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+# Query instrumentation (app/db/instrumentation.py): statements slower than
+# SLOW_QUERY_MS are logged, a SLOW_QUERY_SAMPLE_RATE fraction of them.
+# QUERY_COUNT_HEADER adds X-Query-Count/X-Query-Time-Ms to responses (dev),
+# and logs the counts of streamed pages, which come too late for a header;
+# SQL_ECHO logs every statement again
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_SAMPLE_RATE = float(os.getenv("SLOW_QUERY_SAMPLE_RATE", "1.0"))
+QUERY_COUNT_HEADER = env_bool("QUERY_COUNT_HEADER")
+SQL_ECHO = env_bool("SQL_ECHO")
+
+# Templates (app/templating.py): compiled templates are cached on disk in
+# TEMPLATE_CACHE_DIR so worker starts skip compiling; TEMPLATE_AUTO_RELOAD
+# re-checks template files for changes on every render and ETag (for editing
+# templates; off by default, templates are read once per worker). Up to FRAGMENT_CACHE_SIZE rendered question/tag items are kept
+# in memory, 0 disables the fragment cache
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", ".jinja_cache")
+TEMPLATE_AUTO_RELOAD = env_bool("TEMPLATE_AUTO_RELOAD")
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", "5000"))
+
+# Stream the front page and question lists while they render instead of
+# building the whole page first (app/utils/streaming.py). Output is sent in
+# STREAM_CHUNK_SIZE character pieces; rows are fetched STREAM_FETCH_SIZE at a time
+STREAM_HTML = env_bool("STREAM_HTML", True)
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "8192"))
+STREAM_FETCH_SIZE = int(os.getenv("STREAM_FETCH_SIZE", "20"))
+
+# Conditional GET (app/utils/http_cache.py): pages for anonymous visitors may
+# be served by caches for HTTP_CACHE_MAX_AGE seconds and HTTP_CACHE_STALE_SECONDS
+# more while they revalidate; pages for logged-in users always revalidate
+HTTP_CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", "5"))
+HTTP_CACHE_STALE_SECONDS = int(os.getenv("HTTP_CACHE_STALE_SECONDS", "30"))
+
+# Full-text search (app/services/search.py): SEARCH_CANDIDATES matches are
+# ranked again with a boost of up to SEARCH_VOTE_WEIGHT for popular questions.
+# They are the most relevant matches if a word of the query is in at most
+# SEARCH_SCORED_MATCHES questions, otherwise the most voted. The search page
+# shows SEARCH_RESULTS questions and the typeahead SEARCH_SUGGESTIONS
+# questions and tags
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "200"))
+SEARCH_SCORED_MATCHES = int(os.getenv("SEARCH_SCORED_MATCHES", "1000"))
+SEARCH_VOTE_WEIGHT = float(os.getenv("SEARCH_VOTE_WEIGHT", "1.0"))
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", "20"))
+SEARCH_SUGGESTIONS = int(os.getenv("SEARCH_SUGGESTIONS", "5"))
+
+# Tag typeahead (app/services/tag_index.py): tag names are held in memory and
+# reloaded from the database every TAG_INDEX_REFRESH_SECONDS (0: only at
+# startup); the tag input suggests up to TAG_SUGGESTIONS of them
+TAG_INDEX_REFRESH_SECONDS = float(os.getenv("TAG_INDEX_REFRESH_SECONDS", "60"))
+TAG_SUGGESTIONS = int(os.getenv("TAG_SUGGESTIONS", "8"))
+
+# Related questions (app/services/related.py): each question page lists up to
+# RELATED_QUESTIONS questions with similar tags. A job catches up with tag
+# changes and recomputes everything every RELATED_REBUILD_SECONDS; it runs as
+# `python -m app.services.related --watch SECONDS`, or in the web worker every
+# RELATED_REFRESH_SECONDS (0, the default, leaves it to that process; only set
+# it with a single worker). Tags on more than RELATED_MAX_POSTINGS questions
+# only link their heaviest ones
+RELATED_QUESTIONS = int(os.getenv("RELATED_QUESTIONS", "5"))
+RELATED_REFRESH_SECONDS = float(os.getenv("RELATED_REFRESH_SECONDS", "0"))
+RELATED_REBUILD_SECONDS = float(os.getenv("RELATED_REBUILD_SECONDS", "3600"))
+RELATED_MAX_POSTINGS = int(os.getenv("RELATED_MAX_POSTINGS", "100"))
+
+# Live vote totals over Server-Sent Events (app/services/live.py): totals are
+# pushed at most every LIVE_PUSH_INTERVAL_MS per question, to up to
+# LIVE_MAX_SUBSCRIBERS open pages per worker. Idle streams get a keepalive
+# every LIVE_KEEPALIVE_SECONDS and are closed (and reopened by the browser)
+# after LIVE_MAX_CONNECTION_SECONDS
+LIVE_UPDATES = env_bool("LIVE_UPDATES", True)
+LIVE_PUSH_INTERVAL_MS = int(os.getenv("LIVE_PUSH_INTERVAL_MS", "500"))
+LIVE_MAX_SUBSCRIBERS = int(os.getenv("LIVE_MAX_SUBSCRIBERS", "10000"))
+LIVE_KEEPALIVE_SECONDS = float(os.getenv("LIVE_KEEPALIVE_SECONDS", "15"))
+LIVE_MAX_CONNECTION_SECONDS = float(os.getenv("LIVE_MAX_CONNECTION_SECONDS", "300"))
+
+# Rankings (app/services/rankings.py): a vote counts half as much in the hot
+# scores every RANKING_HOT_HALF_LIFE_HOURS (run `python -m app.services.rankings`
+# after changing it); every RANKING_REBASE_SECONDS (0 disables it) a worker
+# checks whether the stored hot scores need scaling down
+RANKING_HOT_HALF_LIFE_HOURS = float(os.getenv("RANKING_HOT_HALF_LIFE_HOURS", "24"))
+RANKING_REBASE_SECONDS = float(os.getenv("RANKING_REBASE_SECONDS", "3600"))
+
+# Bulk import and export (app/services/bulk.py): the /admin routes are open to
+# the comma-separated ADMIN_USERNAMES (none by default); imports write
+# IMPORT_BATCH questions or votes per transaction
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "5000"))
+
+# Traffic capture (app/traffic.py): with TRAFFIC_CAPTURE_PATH set, sanitized
+# request traces are appended to that file for benchmarks/replay.py, until it
+# reaches TRAFFIC_CAPTURE_MAX_MB. Free text is replaced by a keyed hash under
+# TRAFFIC_CAPTURE_KEY, random per process unless set; give all workers the
+# same key so the same user or text gets the same hash in every trace
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH", "")
+TRAFFIC_CAPTURE_MAX_MB = float(os.getenv("TRAFFIC_CAPTURE_MAX_MB", "1024"))
+TRAFFIC_CAPTURE_KEY = os.getenv("TRAFFIC_CAPTURE_KEY") or os.urandom(32).hex()
@@ -0,0 +1,205 @@
+"""
+The Jinja2 environment shared by all routers.
+
+Templates are compiled into TimedTemplate, which records how long each one
+takes to render in the template_render_seconds metric. Times are inclusive:
+a page's time contains the layout it extends and the fragments it includes,
+which are also recorded under their own names.
+
+Compiled templates are kept in a bytecode cache on disk and all templates are
+compiled at startup (precompile_templates), so the first requests of a new
+worker don't pay for it. `{% cache key, ... %}...{% endcache %}` blocks are
+rendered once per key and served from the in-memory fragment_cache after that;
+the key must cover everything the block displays.
+
+template_version() is a digest of the template files, taken once per worker
+(on every call with TEMPLATE_AUTO_RELOAD); it is part of every ETag
+(app/utils/http_cache.py), so new templates aren't answered with 304s.
+
+`stream_templates` renders the same templates asynchronously, for streamed
+responses (app/utils/streaming.py). There `{{ stream_flush() }}` sends
+everything rendered so far to the client; in normal rendering it outputs
+nothing.
+"""
+import hashlib
+import inspect
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from app import settings
+from app.metrics import registry, template_render_duration
+
+
+class TimedTemplate(Template):
+    @classmethod
+    def _from_namespace(cls, environment, namespace, globals):
+        # Every way of rendering, including {% include %} and {% extends %},
+        # goes through root_render_func, so that is what gets wrapped
+        template = super()._from_namespace(environment, namespace, globals)
+        template.root_render_func = _timed(template.name, template.root_render_func)
+        return template
+
+
+def _timed(name, render_func):
+    if inspect.isasyncgenfunction(render_func):
+        async def timed_async(context):
+            started = time.perf_counter()
+            try:
+                async for chunk in render_func(context):
+                    yield chunk
+            finally:
+                template_render_duration.observe(name, value=time.perf_counter() - started)
+        return timed_async
+
+    def timed(context):
+        started = time.perf_counter()
+        try:
+            yield from render_func(context)
+        finally:
+            template_render_duration.observe(name, value=time.perf_counter() - started)
+    return timed
+
+
+class FragmentCache:
+    """Rendered fragments by key, least recently used first out."""
+
+    def __init__(self, max_size: int = 5000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._fragments: OrderedDict[tuple, Markup] = OrderedDict()
+
+    def get(self, key: tuple) -> Markup | None:
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self._fragments.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+    def put(self, key: tuple, fragment: str):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._fragments[key] = Markup(fragment)
+            while len(self._fragments) > self.max_size:
+                self._fragments.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+
+
+fragment_cache = FragmentCache(settings.FRAGMENT_CACHE_SIZE)
+
+registry.callback_counter("fragment_cache_hits_total", "Template fragments served from the cache.", lambda: fragment_cache.hits)
+registry.callback_counter("fragment_cache_misses_total", "Template fragments rendered.", lambda: fragment_cache.misses)
+
+
+class FragmentCacheExtension(Extension):
+    """
+    `{% cache "name", key... %}body{% endcache %}`. The request's base URL is
+    added to the key because url_for renders absolute URLs.
+    """
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        method = "_cached_async" if self.environment.is_async else "_cached"
+        args = [nodes.Tuple(key, "load"), nodes.ContextReference()]
+        return nodes.CallBlock(self.call_method(method, args), [], [], body).set_lineno(lineno)
+
+    @staticmethod
+    def _full_key(key: tuple, context) -> tuple:
+        request = context.get("request")
+        return (str(request.base_url) if request is not None else None, *key)
+
+    def _cached(self, key, context, caller):
+        key = self._full_key(key, context)
+        fragment = fragment_cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            fragment_cache.put(key, fragment)
+        return fragment
+
+    async def _cached_async(self, key, context, caller):
+        key = self._full_key(key, context)
+        fragment = fragment_cache.get(key)
+        if fragment is None:
+            fragment = await caller()
+            fragment_cache.put(key, fragment)
+        return fragment
+
+
+# Never part of a response: the streaming response flushes and drops it
+FLUSH_MARKER = "<!--stream-flush-->"
+
+
+def create_environment(directory: str = "templates", **options) -> Environment:
+    bytecode_cache = None
+    if settings.TEMPLATE_CACHE_DIR:
+        # Async templates compile to different code under the same cache key
+        cache_dir = os.path.join(settings.TEMPLATE_CACHE_DIR, "async" if options.get("enable_async") else "sync")
+        os.makedirs(cache_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    environment = Environment(
+        loader=FileSystemLoader(directory),
+        autoescape=True,
+        bytecode_cache=bytecode_cache,
+        auto_reload=settings.TEMPLATE_AUTO_RELOAD,
+        extensions=[FragmentCacheExtension],
+        **options,
+    )
+    environment.template_class = TimedTemplate
+    flush = Markup(FLUSH_MARKER) if environment.is_async else Markup("")
+    environment.globals["stream_flush"] = lambda: flush
+    environment.globals["live_updates"] = settings.LIVE_UPDATES
+    return environment
+
+
+def precompile_templates(environment: Environment) -> int:
+    """Load every template into the environment's cache; returns how many there are."""
+    names = environment.list_templates()
+    for name in names:
+        environment.get_template(name)
+    return len(names)
+
+
+def _template_files_digest(loader: FileSystemLoader) -> str:
+    digest = hashlib.sha1()
+    for directory in loader.searchpath:
+        for root, _, files in sorted(os.walk(directory)):
+            for filename in sorted(files):
+                stat = os.stat(os.path.join(root, filename))
+                digest.update(f"{root}/{filename}:{stat.st_mtime_ns}:{stat.st_size};".encode())
+    return digest.hexdigest()[:12]
+
+
+_template_version = None
+
+
+def template_version() -> str:
+    """Short digest of the template files' names, sizes and modification times."""
+    global _template_version
+    # With auto reload templates can change under a running worker
+    if _template_version is None or settings.TEMPLATE_AUTO_RELOAD:
+        _template_version = _template_files_digest(templates.env.loader)
+    return _template_version
+
+
+templates = Jinja2Templates(env=create_environment())
+stream_templates = Jinja2Templates(env=create_environment(enable_async=True))
@@ -0,0 +1,256 @@
+"""
+Opt-in capture of sanitized request traces, replayed by benchmarks/replay.py.
+
+With TRAFFIC_CAPTURE_PATH set, each request except /metrics, /admin and
+static files is appended to that file as one line of JSON:
+
+    {"t": 1718000000.123, "m": "POST", "r": "/questions/{item_id}/vote/up", "p": "/questions/7/vote/up",
+     "i": "3f9c1a0b2e4d", "x": 1, "s": 201, "d": 12.4}
+
+    t  when it arrived, unix seconds      m  method
+    r  route template                      p  path
+    q  query parameters                    f  form fields
+    i  who sent it                         x  1 for htmx requests
+    c  1 if it was a conditional GET       s  status
+    d  time to the end of the response, ms
+
+Headers, cookies and tokens are never written, nor are passwords. Who sent a
+request is a keyed hash (HMAC under TRAFFIC_CAPTURE_KEY) of the username in
+its access token, or in the form of a login or registration. Other free text
+(searches, question text, tag names, text in paths) becomes "~<words>:<hash>",
+the same text always the same hash, so repeats and word counts survive but
+the text does not. Numbers, other than usernames and emails, and the values
+of KEPT_FIELDS are kept as they are.
+
+Lines are written by a background thread in batches, so a request only pays
+for building its line. If the writer falls QUEUE_SIZE lines behind, or the file
+reaches TRAFFIC_CAPTURE_MAX_MB, lines are dropped and counted in
+traffic_capture_dropped_total. Workers may share a file: batches are appended
+with single O_APPEND writes.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from typing import Optional
+from urllib.parse import parse_qsl
+
+import jwt
+from starlette.requests import cookie_parser
+
+from app import settings
+from app.metrics import traffic_capture_dropped
+
+logger = logging.getLogger(__name__)
+
+SKIPPED_PREFIXES = ("/metrics", "/admin", "/static")
+KEPT_FIELDS = {"sort", "limit", "cursor", "format"}
+DROPPED_FIELDS = {"password"}
+# Hashed even when they look like numbers
+HASHED_FIELDS = {"username", "email"}
+QUEUE_SIZE = 10_000
+# Form bodies bigger than this are recorded without their fields
+MAX_FORM_BYTES = 64 * 1024
+
+# Decoding a token costs more than the rest of the trace, and users send
+# theirs on every request; remembered for up to MAX_TOKENS tokens at a time
+MAX_TOKENS = 10_000
+_token_identities: dict[str, Optional[str]] = {}
+
+_PATH_PARAM = re.compile(r"{(\w+)(?::\w+)?}")
+_NUMBER = re.compile(r"-?\d+(\.\d+)?")
+
+
+def identity(value: str) -> str:
+    return hmac.new(settings.TRAFFIC_CAPTURE_KEY.encode(), value.encode(), hashlib.sha256).hexdigest()[:12]
+
+
+def pseudonym(value: str) -> str:
+    return f"~{len(value.split())}:{identity(value)}"
+
+
+def sanitize(name: str, value: str) -> str:
+    if name in KEPT_FIELDS or (name not in HASHED_FIELDS and _NUMBER.fullmatch(value)):
+        return value
+    return pseudonym(value)
+
+
+def sanitize_fields(pairs: list[tuple[str, str]]) -> dict[str, str]:
+    return {name: sanitize(name, value) for name, value in pairs if name not in DROPPED_FIELDS}
+
+
+def _token_identity(scope: dict) -> Optional[str]:
+    token = None
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            token = cookie_parser(value.decode("latin-1")).get("access_token") or token
+        elif name == b"authorization" and value[:7].lower() == b"bearer ":
+            token = token or value[7:].decode("latin-1")
+    if not token:
+        return None
+    if token in _token_identities:
+        return _token_identities[token]
+    try:
+        # Only to tell users apart; the app itself checks the signature
+        username = jwt.decode(token, options={"verify_signature": False}).get("sub")
+    except jwt.InvalidTokenError:
+        username = None
+    if len(_token_identities) >= MAX_TOKENS:
+        _token_identities.clear()
+    _token_identities[token] = identity(username) if username else None
+    return _token_identities[token]
+
+
+def build_trace(scope: dict, started: float, duration: float, status: Optional[int], body: Optional[bytes]) -> dict:
+    trace = {"t": round(started, 3), "m": scope["method"]}
+    route = getattr(scope.get("route"), "path", None)
+    if route is None:
+        trace["r"] = "unmatched"
+    else:
+        params = scope.get("path_params", {})
+        trace["r"] = route
+        trace["p"] = _PATH_PARAM.sub(lambda match: sanitize(match[1], str(params.get(match[1], ""))), route)
+    if scope["query_string"]:
+        trace["q"] = sanitize_fields(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+
+    form = None
+    if body is not None:
+        form = parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True)
+        trace["f"] = sanitize_fields(form)
+    who = _token_identity(scope)
+    if who is None and form:
+        username = dict(form).get("username")
+        who = identity(username) if username else None
+    if who:
+        trace["i"] = who
+
+    headers = dict(scope["headers"])
+    if headers.get(b"hx-request") == b"true":
+        trace["x"] = 1
+    if b"if-none-match" in headers:
+        trace["c"] = 1
+    # No status: the app raised, and Starlette answered 500
+    trace["s"] = status or 500
+    trace["d"] = round(duration * 1000, 2)
+    return trace
+
+
+class TrafficLog:
+    """Appends traces to a file from a background thread."""
+
+    def __init__(self, path: str, max_mb: float):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.written = 0
+        self._queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._fd: Optional[int] = None
+
+    def write(self, trace: dict):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            traffic_capture_dropped.inc("behind")
+
+    def start(self):
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.written = os.fstat(self._fd).st_size
+        self._thread = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        while not self._queue.empty():
+            self._flush()
+        os.close(self._fd)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._flush(self._queue.get(timeout=0.5))
+            except queue.Empty:
+                pass
+            except Exception:
+                logger.exception("Writing request traces failed")
+
+    def _flush(self, first: Optional[dict] = None):
+        traces = [] if first is None else [first]
+        while len(traces) < 1000:
+            try:
+                traces.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not traces:
+            return
+        data = "".join(json.dumps(trace, separators=(",", ":")) + "\n" for trace in traces).encode()
+        if self.written + len(data) > self.max_bytes:
+            if self.written <= self.max_bytes:
+                logger.warning("Traffic capture file %s is full, no longer capturing", self.path)
+                self.written = self.max_bytes + 1
+            traffic_capture_dropped.inc("full", amount=len(traces))
+            return
+        os.write(self._fd, data)
+        self.written += len(data)
+
+
+traffic_log: Optional[TrafficLog] = None
+
+
+def start_traffic_capture(path: str, max_mb: float):
+    global traffic_log
+    traffic_log = TrafficLog(path, max_mb)
+    traffic_log.start()
+
+
+def stop_traffic_capture():
+    global traffic_log
+    if traffic_log:
+        traffic_log.stop()
+        traffic_log = None
+
+
+class TrafficCaptureMiddleware:
+    """Hands a sanitized trace of every request to `traffic_log` once it is answered."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or traffic_log is None or scope["path"].startswith(SKIPPED_PREFIXES):
+            return await self.app(scope, receive, send)
+
+        log = traffic_log
+        started = time.time()
+        timer = time.perf_counter()
+        status: Optional[int] = None
+        is_form = dict(scope["headers"]).get(b"content-type", b"").startswith(b"application/x-www-form-urlencoded")
+        chunks: list[bytes] = []
+        size = 0
+
+        async def receive_with_body():
+            nonlocal size
+            message = await receive()
+            if is_form and message["type"] == "http.request" and size <= MAX_FORM_BYTES:
+                chunks.append(message.get("body", b""))
+                size += len(chunks[-1])
+            return message
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive_with_body if is_form else receive, send_with_status)
+        finally:
+            body = b"".join(chunks) if is_form and size <= MAX_FORM_BYTES else None
+            log.write(build_trace(scope, started, time.perf_counter() - timer, status, body))
@@ -0,0 +1,64 @@
+"""
+Conditional GET for HTML pages.
+
+A page's ETag is a digest of the versions of everything it shows (question
+revisions from app/db/revisions.py, the leaderboard entries, the current user)
+plus template_version(). Routes compute it before loading and rendering the
+page and answer a matching If-None-Match with 304 right away.
+
+Pages shown to a logged-in user carry their vote state, so they are
+`private, no-cache`: only the browser keeps them, and revalidates every time.
+Anonymous pages are `public` with HTTP_CACHE_MAX_AGE and
+HTTP_CACHE_STALE_SECONDS of stale-while-revalidate, so a reverse proxy can
+serve them. Both vary on Cookie and Authorization, where the access token
+lives, so a shared cache never hands one user's page to another.
+"""
+import hashlib
+from typing import Any, Optional
+
+from fastapi import Request, Response
+
+from app import settings
+from app.models.user import UserPublic
+from app.templating import template_version
+
+VARY = "Cookie, Authorization"
+
+
+def make_etag(*parts: Any) -> str:
+    """Weak ETag over `parts`, which must have a stable repr across processes."""
+    digest = hashlib.sha1(repr((template_version(), *parts)).encode()).hexdigest()[:20]
+    # Weak: a compressed body is still the same page
+    return f'W/"{digest}"'
+
+
+def _opaque(etag: str) -> str:
+    return etag.removeprefix("W/")
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison
+    return _opaque(etag) in {_opaque(candidate.strip()) for candidate in header.split(",")}
+
+
+def cache_headers(etag: str, current_user: Optional[UserPublic]) -> dict[str, str]:
+    if current_user is not None:
+        cache_control = "private, no-cache"
+    else:
+        cache_control = (
+            f"public, max-age={settings.HTTP_CACHE_MAX_AGE}, "
+            f"stale-while-revalidate={settings.HTTP_CACHE_STALE_SECONDS}"
+        )
+    return {"ETag": etag, "Cache-Control": cache_control, "Vary": VARY}
+
+
+def not_modified(request: Request, etag: str, current_user: Optional[UserPublic]) -> Optional[Response]:
+    """A 304 response if the client already has this version of the page, else None."""
+    if not etag_matches(request, etag):
+        return None
+    return Response(status_code=304, headers=cache_headers(etag, current_user))
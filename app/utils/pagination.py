@@ -0,0 +1,101 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are selected with a row-value comparison on the sort key instead of
+OFFSET, so with a matching index page N costs the same as page 1. Cursors are
+opaque url-safe strings holding the direction and the key of the boundary row.
+"""
+import base64
+import json
+from dataclasses import dataclass
+from typing import Any, Callable, Generic, Optional, Sequence, TypeVar
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+
+T = TypeVar("T")
+
+
+def encode_cursor(direction: str, key: Sequence[Any]) -> str:
+    raw = json.dumps([direction, list(key)], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[str, list[Any]]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        direction, key = json.loads(raw)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if direction not in ("next", "prev") or not isinstance(key, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return direction, key
+
+
+@dataclass
+class Page(Generic[T]):
+    items: list[T]
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
+
+
+class Keyset:
+    """
+    Pagination over `keys`, which must be unique together (end with the primary key).
+
+        keyset = Keyset([Question.vote_sum, Question.id], lambda q: (q.vote_sum, q.id), cursor, limit, descending=True)
+        page = keyset.page(session.exec(keyset.apply(select(Question))).all())
+    """
+
+    def __init__(
+        self,
+        keys: Sequence[Any],
+        key_of: Callable[[Any], Sequence[Any]],
+        cursor: Optional[str],
+        limit: int,
+        descending: bool = False,
+    ):
+        self.keys = keys
+        self.key_of = key_of
+        self.limit = limit
+        self.has_cursor = cursor is not None
+        self.direction, self.after = decode_cursor(cursor) if cursor else ("next", None)
+        if self.after is not None and len(self.after) != len(keys):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        self.backwards = self.direction == "prev"
+        # Walking backwards scans the index in the opposite order
+        self.scan_descending = descending != self.backwards
+
+    def apply(self, statement):
+        if self.after is not None:
+            key = tuple_(*self.keys)
+            after = tuple_(*self.after)
+            statement = statement.where(key < after if self.scan_descending else key > after)
+        order = [k.desc() if self.scan_descending else k.asc() for k in self.keys]
+        # One extra row tells whether there is another page in this direction
+        return statement.order_by(*order).limit(self.limit + 1)
+
+    def page(self, rows: Sequence[T]) -> Page[T]:
+        rows = list(rows)
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        if self.backwards:
+            rows.reverse()
+        if not rows:
+            return Page(items=rows)
+
+        next_cursor, prev_cursor = self.cursors(rows[0], rows[-1], has_more)
+        return Page(items=rows, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+    def cursors(self, first: Any, last: Any, has_more: bool) -> tuple[Optional[str], Optional[str]]:
+        """
+        Next and previous cursors of a non-empty page running from `first` to
+        `last`, for callers that stream rows instead of passing them to page().
+        has_more tells whether the query returned the extra row.
+        """
+        has_next = has_more if not self.backwards else True
+        has_prev = self.has_cursor if not self.backwards else has_more
+        return (
+            encode_cursor("next", self.key_of(last)) if has_next else None,
+            encode_cursor("prev", self.key_of(first)) if has_prev else None,
+        )
@@ -0,0 +1,66 @@
+"""
+Streamed template responses.
+
+The page is rendered with the async Jinja environment while it is being sent:
+output goes out in STREAM_CHUNK_SIZE pieces, and `{{ stream_flush() }}` in a
+template sends what is buffered right away (layout.html does so before the page
+content, so the browser can start on the head while rows are still loading).
+
+Template variables can be async iterables that load rows as the template loops
+over them. They run after the route returned, when FastAPI has already closed
+the route's dependencies, so they must open their own database session.
+"""
+from typing import Any, AsyncIterator, Optional
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+from app import settings
+from app.templating import FLUSH_MARKER, stream_templates
+
+
+class PendingValue:
+    """A template value that is only known once earlier parts of the page were rendered, e.g. a page cursor."""
+
+    def __init__(self, value: Optional[str] = None):
+        self.value = value
+
+    def __bool__(self):
+        return bool(self.value)
+
+    def __str__(self):
+        return self.value or ""
+
+
+async def _render_chunks(template, context: dict, chunk_size: int) -> AsyncIterator[str]:
+    buffer: list[str] = []
+    size = 0
+    async for piece in template.generate_async(context):
+        flush = FLUSH_MARKER in piece
+        if flush:
+            piece = piece.replace(FLUSH_MARKER, "")
+        buffer.append(piece)
+        size += len(piece)
+        if flush or size >= chunk_size:
+            yield "".join(buffer)
+            buffer.clear()
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def StreamingTemplateResponse(
+    request: Request,
+    name: str,
+    context: dict[str, Any],
+    status_code: int = 200,
+    headers: Optional[dict[str, str]] = None,
+) -> StreamingResponse:
+    context = {"request": request, **context}
+    template = stream_templates.get_template(name)
+    return StreamingResponse(
+        _render_chunks(template, context, settings.STREAM_CHUNK_SIZE),
+        status_code=status_code,
+        headers=headers,
+        media_type="text/html; charset=utf-8",
+    )
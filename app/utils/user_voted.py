@@ -1,27 +1,33 @@
 from typing import TYPE_CHECKING
 from enum import Enum
 
+from sqlmodel import Session
+
 # Use TYPE_CHECKING to avoid circular imports
 if TYPE_CHECKING:
     from app.models.question import Question
     from app.models.tag import Tag
     from app.models.user import User
+    from app.utils.vote_context import VoteContext
 
 class Vote(Enum):
     DOWNVOTE = -1
     NEUTRAL = 0
     UPVOTE = 1
 
-def user_voted(current_user: "User | None", question: "Question", tag: "Tag | None" = None) -> Vote:
-    if not current_user:
+def user_voted(
+    current_user: "User | None",
+    question: "Question",
+    tag: "Tag | None" = None,
+    vote_context: "VoteContext | None" = None,
+) -> Vote:
+    if not current_user or not question:
         return Vote.NEUTRAL
-    if tag:
-        for vote in tag.question_tag_votes:
-            if vote.user_id == current_user.id and vote.question_id == question.id:
-                return Vote(vote.vote_value)
-    elif question:
-        for vote in question.votes:
-            if vote.user_id == current_user.id:
-                return Vote(vote.vote_value)
 
-    return Vote.NEUTRAL
+    if vote_context is None:
+        from app.utils.vote_context import VoteContext
+        vote_context = VoteContext.load(Session.object_session(question), [question.id], current_user)
+
+    if tag:
+        return vote_context.tag_vote(question.id, tag.id)
+    return vote_context.question_vote(question.id)
@@ -0,0 +1,121 @@
+from typing import TYPE_CHECKING, Iterable, Optional
+
+from sqlmodel import Session, select
+
+from app.utils.user_voted import Vote
+
+# Use TYPE_CHECKING to avoid circular imports
+if TYPE_CHECKING:
+    from app.models.user import User
+
+
+class VoteContext:
+    """
+    Request-scoped snapshot of vote totals for a page of questions.
+
+    Holds the per-question sums, the per-(question, tag) sums and Wilson
+    scores (which order a question's tags) and the current user's own votes,
+    so rendering a page never walks ORM vote collections.
+    """
+
+    def __init__(
+        self,
+        question_sums: Optional[dict[int, int]] = None,
+        tag_sums: Optional[dict[tuple[int, int], int]] = None,
+        question_votes: Optional[dict[int, int]] = None,
+        tag_votes: Optional[dict[tuple[int, int], int]] = None,
+        tag_ranks: Optional[dict[tuple[int, int], float]] = None,
+    ):
+        self.question_sums = question_sums or {}
+        self.tag_sums = tag_sums or {}
+        self.tag_ranks = tag_ranks or {}
+        self.question_votes = question_votes or {}
+        self.tag_votes = tag_votes or {}
+
+    @classmethod
+    def load(
+        cls,
+        session: Session,
+        question_ids: Iterable[int],
+        current_user: "User | None" = None,
+        question_sums: Optional[dict[int, int]] = None,
+        question_votes: Optional[dict[int, int]] = None,
+    ) -> "VoteContext":
+        """
+        Fetch everything needed to render the given questions in a constant
+        number of queries. Totals come from the denormalized vote_sum counters;
+        pass question_sums or question_votes when the caller already knows them
+        to skip those queries.
+        """
+        from app.models.link_tables import QuestionTagLink
+        from app.models.question import Question
+
+        ids = list(set(question_ids))
+        if not ids:
+            return cls()
+
+        if question_sums is None:
+            question_sums = dict(session.exec(
+                select(Question.id, Question.vote_sum).where(Question.id.in_(ids))
+            ).all())
+
+        tag_sums, tag_ranks = {}, {}
+        for question_id, tag_id, vote_sum, wilson_score in session.exec(
+            select(QuestionTagLink.question_id, QuestionTagLink.tag_id, QuestionTagLink.vote_sum, QuestionTagLink.wilson_score)
+            .where(QuestionTagLink.question_id.in_(ids))
+        ).all():
+            tag_sums[question_id, tag_id] = vote_sum
+            tag_ranks[question_id, tag_id] = wilson_score
+
+        if not current_user:
+            return cls(question_sums, tag_sums, tag_ranks=tag_ranks)
+        user_votes = cls.load_user_votes(session, ids, current_user, question_votes)
+        user_votes.question_sums = question_sums
+        user_votes.tag_sums = tag_sums
+        user_votes.tag_ranks = tag_ranks
+        return user_votes
+
+    @classmethod
+    def load_user_votes(
+        cls,
+        session: Session,
+        question_ids: Iterable[int],
+        current_user: "User",
+        question_votes: Optional[dict[int, int]] = None,
+    ) -> "VoteContext":
+        """Fetch only the current user's own votes, for pages whose totals are already known."""
+        from app.models.link_tables import QuestionTagVote
+        from app.models.vote import QuestionVote
+
+        ids = list(set(question_ids))
+        if not ids:
+            return cls()
+
+        if question_votes is None:
+            question_votes = dict(session.exec(
+                select(QuestionVote.question_id, QuestionVote.vote_value)
+                .where(QuestionVote.user_id == current_user.id, QuestionVote.question_id.in_(ids))
+            ).all())
+        tag_votes = {
+            (question_id, tag_id): vote_value
+            for question_id, tag_id, vote_value in session.exec(
+                select(QuestionTagVote.question_id, QuestionTagVote.tag_id, QuestionTagVote.vote_value)
+                .where(QuestionTagVote.user_id == current_user.id, QuestionTagVote.question_id.in_(ids))
+            ).all()
+        }
+        return cls(question_votes=question_votes, tag_votes=tag_votes)
+
+    def question_sum(self, question_id: int) -> int:
+        return self.question_sums.get(question_id) or 0
+
+    def tag_sum(self, question_id: int, tag_id: int) -> int:
+        return self.tag_sums.get((question_id, tag_id)) or 0
+
+    def tag_rank(self, question_id: int, tag_id: int) -> float:
+        return self.tag_ranks.get((question_id, tag_id)) or 0.0
+
+    def question_vote(self, question_id: int) -> Vote:
+        return Vote(self.question_votes.get(question_id, 0))
+
+    def tag_vote(self, question_id: int, tag_id: int) -> Vote:
+        return Vote(self.tag_votes.get((question_id, tag_id), 0))
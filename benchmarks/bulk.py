@@ -0,0 +1,181 @@
+"""
+Throughput of the bulk import and export (app/services/bulk.py).
+
+    python -m benchmarks.bulk --rows 1000000
+
+Writes a JSONL file of --rows records to a temporary directory: a tenth are
+questions with Zipf-distributed tags, the rest votes on Zipf-distributed
+questions, one in ten of them on a tag. Imports it into a throwaway SQLite
+file and exports it back as JSONL and CSV, reporting rows per second and the
+process' resident memory, then times importing --baseline of the questions and
+votes one transaction per row, as the routes write them.
+"""
+import argparse
+import json
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlmodel import Session, SQLModel, select
+
+from app.db.migrations import upgrade
+from app.models import Question, QuestionVote, Tag, User
+from app.services import bulk
+from app.services.passwords import pwd_context
+
+
+def rss_mib() -> float:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def reset_peak_rss():
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+        clear_refs.write("5")
+
+
+def peak_rss_mib() -> float:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def write_records(path: Path, rows: int, users: int, tags: int):
+    rng = random.Random(1)
+    questions = max(rows // 10, 1)
+    now = datetime.utcnow()
+    tag_weights = [1 / rank for rank in range(1, tags + 1)]
+    question_tags = []
+    with open(path, "w") as file:
+        for question_id in range(1, questions + 1):
+            names = sorted({f"tag{index}" for index in rng.choices(range(tags), weights=tag_weights, k=rng.randint(1, 4))})
+            question_tags.append(names)
+            file.write(json.dumps({
+                "kind": "question", "id": question_id, "text": f"Question number {question_id}",
+                "tags": names, "user": f"user{rng.randrange(users)}",
+            }) + "\n")
+        question_weights = [1 / rank for rank in range(1, questions + 1)]
+        for question_id in rng.choices(range(1, questions + 1), weights=question_weights, k=rows - questions):
+            record = {
+                "kind": "vote", "question_id": question_id, "user": f"user{rng.randrange(users)}",
+                "value": 1 if rng.random() < 0.7 else -1,
+                "created_at": (now - timedelta(seconds=rng.uniform(0, 30 * 86400))).isoformat(),
+            }
+            if rng.random() < 0.1:
+                record["tag"] = rng.choice(question_tags[question_id - 1])
+            file.write(json.dumps(record) + "\n")
+
+
+def database(path: Path):
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    upgrade(engine)
+    return engine
+
+
+def per_row(engine, path: Path, rows: int):
+    """Import about `rows` questions and votes on them one transaction per row, through the ORM."""
+    password = pwd_context.hash("imported")
+    questions = rows // 10
+    records = []
+    with open(path) as file:
+        for record in map(json.loads, file):
+            if len(records) >= rows:
+                break
+            if record["kind"] == "question" and record["id"] <= questions:
+                records.append(record)
+            elif record["kind"] == "vote" and record["question_id"] <= questions and not record.get("tag"):
+                records.append(record)
+    user_ids, question_ids = {}, {}
+    started = time.perf_counter()
+    with Session(engine) as session:
+        for record in records:
+            if record["user"] not in user_ids:
+                user = User(username=record["user"], email=f"{record['user']}@imported.invalid", hashed_password=password)
+                session.add(user)
+                session.commit()
+                user_ids[record["user"]] = user.id
+            if record["kind"] == "question":
+                tags = []
+                for name in record["tags"]:
+                    tag = session.exec(select(Tag).where(Tag.name == name)).first() or Tag(name=name)
+                    tags.append(tag)
+                question = Question(text=record["text"], created_by=user_ids[record["user"]], tags=tags)
+                session.add(question)
+                session.commit()
+                question_ids[record["id"]] = question.id
+                continue
+            exists = session.exec(select(QuestionVote).where(
+                QuestionVote.user_id == user_ids[record["user"]],
+                QuestionVote.question_id == question_ids[record["question_id"]],
+            )).first()
+            if exists:
+                continue
+            session.add(QuestionVote(
+                user_id=user_ids[record["user"]], question_id=question_ids[record["question_id"]],
+                vote_value=record["value"], created_at=datetime.fromisoformat(record["created_at"]),
+            ))
+            question = session.get(Question, question_ids[record["question_id"]])
+            question.vote_sum += record["value"]
+            session.commit()
+    return len(records), time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--tags", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=5000)
+    parser.add_argument("--baseline", type=int, default=5000, help="rows imported one at a time")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / "source.jsonl"
+        write_records(source, args.rows, args.users, args.tags)
+        print(f"{args.rows} records, {source.stat().st_size / 1024 / 1024:.0f} MiB of JSONL")
+
+        engine = database(Path(tmp) / "bulk.db")
+        reset_peak_rss()
+        before = rss_mib()
+        started = time.perf_counter()
+        with open(source) as file:
+            report = bulk.import_file(engine, file, "jsonl", args.batch)
+        seconds = time.perf_counter() - started
+        imported = report.questions + report.votes
+        print(
+            f"import        {imported / seconds:9.0f} rows/s  {seconds:6.1f}s  RSS {before:.0f} -> peak {peak_rss_mib():.0f} MiB  "
+            f"({report.questions} questions, {report.tags} tags, {report.users} users, {report.votes} votes, "
+            f"{report.skipped} skipped)"
+        )
+
+        for format in bulk.FORMATS:
+            before = rss_mib()
+            highest = before
+            records = 0
+            started = time.perf_counter()
+            with open(Path(tmp) / f"export.{format}", "wb") as file:
+                for chunk in bulk.export_chunks(engine, format):
+                    file.write(chunk)
+                    records += chunk.count(b"\n")
+                    highest = max(highest, rss_mib())
+            seconds = time.perf_counter() - started
+            print(f"export {format:<6} {records / seconds:9.0f} rows/s  {seconds:6.1f}s  RSS {before:.0f} -> max {highest:.0f} MiB")
+        engine.dispose()
+
+        engine = database(Path(tmp) / "per_row.db")
+        rows, seconds = per_row(engine, source, args.baseline)
+        print(f"per-row       {rows / seconds:9.0f} rows/s  {seconds:6.1f}s  ({rows} rows)")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
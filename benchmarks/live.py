@@ -0,0 +1,150 @@
+"""
+Live vote updates with thousands of idle subscribers.
+
+    python -m benchmarks.live --subscribers 2000
+
+Seeds a throwaway SQLite file and serves app.main:app from a uvicorn
+subprocess. Opens --subscribers idle event streams spread over question pages
+and list pages and reports the server's resident memory per stream, vote
+latency with and without them, how long a vote on a quiet question takes to
+reach a page watching it, and how many pushes a burst of votes on one
+question turns into.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from app import settings
+from app.services import passwords
+from benchmarks.load_async import free_port, serve
+from benchmarks.login_storm import PASSWORD, seed
+
+BURST = 50
+
+
+def rss_kib(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def ms(latencies: list[float], percentile: int) -> float:
+    return statistics.quantiles(latencies, n=100)[percentile - 1] * 1000
+
+
+async def watch(client: httpx.AsyncClient, path: str, received: asyncio.Queue | None, opened: asyncio.Event):
+    async with client.stream("GET", path) as response:
+        opened.set()
+        async for line in response.aiter_lines():
+            if received is not None and line.startswith("event: "):
+                received.put_nowait((line[len("event: "):], time.perf_counter()))
+
+
+async def vote_latencies(client: httpx.AsyncClient, headers: list[dict], questions: int, count: int) -> list[float]:
+    rng = random.Random(4)
+    latencies = []
+    for i in range(count):
+        started = time.perf_counter()
+        response = await client.post(
+            f"/questions/{rng.randint(1, questions)}/vote/{rng.choice(('up', 'down'))}", headers=headers[i % len(headers)]
+        )
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def drive(base_url: str, pid: int, args) -> None:
+    rng = random.Random(3)
+    limits = httpx.Limits(max_connections=args.subscribers + 20, max_keepalive_connections=20)
+    timeout = httpx.Timeout(60, read=None)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        headers = []
+        for i in range(args.users):
+            response = await client.post("/auth/token", data={"username": f"user{i}", "password": PASSWORD})
+            response.raise_for_status()
+            headers.append({"Authorization": f"Bearer {response.json()['access_token']}"})
+
+        idle = await vote_latencies(client, headers, args.questions, args.votes)
+        memory_before = rss_kib(pid)
+
+        streams = []
+        for i in range(args.subscribers):
+            opened = asyncio.Event()
+            path = (
+                f"/questions/{rng.randint(3, args.questions)}/events" if i % 4
+                else f"/questions/events?limit=20"
+            )
+            streams.append(asyncio.create_task(watch(client, path, None, opened)))
+            await opened.wait()
+        await asyncio.sleep(1)
+        memory_after = rss_kib(pid)
+        print(
+            f"{args.subscribers} streams: server RSS {memory_before / 1024:.0f} -> {memory_after / 1024:.0f} MiB, "
+            f"{(memory_after - memory_before) / args.subscribers:.1f} KiB per stream"
+        )
+
+        busy = await vote_latencies(client, headers, args.questions, args.votes)
+        print(f"vote without streams p50={ms(idle, 50):6.1f}ms p99={ms(idle, 99):6.1f}ms")
+        print(f"vote with streams    p50={ms(busy, 50):6.1f}ms p99={ms(busy, 99):6.1f}ms")
+
+        received: asyncio.Queue = asyncio.Queue()
+        opened = asyncio.Event()
+        watcher = asyncio.create_task(watch(client, "/questions/1/events", received, opened))
+        await opened.wait()
+        delays = []
+        for i in range(args.rounds):
+            # Let the question's push interval run out, so the vote isn't held back
+            await asyncio.sleep(settings.LIVE_PUSH_INTERVAL_MS / 1000 + 0.05)
+            started = time.perf_counter()
+            (await client.post("/questions/1/vote/up", headers=headers[i % len(headers)])).raise_for_status()
+            name, arrived = await received.get()
+            delays.append(arrived - started)
+        print(f"vote to push         p50={ms(delays, 50):6.1f}ms p99={ms(delays, 99):6.1f}ms")
+
+        while not received.empty():
+            received.get_nowait()
+        for i in range(BURST):
+            await client.post(f"/questions/1/vote/{'up' if i % 2 else 'down'}", headers=headers[i % len(headers)])
+        await asyncio.sleep(2)
+        print(f"{BURST} votes in a burst -> {received.qsize()} pushes")
+
+        for task in [*streams, watcher]:
+            task.cancel()
+        await asyncio.gather(*streams, watcher, return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=500)
+    parser.add_argument("--votes", type=int, default=300, help="votes timed with and without streams")
+    parser.add_argument("--rounds", type=int, default=30, help="votes timed until their push arrives")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = f"sqlite:///{Path(tmp) / 'bench.db'}"
+        os.environ["BCRYPT_ROUNDS"] = "4"
+        passwords.pwd_context.update(bcrypt__rounds=4, bcrypt__min_rounds=4)
+        seed(database_url, args.users, args.questions)
+        env = {**os.environ, "DATABASE_URL": database_url, "RELATED_REFRESH_SECONDS": "0"}
+        port = free_port()
+        server = serve("app.main:app", env, port)
+        try:
+            asyncio.run(drive(f"http://127.0.0.1:{port}", server.pid, args))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
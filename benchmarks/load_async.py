@@ -0,0 +1,179 @@
+"""
+Latency under concurrency: async routes vs. the old sync-def/threadpool model.
+
+    python -m benchmarks.load_async --concurrency 200 --requests 4000
+
+Seeds a throwaway SQLite file, then serves it twice from a uvicorn subprocess:
+once with app.main:app (AsyncSession on aiosqlite) and once with
+`threadpool_app` below, which renders the same pages from sync `def` routes
+on a sync Session, as every route did before. Both are driven with the same
+mix of question detail and list page requests.
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from sqlalchemy.orm import selectinload
+from sqlmodel import desc, select
+
+from app.db.database import SessionDep
+from app.models import Question, QuestionPublic
+from app.routers import authentication, questions, search
+from app.templating import templates
+from app.utils.vote_context import VoteContext
+
+threadpool_app = FastAPI()
+
+
+@threadpool_app.get("/questions/{item_id}", name="question")
+def read_question(session: SessionDep, request: Request, item_id: int):
+    question = session.exec(
+        select(Question).where(Question.id == item_id).options(selectinload(Question.user), selectinload(Question.tags))
+    ).first()
+    if not question:
+        raise HTTPException(status_code=404, detail="Question not found")
+    vote_context = VoteContext.load(session, [question.id], question_sums={question.id: question.vote_sum})
+    return templates.TemplateResponse("questions/index.html", {
+        "request": request,
+        "question": QuestionPublic.from_question(question, vote_context=vote_context),
+    })
+
+
+@threadpool_app.get("/questions/", name="list_questions")
+def list_questions(session: SessionDep, request: Request, limit: int = 5):
+    questions = session.exec(
+        select(Question)
+        .options(selectinload(Question.user), selectinload(Question.tags))
+        .order_by(desc(Question.vote_sum), desc(Question.id))
+        .limit(limit)
+    ).all()
+    vote_context = VoteContext.load(session, [q.id for q in questions], question_sums={q.id: q.vote_sum for q in questions})
+    return templates.TemplateResponse("questions/list.html", {
+        "request": request,
+        "questions": [QuestionPublic.from_question(q, vote_context=vote_context) for q in questions],
+    })
+
+
+# The templates link to the other routes with url_for; the sync routes above
+# were added first, so they win when paths overlap
+threadpool_app.include_router(questions.router)
+threadpool_app.include_router(authentication.router)
+threadpool_app.include_router(search.router)
+
+
+def seed(database_url: str, questions: int, tags: int):
+    from sqlalchemy import create_engine, insert
+    from sqlmodel import Session, SQLModel
+
+    from app.db.migrations import upgrade
+    from app.models import QuestionTagLink, Tag
+
+    engine = create_engine(database_url)
+    SQLModel.metadata.create_all(engine)
+    upgrade(engine)
+    rng = random.Random(1)
+    with Session(engine) as session:
+        session.execute(insert(Tag), [{"name": f"tag{i}"} for i in range(tags)])
+        session.execute(insert(Question), [
+            {"text": f"Question {i}", "vote_sum": rng.randint(-5, 50)} for i in range(questions)
+        ])
+        session.execute(insert(QuestionTagLink), [
+            {"question_id": q, "tag_id": t, "vote_sum": rng.randint(0, 10)}
+            for q in range(1, questions + 1)
+            for t in rng.sample(range(1, tags + 1), 3)
+        ])
+        session.commit()
+    engine.dispose()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def drive(base_url: str, args) -> tuple[list[float], int]:
+    rng = random.Random(2)
+    paths = [
+        f"/questions/{rng.randint(1, args.questions)}" if rng.random() < 0.7 else "/questions/?limit=20"
+        for _ in range(args.requests)
+    ]
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def one(path: str):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.get(path)
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    errors += 1
+
+        await asyncio.gather(*(one(path) for path in paths[:50]))  # warm up
+        latencies.clear()
+        started = time.perf_counter()
+        await asyncio.gather(*(one(path) for path in paths))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def serve(target: str, env: dict, port: int, factory: bool = False) -> subprocess.Popen:
+    command = [sys.executable, "-m", "uvicorn", target, "--port", str(port), "--log-level", "warning", "--timeout-keep-alive", "120"]
+    if factory:
+        command.append("--factory")
+    server = subprocess.Popen(command, env=env)
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/questions/1", timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"{target} did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--questions", type=int, default=2000)
+    parser.add_argument("--tags", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = f"sqlite:///{Path(tmp) / 'bench.db'}"
+        seed(database_url, args.questions, args.tags)
+        env = {**os.environ, "DATABASE_URL": database_url}
+
+        for label, target in (("threadpool", "benchmarks.load_async:threadpool_app"), ("async", "app.main:app")):
+            port = free_port()
+            server = serve(target, env, port)
+            try:
+                latencies, errors, elapsed = asyncio.run(drive(f"http://127.0.0.1:{port}", args))
+            finally:
+                server.terminate()
+                server.wait()
+            quantiles = statistics.quantiles(latencies, n=100)
+            print(
+                f"{label:10s} {len(latencies) / elapsed:8.0f} req/s  "
+                f"p50={quantiles[49] * 1000:7.1f}ms  p95={quantiles[94] * 1000:7.1f}ms  "
+                f"p99={quantiles[98] * 1000:7.1f}ms  errors={errors}"
+            )
+
+
+if __name__ == "__main__":
+    main()
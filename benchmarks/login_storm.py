@@ -0,0 +1,160 @@
+"""
+Page view latency during a login storm.
+
+    python -m benchmarks.login_storm --logins 16 --views 32 --requests 1000
+
+Seeds a throwaway SQLite file with users and questions, then serves app.main:app
+from a uvicorn subprocess twice: once as shipped, with bcrypt on the password
+hash pool, and once with `InlinePasswordHasher`, which hashes on the event loop
+as the routes did before. Each run drives question pages at a fixed concurrency
+while other clients log in back to back, and reports page latency percentiles,
+login throughput and how many logins were turned away with 503.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from app.services import passwords
+from app.services.passwords import PasswordHasher
+from benchmarks.load_async import free_port, serve
+
+PASSWORD = "correct horse battery staple"
+
+
+class InlinePasswordHasher(PasswordHasher):
+    """Runs bcrypt on the calling thread, i.e. on the event loop."""
+
+    async def _submit(self, fn, *args):
+        return fn(*args)
+
+
+def inline_app():
+    from app.main import app
+
+    passwords.password_hasher = InlinePasswordHasher(passwords.pwd_context)
+    return app
+
+
+def seed(database_url: str, users: int, questions: int):
+    from sqlalchemy import create_engine, insert
+    from sqlmodel import Session, SQLModel
+
+    from app.db.migrations import upgrade
+    from app.models import Question, User
+
+    engine = create_engine(database_url)
+    SQLModel.metadata.create_all(engine)
+    upgrade(engine)
+    # One hash for everyone: seeding shouldn't take minutes of bcrypt
+    hashed_password = passwords.pwd_context.hash(PASSWORD)
+    with Session(engine) as session:
+        session.execute(insert(User), [
+            {"username": f"user{i}", "email": f"user{i}@example.com", "hashed_password": hashed_password}
+            for i in range(users)
+        ])
+        session.execute(insert(Question), [{"text": f"Question {i}"} for i in range(questions)])
+        session.commit()
+    engine.dispose()
+
+
+async def drive(base_url: str, args) -> dict:
+    rng = random.Random(2)
+    view_latencies = []
+    login_latencies = []
+    view_errors = 0
+    rejected = 0
+    done = asyncio.Event()
+    limits = httpx.Limits(max_connections=args.views + args.logins)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        remaining = args.requests
+
+        async def viewer():
+            nonlocal remaining, view_errors
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                response = await client.get(f"/questions/{rng.randint(1, args.questions)}")
+                view_latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    view_errors += 1
+
+        async def login_loop():
+            nonlocal rejected
+            while not done.is_set():
+                started = time.perf_counter()
+                response = await client.post(
+                    "/auth/token", data={"username": f"user{rng.randrange(args.users)}", "password": PASSWORD}
+                )
+                if response.status_code == 503:
+                    rejected += 1
+                    await asyncio.sleep(0.05)
+                    continue
+                response.raise_for_status()
+                login_latencies.append(time.perf_counter() - started)
+
+        async def views():
+            await asyncio.gather(*(viewer() for _ in range(args.views)))
+            done.set()
+
+        started = time.perf_counter()
+        await asyncio.gather(views(), *(login_loop() for _ in range(args.logins)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "views": view_latencies,
+        "view_errors": view_errors,
+        "logins": login_latencies,
+        "rejected": rejected,
+        "elapsed": elapsed,
+    }
+
+
+def ms(latencies: list[float], percentile: int) -> float:
+    return statistics.quantiles(latencies, n=100)[percentile - 1] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=16, help="clients logging in back to back")
+    parser.add_argument("--views", type=int, default=32, help="clients loading question pages")
+    parser.add_argument("--requests", type=int, default=1000, help="page views per run")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--questions", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=12, help="BCRYPT_ROUNDS for the seeded hashes and the server")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = f"sqlite:///{Path(tmp) / 'bench.db'}"
+        os.environ["BCRYPT_ROUNDS"] = str(args.rounds)
+        passwords.pwd_context.update(bcrypt__rounds=args.rounds, bcrypt__min_rounds=args.rounds)
+        seed(database_url, args.users, args.questions)
+        env = {**os.environ, "DATABASE_URL": database_url}
+
+        for label, target in (("inline", "benchmarks.login_storm:inline_app"), ("pool", "app.main:app")):
+            port = free_port()
+            server = serve(target, env, port, factory=target.endswith(":inline_app"))
+            try:
+                result = asyncio.run(drive(f"http://127.0.0.1:{port}", args))
+            finally:
+                server.terminate()
+                server.wait()
+            views, logins = result["views"], result["logins"]
+            print(
+                f"{label:7s} views: p50={ms(views, 50):7.1f}ms p95={ms(views, 95):7.1f}ms "
+                f"p99={ms(views, 99):7.1f}ms errors={result['view_errors']}  "
+                f"logins: {len(logins) / result['elapsed']:5.1f}/s p50={ms(logins, 50):7.1f}ms "
+                f"rejected={result['rejected']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Cost of the stored rankings against ranking from the vote rows per request.
+
+    python -m benchmarks.rankings --questions 100000
+
+Seeds a throwaway SQLite file with Zipf-distributed votes cast over the last
+--days days, times the full rescoring pass (app/services/rankings.py), reading
+the first and a deep page of each ranking through its (score, id) index, and
+for comparison the hot and best first pages aggregated from the vote rows.
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import create_engine, insert, text, tuple_
+from sqlmodel import Session, SQLModel, select
+
+from app import settings
+from app.db.migrations import upgrade
+from app.models import Question, QuestionVote
+from app.services import rankings
+
+BATCH = 50_000
+PAGE = 20
+
+
+def seed(engine, questions: int, votes: int, users: int, days: int):
+    rng = random.Random(1)
+    now = datetime.utcnow()
+    weights = [1 / rank for rank in range(1, questions + 1)]
+    per_question = [0] * questions
+    for index in rng.choices(range(questions), weights=weights, k=votes):
+        per_question[index] = min(per_question[index] + 1, users)
+    with Session(engine) as session:
+        for start in range(0, questions, BATCH):
+            session.execute(insert(Question), [{"text": f"question {i}"} for i in range(start, min(start + BATCH, questions))])
+        rows = []
+        for index, count in enumerate(per_question):
+            # Some questions are liked, some divisive
+            share = rng.choice((0.9, 0.7, 0.5))
+            for user_id in rng.sample(range(1, users + 1), count):
+                rows.append({
+                    "user_id": user_id,
+                    "question_id": index + 1,
+                    "vote_value": 1 if rng.random() < share else -1,
+                    "created_at": now - timedelta(seconds=rng.uniform(0, days * 86400)),
+                })
+            if len(rows) >= BATCH:
+                session.execute(insert(QuestionVote), rows)
+                rows = []
+        if rows:
+            session.execute(insert(QuestionVote), rows)
+        session.commit()
+
+
+def timed(session, statement, rounds: int) -> list[float]:
+    latencies = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        session.execute(statement).all()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def ms(latencies: list[float]) -> str:
+    return f"p50={statistics.median(latencies) * 1000:8.2f}ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=100_000)
+    parser.add_argument("--votes", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{Path(tmp) / 'bench.db'}")
+        SQLModel.metadata.create_all(engine)
+        upgrade(engine)
+        seed(engine, args.questions, args.votes, args.users, args.days)
+
+        with Session(engine) as session:
+            started = time.perf_counter()
+            scored, _ = rankings.rebuild(session)
+            session.commit()
+            print(f"rescore all          {time.perf_counter() - started:8.1f}s   {scored} questions with votes")
+
+            for sort, column in rankings.SORTS.items():
+                first = select(Question.id).order_by(column.desc(), Question.id.desc()).limit(PAGE)
+                # Keyset page 500 pages in, as the list route asks for it
+                boundary = session.execute(
+                    select(column, Question.id).order_by(column.desc(), Question.id.desc()).offset(500 * PAGE)
+                ).first()
+                deep = first.where(tuple_(column, Question.id) < tuple_(*boundary))
+                print(
+                    f"{sort:<14} stored  first {ms(timed(session, first, args.rounds))}   "
+                    f"page 500 {ms(timed(session, deep, args.rounds))}"
+                )
+
+            # What each request would cost without the stored scores
+            half_life = settings.RANKING_HOT_HALF_LIFE_HOURS * 3600
+            now = time.time()
+            hot = text(
+                "SELECT question_id, sum(vote_value * pow(2, (unixepoch(created_at) - :now) / :half_life)) AS score "
+                "FROM questionvote GROUP BY question_id ORDER BY score DESC LIMIT :page"
+            ).bindparams(now=now, half_life=half_life, page=PAGE)
+            rounds = max(args.rounds // 50, 3)
+            try:
+                print(f"hot            from votes        {ms(timed(session, hot, rounds))}")
+            except Exception as error:
+                print(f"hot            from votes        skipped, this SQLite lacks math functions ({error.__class__.__name__})")
+            ups = "sum(vote_value = 1)"
+            total = "count(*)"
+            z = rankings.Z
+            best = text(
+                f"SELECT question_id, ({ups} * 1.0 / {total} + {z * z} / (2.0 * {total}) - {z} * sqrt(({ups} * 1.0 / {total} "
+                f"* (1 - {ups} * 1.0 / {total}) + {z * z} / (4.0 * {total})) / {total})) / (1 + {z * z} / {total}) AS score "
+                f"FROM questionvote GROUP BY question_id ORDER BY score DESC LIMIT :page"
+            ).bindparams(page=PAGE)
+            try:
+                print(f"best           from votes        {ms(timed(session, best, rounds))}")
+            except Exception as error:
+                print(f"best           from votes        skipped, this SQLite lacks math functions ({error.__class__.__name__})")
+
+            top = session.execute(select(Question.id).order_by(Question.hot_score.desc()).limit(3)).scalars().all()
+            plan = session.execute(text(
+                "EXPLAIN QUERY PLAN SELECT id FROM question ORDER BY hot_score DESC, id DESC LIMIT 20"
+            )).all()
+            print(f"hot top 3: {top}; plan: {plan[-1][-1]}")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Mixed read/vote traffic against each database profile.
+
+    python -m benchmarks.read_vote_mix --readers 48 --voters 16 --requests 3000
+
+Seeds a throwaway SQLite file, then serves app.main:app from a uvicorn
+subprocess once per DATABASE_PROFILE. Readers load question pages while
+logged-in voters click vote buttons on the same questions; the run reports
+latency percentiles and errors (e.g. "database is locked") for both.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from app.db.profiles import PROFILES
+from app.services import passwords
+from benchmarks.load_async import free_port, serve
+from benchmarks.login_storm import PASSWORD, ms, seed
+
+
+async def drive(base_url: str, args) -> dict:
+    rng = random.Random(3)
+    results = {"read": [], "vote": []}
+    errors = {"read": 0, "vote": 0}
+    limits = httpx.Limits(max_connections=args.readers + args.voters)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        tokens = []
+        for i in range(args.voters):
+            response = await client.post("/auth/token", data={"username": f"user{i}", "password": PASSWORD})
+            response.raise_for_status()
+            tokens.append(response.json()["access_token"])
+
+        remaining = args.requests
+
+        async def reader():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                await timed("read", client.get(f"/questions/{rng.randint(1, args.questions)}"))
+
+        async def voter(token: str):
+            headers = {"Authorization": f"Bearer {token}"}
+            while remaining > 0:
+                direction = rng.choice(("up", "down"))
+                await timed("vote", client.post(f"/questions/{rng.randint(1, args.questions)}/vote/{direction}", headers=headers))
+
+        async def timed(kind: str, request):
+            started = time.perf_counter()
+            try:
+                response = await request
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            results[kind].append(time.perf_counter() - started)
+            errors[kind] += failed
+
+        started = time.perf_counter()
+        await asyncio.gather(*(reader() for _ in range(args.readers)), *(voter(token) for token in tokens))
+        elapsed = time.perf_counter() - started
+
+    return {"latencies": results, "errors": errors, "elapsed": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=48)
+    parser.add_argument("--voters", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=3000, help="page reads per run; voters run until they are done")
+    # Few questions so votes contend for the same rows
+    parser.add_argument("--questions", type=int, default=50)
+    args = parser.parse_args()
+
+    # Logins aren't what's measured here
+    passwords.pwd_context.update(bcrypt__rounds=4, bcrypt__min_rounds=4)
+
+    for profile in PROFILES:
+        with tempfile.TemporaryDirectory() as tmp:
+            database_url = f"sqlite:///{Path(tmp) / 'bench.db'}"
+            seed(database_url, args.voters, args.questions)
+            env = {**os.environ, "DATABASE_URL": database_url, "DATABASE_PROFILE": profile, "BCRYPT_ROUNDS": "4"}
+            port = free_port()
+            server = serve("app.main:app", env, port)
+            try:
+                result = asyncio.run(drive(f"http://127.0.0.1:{port}", args))
+            finally:
+                server.terminate()
+                server.wait()
+
+        for kind in ("read", "vote"):
+            latencies = result["latencies"][kind]
+            print(
+                f"{profile:10s} {kind}s: {len(latencies) / result['elapsed']:6.0f}/s  "
+                f"p50={ms(latencies, 50):7.1f}ms  p95={ms(latencies, 95):7.1f}ms  "
+                f"p99={ms(latencies, 99):7.1f}ms  errors={result['errors'][kind]}"
+            )
+
+
+if __name__ == "__main__":
+    main()
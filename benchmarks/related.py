@@ -0,0 +1,116 @@
+"""
+Cost of the related questions job and of reading its results.
+
+    python -m benchmarks.related --questions 100000
+
+Seeds a throwaway SQLite file with questions carrying 1 to 5 Zipf-distributed
+tags (some with tag votes), times a full rebuild, incremental passes after
+retagging a few questions, and the keyed lookup read_question does. For
+comparison, a plain shared-tag count (no weights) is computed live with a
+self-join on QuestionTagLink for a sample of questions.
+"""
+import argparse
+import itertools
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, delete, insert, text, update
+from sqlmodel import Session, SQLModel
+
+from app.db.migrations import upgrade
+from app.db.revisions import next_revision
+from app.models import Question, QuestionTagLink, Tag
+from app.services import related
+
+BATCH = 50_000
+
+
+def seed(engine, questions: int, tags: int):
+    rng = random.Random(1)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, tags + 1)))
+    with Session(engine) as session:
+        session.execute(insert(Tag), [{"name": f"tag{i}"} for i in range(tags)])
+        for start in range(0, questions, BATCH):
+            count = min(BATCH, questions - start)
+            session.execute(insert(Question), [{"text": f"question {start + i}"} for i in range(count)])
+            session.execute(insert(QuestionTagLink), [
+                {"question_id": question_id, "tag_id": tag_id, "vote_sum": rng.choice((0, 0, 0, 1, 3, -1))}
+                for question_id in range(start + 1, start + count + 1)
+                for tag_id in set(rng.choices(range(1, tags + 1), cum_weights=cum_weights, k=rng.randint(1, 5)))
+            ])
+        session.commit()
+
+
+def retag(engine, questions: int, tags: int, count: int, rng: random.Random):
+    """Replace the tags of `count` random questions and bump their revisions, as the tag routes do."""
+    with Session(engine) as session:
+        for question_id in rng.sample(range(1, questions + 1), count):
+            session.execute(delete(QuestionTagLink).where(QuestionTagLink.question_id == question_id))
+            session.execute(insert(QuestionTagLink), [
+                {"question_id": question_id, "tag_id": tag_id, "vote_sum": 0}
+                for tag_id in set(rng.choices(range(1, tags + 1), k=3))
+            ])
+            session.execute(update(Question).where(Question.id == question_id).values(revision=next_revision()))
+        session.commit()
+
+
+def ms(seconds: float) -> str:
+    return f"{seconds * 1000:8.2f}ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=100_000)
+    parser.add_argument("--tags", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=1000)
+    args = parser.parse_args()
+    rng = random.Random(2)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{Path(tmp) / 'bench.db'}")
+        SQLModel.metadata.create_all(engine)
+        upgrade(engine)
+        seed(engine, args.questions, args.tags)
+
+        index = related.RelatedIndex()
+        with Session(engine) as session:
+            started = time.perf_counter()
+            written = related.rebuild(session, index)
+            print(f"full rebuild         {time.perf_counter() - started:8.1f}s   {written} lists written")
+            started = time.perf_counter()
+            written = related.rebuild(session, related.RelatedIndex())
+            print(f"rebuild on restart   {time.perf_counter() - started:8.1f}s   {written} lists written")
+
+            for retagged in (1, 10, 100):
+                retag(engine, args.questions, args.tags, retagged, rng)
+                started = time.perf_counter()
+                written = related.refresh(session, index)
+                print(f"refresh, {retagged:3d} retagged {ms(time.perf_counter() - started)}   {written} lists written")
+
+            sample = [rng.randint(1, args.questions) for _ in range(args.rounds)]
+            lookups = []
+            for question_id in sample:
+                started = time.perf_counter()
+                session.exec(related.related_questions(question_id)).all()
+                lookups.append(time.perf_counter() - started)
+            lookups.sort()
+            print(f"stored lookup        p50={ms(statistics.median(lookups))} p99={ms(lookups[int(len(lookups) * 0.99)])}")
+
+            live = []
+            for question_id in sample[:20]:
+                started = time.perf_counter()
+                session.execute(text(
+                    "SELECT other.question_id, sum(1) AS shared FROM questiontaglink AS mine "
+                    "JOIN questiontaglink AS other ON other.tag_id = mine.tag_id AND other.question_id != mine.question_id "
+                    "WHERE mine.question_id = :id GROUP BY other.question_id ORDER BY shared DESC LIMIT 5"
+                ), {"id": question_id}).all()
+                live.append(time.perf_counter() - started)
+            print(f"live self-join       p50={ms(statistics.median(live))} max={ms(max(live))}")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
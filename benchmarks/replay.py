@@ -0,0 +1,333 @@
+"""
+Replays traffic captured by app/traffic.py against a local copy of the database.
+
+    TRAFFIC_CAPTURE_PATH=traffic.jsonl fastapi run app.main:app     # capture
+    python -m benchmarks.replay traffic.jsonl --database copy.db --speed 4
+
+Takes a snapshot of --database (a SQLite file, which isn't changed) in a
+temporary directory, serves app.main:app on it from a uvicorn subprocess on
+127.0.0.1 and sends the captured requests again: each at its offset from the
+first one divided by --speed, whether or not the earlier ones were answered,
+with at most --max-in-flight outstanding. Nothing leaves the machine. Ids in
+the trace are used as they are, so replay against a copy of the database the
+traffic was captured on, or of one seeded to the same size.
+
+Every captured user gets a local account, replay_<hash> with the password
+PASSWORD, created in the snapshot unless the trace has them register, and
+their own cookies: they are logged in before their first request and again
+when their access token runs out, and keep whatever cookies and ETags the app
+sends them. Hashed text in forms, queries and paths becomes tag names from the
+database, the same hash always the same words, so searches and new tags do
+real work. Live update streams are not replayed.
+
+Reports throughput, latency percentiles next to the captured ones, overall and
+for the busiest routes, the share of 4xx and 5xx answers and failed requests,
+statements that failed with "database is locked" (db_lock_errors_total), and
+how late requests went out when the client or the server fell behind.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from pathlib import Path
+from typing import Optional
+
+import httpx
+from sqlalchemy import create_engine, insert, select
+
+from app.models import Tag, User
+from app.services import passwords
+from benchmarks.load_async import free_port, serve
+from benchmarks.login_storm import PASSWORD
+from benchmarks.seed import vocabulary
+
+LOGIN = "/auth/users/login"
+REGISTER = "/auth/users/register"
+HASHED = re.compile(r"~(\d+):([0-9a-f]+)")
+LOCK_ERRORS = re.compile(r"^db_lock_errors_total (\S+)$", re.MULTILINE)
+
+
+def load(path: Path, limit: Optional[int]) -> tuple[list[dict], Counter]:
+    """Replayable traces in time order, and how many of each kind were left out."""
+    traces, skipped = [], Counter()
+    with open(path) as file:
+        for line in file:
+            trace = json.loads(line)
+            if trace["r"] == "unmatched":
+                skipped["unmatched routes"] += 1
+            elif trace["r"].endswith("/events"):
+                skipped["live update streams"] += 1
+            else:
+                traces.append(trace)
+    # Workers append in batches, so lines are only roughly in order
+    traces.sort(key=lambda trace: trace["t"])
+    return traces[:limit] if limit else traces, skipped
+
+
+def snapshot(source: Path, target: Path):
+    # The backup API also copies what is still in the WAL of a live database
+    live, copy = sqlite3.connect(source), sqlite3.connect(target)
+    try:
+        live.backup(copy)
+    finally:
+        live.close()
+        copy.close()
+
+
+def prepare(database_url: str, traces: list[dict]) -> list[str]:
+    """Create the captured users that don't register during the trace; returns the tag names."""
+    registered, first = set(), {}
+    for trace in traces:
+        if "i" in trace and trace["i"] not in first:
+            first[trace["i"]] = trace
+            if trace["r"] == REGISTER and trace["s"] < 400:
+                registered.add(trace["i"])
+
+    engine = create_engine(database_url)
+    hashed_password = passwords.pwd_context.hash(PASSWORD)
+    with engine.begin() as connection:
+        accounts = [
+            {"username": f"replay_{identity}", "email": f"replay_{identity}@replay.invalid", "hashed_password": hashed_password}
+            for identity in first if identity not in registered
+        ]
+        if accounts:
+            connection.execute(insert(User.__table__).prefix_with("OR IGNORE"), accounts)
+        names = connection.execute(select(Tag.name).order_by(Tag.id).limit(10_000)).scalars().all()
+    engine.dispose()
+    return names or vocabulary(2000)
+
+
+class Visitor:
+    """One captured user: their account, cookies and ETags."""
+
+    def __init__(self, identity: str):
+        self.username = f"replay_{identity}"
+        self.email = f"{self.username}@replay.invalid"
+        self.cookies: dict[str, str] = {}
+        self.etags: dict[str, str] = {}
+        self.signed_in = False
+        self.lock = asyncio.Lock()
+
+    def headers(self, url: str, conditional: bool) -> dict:
+        headers = {}
+        if self.cookies:
+            # Set by hand: the app's cookies are Secure and the replay is plain http
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        if conditional and url in self.etags:
+            headers["If-None-Match"] = self.etags[url]
+        return headers
+
+    def remember(self, url: str, response: httpx.Response):
+        for header in response.headers.get_list("set-cookie"):
+            name, _, value = header.split(";", 1)[0].partition("=")
+            if value and value != '""' and "max-age=0" not in header.lower():
+                self.cookies[name.strip()] = value
+            else:
+                self.cookies.pop(name.strip(), None)
+        if "etag" in response.headers:
+            self.etags[url] = response.headers["etag"]
+
+
+class Replay:
+    def __init__(self, client: httpx.AsyncClient, words: list[str], args):
+        self.client = client
+        self.words = words
+        self.args = args
+        self.visitors: dict[str, Visitor] = {}
+        # route -> [(replayed seconds, captured seconds)]
+        self.latencies: dict[str, list[tuple[float, float]]] = defaultdict(list)
+        self.statuses: Counter = Counter()
+        self.changed_status = 0
+        self.failed: Counter = Counter()
+        self.lags: list[float] = []
+        self.logins = 0
+
+    def text(self, value: str, separator: str = " ") -> str:
+        def words(match: re.Match) -> str:
+            start = int(match[2], 16)
+            return separator.join(
+                self.words[(start + index * 7919) % len(self.words)] for index in range(max(int(match[1]), 1))
+            )
+        return HASHED.sub(words, value)
+
+    def request(self, trace: dict, visitor: Optional[Visitor]) -> tuple[str, dict, Optional[dict]]:
+        path = self.text(trace["p"], "-")
+        params = {name: self.text(value) for name, value in trace.get("q", {}).items()}
+        form = None
+        if "f" in trace:
+            form = {name: self.text(value) for name, value in trace["f"].items()}
+            if "username" in form:
+                form["username"] = visitor.username
+                form["password"] = PASSWORD
+            if "email" in form:
+                form["email"] = visitor.email
+        return path, params, form
+
+    async def sign_in(self, visitor: Visitor):
+        async with visitor.lock:
+            if visitor.signed_in:
+                return
+            response = await self.client.post(LOGIN, data={"username": visitor.username, "password": PASSWORD})
+            if response.status_code >= 400:
+                raise RuntimeError(f"{visitor.username} could not sign in: {response.status_code}")
+            visitor.remember(LOGIN, response)
+            visitor.signed_in = True
+            self.logins += 1
+
+    async def send(self, trace: dict, visitor: Optional[Visitor]) -> httpx.Response:
+        path, params, form = self.request(trace, visitor)
+        url = str(httpx.URL(path, params=params))
+        headers = visitor.headers(url, "c" in trace) if visitor else {}
+        if "x" in trace:
+            headers["HX-Request"] = "true"
+        response = await self.client.request(trace["m"], path, params=params, data=form, headers=headers)
+        if visitor:
+            visitor.remember(url, response)
+        return response
+
+    async def one(self, trace: dict, semaphore: asyncio.Semaphore):
+        try:
+            visitor = None
+            if "i" in trace:
+                visitor = self.visitors.setdefault(trace["i"], Visitor(trace["i"]))
+                if trace["r"] in (LOGIN, REGISTER):
+                    visitor.signed_in = trace["r"] == LOGIN
+                elif not visitor.signed_in:
+                    await self.sign_in(visitor)
+            started = time.perf_counter()
+            response = await self.send(trace, visitor)
+            redirect = response.headers.get("hx-redirect") or response.headers.get("location") or ""
+            if visitor and visitor.signed_in and redirect.startswith(LOGIN) and trace["s"] != 302:
+                # The access token ran out here but not in the capture; sign in again
+                visitor.signed_in = False
+                await self.sign_in(visitor)
+                started = time.perf_counter()
+                response = await self.send(trace, visitor)
+            self.latencies[trace["r"]].append((time.perf_counter() - started, trace["d"] / 1000))
+            self.statuses[response.status_code // 100] += 1
+            self.changed_status += response.status_code // 100 != trace["s"] // 100
+        except (httpx.TransportError, RuntimeError) as error:
+            self.failed[type(error).__name__] += 1
+        finally:
+            semaphore.release()
+
+    async def run(self, traces: list[dict]) -> float:
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.args.max_in_flight)
+        tasks = set()
+        first = traces[0]["t"]
+        started = loop.time()
+        for trace in traces:
+            due = started + (trace["t"] - first) / self.args.speed
+            if due > loop.time():
+                await asyncio.sleep(due - loop.time())
+            await semaphore.acquire()
+            self.lags.append(loop.time() - due)
+            task = asyncio.create_task(self.one(trace, semaphore))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        return loop.time() - started
+
+
+async def lock_errors(client: httpx.AsyncClient) -> float:
+    match = LOCK_ERRORS.search((await client.get("/metrics")).text)
+    return float(match[1]) if match else 0
+
+
+def percentiles(values: list[float]) -> tuple[float, float, float]:
+    if len(values) < 2:
+        return (values[0],) * 3 if values else (0, 0, 0)
+    cuts = statistics.quantiles(values, n=100)
+    return statistics.median(values), cuts[94], cuts[98]
+
+
+def milliseconds(values: list[float]) -> str:
+    return "  ".join(f"{value * 1000:8.1f}" for value in percentiles(values))
+
+
+def report(replay: Replay, traces: list[dict], skipped: Counter, elapsed: float, locks: float, args):
+    done = sum(replay.statuses.values())
+    sent = done + sum(replay.failed.values())
+    span = traces[-1]["t"] - traces[0]["t"]
+    print(
+        f"replayed {sent} requests from {len(replay.visitors)} users in {elapsed:.1f}s "
+        f"(captured over {span:.1f}s, --speed {args.speed:g}): {done / elapsed:.1f} req/s"
+    )
+    print(f"{'':<44} {'count':>6}  {'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}   captured p50 / p95 / p99")
+    routes = sorted(replay.latencies.items(), key=lambda item: -len(item[1]))
+    every = [pair for _, pairs in routes for pair in pairs]
+    for route, pairs in [("all", every), *routes[:args.routes]]:
+        print(
+            f"{route[:44]:<44} {len(pairs):6d}  {milliseconds([now for now, _ in pairs])}  "
+            f" {milliseconds([then for _, then in pairs])}"
+        )
+    print(
+        "answers: " + "  ".join(f"{status}xx {count / max(sent, 1):.1%}" for status, count in sorted(replay.statuses.items()))
+        + f"  failed {sum(replay.failed.values()) / max(sent, 1):.1%} {dict(replay.failed) or ''}"
+        + f"  status class differs from the capture: {replay.changed_status}"
+    )
+    print(f"database lock errors: {locks:g} ({locks / max(sent, 1):.2%} of requests)")
+    lag_p50, _, lag_p99 = percentiles(replay.lags)
+    print(
+        f"sent late: p50 {lag_p50 * 1000:.1f}ms  p99 {lag_p99 * 1000:.1f}ms  max {max(replay.lags) * 1000:.1f}ms; "
+        f"{replay.logins} sign-ins added"
+    )
+    if skipped:
+        print("not replayed: " + ", ".join(f"{count} {kind}" for kind, count in skipped.items()))
+
+
+async def drive(base_url: str, traces: list[dict], words: list[str], args):
+    limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+    # Cookies are kept per visitor; the client's own jar takes none
+    jar = CookieJar(DefaultCookiePolicy(allowed_domains=[]))
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout, cookies=jar) as client:
+        before = await lock_errors(client)
+        replay = Replay(client, words, args)
+        elapsed = await replay.run(traces)
+        locks = await lock_errors(client) - before
+    return replay, elapsed, locks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("traces", type=Path, help="file written with TRAFFIC_CAPTURE_PATH")
+    parser.add_argument("--database", type=Path, required=True, help="SQLite file to replay against; a snapshot is used")
+    parser.add_argument("--speed", type=float, default=1.0, help="2 sends the requests twice as fast as captured")
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    parser.add_argument("--limit", type=int, help="replay only the first LIMIT requests")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--routes", type=int, default=10, help="busiest routes to list")
+    args = parser.parse_args()
+
+    traces, skipped = load(args.traces, args.limit)
+    if not traces:
+        raise SystemExit(f"{args.traces} has no requests to replay")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "replay.db"
+        started = time.perf_counter()
+        snapshot(args.database, path)
+        database_url = f"sqlite:///{path}"
+        words = prepare(database_url, traces)
+        print(f"{len(traces)} requests; database ready in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+        port = free_port()
+        server = serve("app.main:app", {**os.environ, "DATABASE_URL": database_url, "TRAFFIC_CAPTURE_PATH": ""}, port)
+        try:
+            replay, elapsed, locks = asyncio.run(drive(f"http://127.0.0.1:{port}", traces, words, args))
+        finally:
+            server.terminate()
+            server.wait()
+    report(replay, traces, skipped, elapsed, locks, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+Latency, queries and memory of each route, against a stored baseline.
+
+    python -m benchmarks.routes                          # compare with benchmarks/baselines/routes.json
+    python -m benchmarks.routes --save-baseline          # after a change meant to move the numbers
+    python -m benchmarks.routes --database seeded.db     # a SQLite file from benchmarks.seed, e.g. with 10M votes
+
+Seeds a throwaway SQLite file with benchmarks.seed (--votes) or copies
+--database, then drives app.main:app in-process over httpx's ASGI transport,
+with the background jobs off. Every route in ROUTES is requested --requests
+times by signed-in users, picked like the seeded voters were and on questions
+picked like the seeded votes were, then --memory-requests more times with
+tracemalloc on. Per route it reports:
+- latency percentiles
+- queries per request, from the app's query instrumentation once the whole
+  body is read, so streamed pages count the queries they make mid-body
+- peak memory allocated while serving a request, from tracemalloc
+and the change from the baseline. A route is flagged, and the exit status is
+1, if it runs half a query more per request, its memory grew by more than
+--memory-tolerance or its p50 latency by more than --tolerance. Query counts
+and memory barely move from run to run (caches expire on the clock); latency
+moves by tens of percent on a busy or virtualized machine, hence the loose
+default. Compare runs made
+with the same options on the same machine; the baseline records the options
+it was made with.
+
+Logins use BCRYPT_ROUNDS=4 unless it is set, so they time the route rather
+than bcrypt.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import httpx
+
+BASELINE = Path(__file__).parent / "baselines" / "routes.json"
+WARMUP = 10
+
+
+def configure(database_url: str):
+    # Settings are read on import, so this runs before anything from app is imported
+    os.environ.update({
+        "DATABASE_URL": database_url,
+        "RELATED_REFRESH_SECONDS": "0",
+        "TAG_INDEX_REFRESH_SECONDS": "0",
+        "RANKING_REBASE_SECONDS": "0",
+        "SLOW_QUERY_MS": "100000",
+    })
+    os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+
+def queries_served() -> int:
+    from app.db.instrumentation import route_stats
+
+    # Requests are sent one at a time, so the change across one is its count
+    return sum(totals.queries for totals in list(route_stats.values()))
+
+
+class Workload:
+    """Who sends which request: Zipf-skewed users, questions and question-tag pairs."""
+
+    def __init__(self, session, users: int, rng: random.Random):
+        from sqlmodel import func, select
+
+        from app.models import Question, QuestionTagLink, User
+        from benchmarks.seed import PASSWORD, Zipf
+
+        self.rng = rng
+        self.password = PASSWORD
+        self.user_count = session.exec(select(func.count()).select_from(User)).one()
+        self.questions = Zipf(session.exec(select(func.max(Question.id))).one(), 1.0)
+        self.voters = Zipf(self.user_count, 1.0)
+        self.usernames = [f"user{i}" for i in self.voters.distinct(rng, users)]
+        drawn = {question + 1 for question in self.questions.draw(rng, 500)}
+        self.links = session.exec(
+            select(QuestionTagLink.question_id, QuestionTagLink.tag_id).where(QuestionTagLink.question_id.in_(drawn))
+        ).all()
+        self.headers: list[dict] = []
+
+    def question(self) -> int:
+        return self.questions.draw(self.rng, 1)[0] + 1
+
+    def user(self) -> dict:
+        return self.rng.choice(self.headers)
+
+    def direction(self) -> str:
+        return self.rng.choice(("up", "down"))
+
+
+# name -> (method, path, form) of the next request
+ROUTES = {
+    "front page": lambda w: ("GET", "/", None),
+    "question": lambda w: ("GET", f"/questions/{w.question()}", None),
+    "list top": lambda w: ("GET", "/questions/?limit=20", None),
+    "list hot": lambda w: ("GET", "/questions/?sort=hot&limit=20", None),
+    "vote up": lambda w: ("POST", f"/questions/{w.question()}/vote/up", None),
+    "vote down": lambda w: ("POST", f"/questions/{w.question()}/vote/down", None),
+    "tag vote": lambda w: ("POST", "/questions/{}/tag/{}/vote/{}".format(*w.rng.choice(w.links), w.direction()), None),
+    "login": lambda w: ("POST", "/auth/token", {"username": w.rng.choice(w.usernames), "password": w.password}),
+}
+
+
+async def send(client: httpx.AsyncClient, workload: Workload, route: str) -> httpx.Response:
+    method, path, form = ROUTES[route](workload)
+    headers = None if form else workload.user()
+    response = await client.request(method, path, data=form, headers=headers)
+    if response.status_code >= 400:
+        raise RuntimeError(f"{route}: {method} {path} answered {response.status_code}")
+    return response
+
+
+async def measure(client: httpx.AsyncClient, workload: Workload, route: str, args) -> dict:
+    for _ in range(WARMUP):
+        await send(client, workload, route)
+
+    # Start each route from the same collector state; what's alive now is
+    # startup and the other routes' caches, not this route's garbage
+    gc.collect()
+    gc.freeze()
+    latencies, queries = [], []
+    for _ in range(args.requests):
+        served = queries_served()
+        started = time.perf_counter()
+        await send(client, workload, route)
+        latencies.append(time.perf_counter() - started)
+        queries.append(queries_served() - served)
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(args.memory_requests):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            await send(client, workload, route)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p95_ms": round(percentiles[94] * 1000, 3),
+        "p99_ms": round(percentiles[98] * 1000, 3),
+        "queries": round(statistics.mean(queries), 2),
+        "max_queries": max(queries),
+        "peak_kib": round(statistics.median(peaks) / 1024, 1),
+    }
+
+
+async def run(args) -> dict:
+    from sqlmodel import Session
+
+    from app.db.database import engine
+    from app.main import app
+
+    with Session(engine) as session:
+        workload = Workload(session, args.users, random.Random(args.seed))
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            for username in workload.usernames:
+                response = await client.post("/auth/token", data={"username": username, "password": workload.password})
+                response.raise_for_status()
+                workload.headers.append({"Authorization": f"Bearer {response.json()['access_token']}"})
+            for route in args.routes or ROUTES:
+                results[route] = await measure(client, workload, route, args)
+                print(f"  {route}: done", file=sys.stderr)
+    return results
+
+
+def change(now: float, before: float) -> str:
+    if not before:
+        return "   n/a"
+    return f"{(now - before) / before * 100:+5.0f}%"
+
+
+def report(results: dict, baseline: dict | None, tolerance: float, memory_tolerance: float) -> list[str]:
+    """Print the table; returns the routes that got worse."""
+    regressions = []
+    print(f"{'route':<12} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'max':>4} {'KiB':>8}", end="")
+    print("   vs baseline: p50 / queries / KiB" if baseline else "")
+    for route, now in results.items():
+        line = (
+            f"{route:<12} {now['p50_ms']:8.2f} {now['p95_ms']:8.2f} {now['p99_ms']:8.2f} "
+            f"{now['queries']:8.2f} {now['max_queries']:4d} {now['peak_kib']:8.1f}"
+        )
+        before = (baseline or {}).get(route)
+        if before:
+            worse = (
+                now["p50_ms"] > before["p50_ms"] * (1 + tolerance)
+                or now["peak_kib"] > before["peak_kib"] * (1 + memory_tolerance)
+                or now["queries"] >= before["queries"] + 0.5
+            )
+            line += (
+                f"   {change(now['p50_ms'], before['p50_ms'])} / {now['queries'] - before['queries']:+.2f}"
+                f" / {change(now['peak_kib'], before['peak_kib'])}{'   WORSE' if worse else ''}"
+            )
+            if worse:
+                regressions.append(route)
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", help="SQLite file seeded by benchmarks.seed; copied, so it isn't changed")
+    parser.add_argument("--votes", type=int, default=100_000, help="size of the seeded database without --database")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--memory-requests", type=int, default=20)
+    parser.add_argument("--users", type=int, default=50, help="signed-in users sending the requests")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--routes", nargs="*", choices=list(ROUTES), help="default: all")
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="growth in p50 latency that counts as worse")
+    parser.add_argument("--memory-tolerance", type=float, default=0.1, help="growth in memory that counts as worse")
+    args = parser.parse_args()
+
+    options = {
+        "database": Path(args.database).name if args.database else None,
+        "votes": None if args.database else args.votes,
+        "requests": args.requests,
+        "users": args.users,
+        "seed": args.seed,
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "routes.db"
+        configure(f"sqlite:///{path}")
+        if args.database:
+            shutil.copy(args.database, path)
+        else:
+            from sqlalchemy import create_engine
+
+            from app import settings
+            from app.db.profiles import apply_profile
+            from benchmarks.seed import Scale, seed
+
+            started = time.perf_counter()
+            seeding = create_engine(f"sqlite:///{path}")
+            apply_profile(seeding, settings.DATABASE_PROFILE)
+            seed(seeding, Scale.from_votes(args.votes), args.seed, log=lambda line: None)
+            seeding.dispose()
+            print(f"seeded {args.votes} votes in {time.perf_counter() - started:.0f}s", file=sys.stderr)
+        results = asyncio.run(run(args))
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps({
+            "options": options,
+            "machine": {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "cpus": os.cpu_count()},
+            "routes": results,
+        }, indent=2) + "\n")
+        report(results, None, args.tolerance, args.memory_tolerance)
+        print(f"saved to {args.baseline}")
+        return
+
+    baseline = None
+    if args.baseline.exists():
+        stored = json.loads(args.baseline.read_text())
+        if stored["options"] != options:
+            print(f"warning: the baseline was made with {stored['options']}, this run with {options}")
+        baseline = stored["routes"]
+    regressions = report(results, baseline, args.tolerance, args.memory_tolerance)
+    if regressions:
+        print(f"worse than the baseline: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
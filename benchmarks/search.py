@@ -0,0 +1,124 @@
+"""
+Full-text search latency on a large database.
+
+    python -m benchmarks.search --questions 1000000
+
+Seeds a throwaway SQLite file with questions made of Zipf-distributed words
+(so a few words are in most questions and most words in few), builds the search
+index and times search_question_ids for common, mid-frequency and rare words,
+two-word queries, tag names and typeahead queries ending in a 2-4 letter prefix. A LIKE scan over question.text is
+timed once for comparison.
+"""
+import argparse
+import itertools
+import random
+import statistics
+import string
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, insert, text
+from sqlmodel import Session, SQLModel
+
+from app.db.migrations import upgrade
+from app.models import Question, QuestionTagLink, Tag
+from app.services import search
+
+BATCH = 50_000
+
+
+def vocabulary(size: int) -> list[str]:
+    """`size` distinct made-up words of 3 to 9 letters, most frequent first."""
+    rng = random.Random(0)
+    words = {}
+    while len(words) < size:
+        words["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9)))] = None
+    return list(words)
+
+
+def seed(engine, questions: int, words: list[str], tags: int):
+    rng = random.Random(1)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    with Session(engine) as session:
+        session.execute(insert(Tag), [{"name": f"{words[i]}-{words[-i - 1]}"} for i in range(tags)])
+        for start in range(0, questions, BATCH):
+            count = min(BATCH, questions - start)
+            session.execute(insert(Question), [
+                {"text": " ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(6, 14))), "vote_sum": rng.randint(-5, 50)}
+                for _ in range(count)
+            ])
+            session.execute(insert(QuestionTagLink), [
+                {"question_id": question_id, "tag_id": rng.randint(1, tags), "vote_sum": 0}
+                for question_id in range(start + 1, start + count + 1)
+            ])
+        session.commit()
+
+
+def timed(session: Session, queries: list[str], rounds: int, prefix: bool = False) -> list[float]:
+    latencies = []
+    for query in itertools.islice(itertools.cycle(queries), rounds):
+        started = time.perf_counter()
+        search.search_question_ids(session, query, prefix=prefix)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=1_000_000)
+    parser.add_argument("--words", type=int, default=20_000)
+    parser.add_argument("--tags", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=500)
+    args = parser.parse_args()
+
+    words = vocabulary(args.words)
+    rng = random.Random(2)
+    # (queries, typeahead)
+    cases = {
+        "common word": (words[:10], False),
+        "mid word": (words[100:1000], False),
+        "rare word": (words[10000:], False),
+        "two words": ([f"{rng.choice(words[:100])} {rng.choice(words[:1000])}" for _ in range(200)], False),
+        "tag": ([f"{words[i]}-{words[-i - 1]}" for i in range(args.tags)], False),
+        "typed 2": ([word[:2] for word in rng.sample(words, 200)], True),
+        "typed 3": ([word[:3] for word in rng.sample(words, 200)], True),
+        "typed 4": ([word[:4] for word in rng.sample(words, 200)], True),
+        "typed word": ([f"{rng.choice(words[:1000])} {word[:3]}" for word in rng.sample(words, 200)], True),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{Path(tmp) / 'bench.db'}")
+        SQLModel.metadata.create_all(engine)
+        upgrade(engine)
+
+        started = time.perf_counter()
+        seed(engine, args.questions, words, args.tags)
+        print(f"seeded {args.questions} questions in {time.perf_counter() - started:.0f}s")
+        started = time.perf_counter()
+        with Session(engine) as session:
+            search.rebuild(session)
+            session.commit()
+        print(f"built the search index in {time.perf_counter() - started:.0f}s")
+
+        with Session(engine) as session:
+            timed(session, words[:100], 100)  # warm the page cache
+            for label, (queries, typeahead) in cases.items():
+                rng.shuffle(queries)
+                latencies = sorted(timed(session, queries, args.rounds, typeahead))
+                print(
+                    f"{label:12s} p50={statistics.median(latencies) * 1000:6.2f}ms "
+                    f"p99={latencies[int(len(latencies) * 0.99)] * 1000:6.2f}ms"
+                )
+
+            started = time.perf_counter()
+            session.execute(
+                text("SELECT id FROM question WHERE text LIKE :pattern ORDER BY vote_sum DESC LIMIT 20"),
+                {"pattern": f"%{words[15000]}%"},
+            ).all()
+            print(f"{'LIKE scan':12s} {(time.perf_counter() - started) * 1000:6.2f}ms")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+Synthetic datasets with realistic skew, from 10k to 10M votes.
+
+    python -m benchmarks.seed --votes 1000000 --database sqlite:///seeded.db
+
+Fills an empty database with users, questions, tags, question-tag links,
+question votes and tag votes. Everything is Zipf-distributed with exponent
+--skew: a few questions get most of the votes, a few tags are on most
+questions and a few users cast most votes and ask most questions. Unless
+given, the other sizes follow from --votes: a question per 10 votes, a user
+per 20 votes, a tag per 20 questions and a tag vote per 5 votes. The same
+--seed always produces the same data.
+
+Vote counters are written along with the rows; the ranking scores, the search
+index and the related questions are then built as the app would have, so
+every page works. All users have the password PASSWORD.
+"""
+import argparse
+import itertools
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import Engine, create_engine, func, insert
+from sqlmodel import Session, SQLModel, select
+
+from app import settings
+from app.db.migrations import upgrade
+from app.db.profiles import apply_profile
+from app.models import Question, QuestionTagLink, QuestionTagVote, QuestionVote, Tag, User
+from app.services import passwords, rankings, related, search
+from benchmarks.login_storm import PASSWORD
+
+# Questions generated per transaction, and rows held before they are written
+BLOCK = 2000
+FLUSH_ROWS = 50_000
+SYLLABLES = ["ka", "lo", "mi", "ra", "te", "su", "no", "vi", "de", "pa", "zo", "ri", "gu", "he", "ba", "lu"]
+
+
+@dataclass
+class Scale:
+    votes: int
+    questions: int
+    users: int
+    tags: int
+    tag_votes: int
+    skew: float = 1.0
+    days: int = 30
+
+    @classmethod
+    def from_votes(cls, votes: int, questions: Optional[int] = None, users: Optional[int] = None,
+                   tags: Optional[int] = None, tag_votes: Optional[int] = None, **options) -> "Scale":
+        questions = questions or max(votes // 10, 1)
+        return cls(
+            votes=votes,
+            questions=questions,
+            users=users or max(votes // 20, 10),
+            tags=tags or max(questions // 20, 10),
+            tag_votes=votes // 5 if tag_votes is None else tag_votes,
+            **options,
+        )
+
+
+class Zipf:
+    """Draws 0..n-1, k with probability proportional to 1 / (k + 1) ** skew."""
+
+    def __init__(self, n: int, skew: float):
+        self.population = range(n)
+        self.cum_weights = list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(n)))
+
+    def draw(self, rng: random.Random, k: int) -> list[int]:
+        return rng.choices(self.population, cum_weights=self.cum_weights, k=k)
+
+    def distinct(self, rng: random.Random, k: int) -> list[int]:
+        """k different values, the likely ones first in line."""
+        n = len(self.population)
+        k = min(k, n)
+        if k * 2 >= n:
+            return rng.sample(self.population, k)
+        chosen = set()
+        for _ in range(3):
+            chosen.update(self.draw(rng, k - len(chosen)))
+            if len(chosen) == k:
+                return list(chosen)
+        # Only the most voted questions get here; the tail is too unlikely to
+        # draw, so top up uniformly
+        while len(chosen) < k:
+            chosen.add(rng.randrange(n))
+        return list(chosen)
+
+
+def vocabulary(size: int) -> list[str]:
+    words = ["".join(parts) for length in (2, 3) for parts in itertools.product(SYLLABLES, repeat=length)]
+    random.Random(0).shuffle(words)
+    return [words[i % len(words)] + (str(i // len(words)) if i >= len(words) else "") for i in range(size)]
+
+
+def spread(rng: random.Random, zipf: Zipf, total: int, cap: int) -> list[int]:
+    """How many of `total` draws land on each value, at most cap each."""
+    counts = [0] * len(zipf.population)
+    for start in range(0, total, 1_000_000):
+        for value, count in Counter(zipf.draw(rng, min(1_000_000, total - start))).items():
+            counts[value] += count
+    return [min(count, cap) for count in counts]
+
+
+def seed(engine: Engine, scale: Scale, rng_seed: int = 1, log=print) -> dict:
+    """Fill an empty database; returns how many rows of each kind were written."""
+    rng = random.Random(rng_seed)
+    SQLModel.metadata.create_all(engine)
+    upgrade(engine)
+    with Session(engine) as session:
+        if session.execute(select(func.count()).select_from(Question)).scalar():
+            raise SystemExit("The database already has questions; seed an empty one")
+
+    started = time.perf_counter()
+    users = Zipf(scale.users, scale.skew)
+    tags = Zipf(scale.tags, scale.skew)
+    words = vocabulary(max(scale.tags, 2000))
+    text_words = Zipf(len(words), scale.skew)
+    now = datetime.utcnow()
+    seconds = scale.days * 86400
+
+    # One hash for everyone: seeding shouldn't take hours of bcrypt
+    hashed_password = passwords.pwd_context.hash(PASSWORD)
+    with Session(engine) as session:
+        for start in range(0, scale.users, FLUSH_ROWS):
+            session.execute(insert(User.__table__), [
+                {"id": i + 1, "username": f"user{i}", "email": f"user{i}@example.com", "hashed_password": hashed_password}
+                for i in range(start, min(start + FLUSH_ROWS, scale.users))
+            ])
+        session.execute(insert(Tag.__table__), [
+            {"id": i + 1, "name": words[i], "normalized_name": words[i]} for i in range(scale.tags)
+        ])
+        session.commit()
+
+    question_votes = spread(rng, Zipf(scale.questions, scale.skew), scale.votes, scale.users)
+    tag_vote_share = scale.tag_votes / max(scale.votes, 1)
+    written = Counter(user=scale.users, tag=scale.tags)
+    # Questions before the links and votes that refer to them
+    pending = {Question: [], QuestionTagLink: [], QuestionVote: [], QuestionTagVote: []}
+
+    def write(session: Session):
+        for model, rows in pending.items():
+            for start in range(0, len(rows), FLUSH_ROWS):
+                session.execute(insert(model.__table__), rows[start:start + FLUSH_ROWS])
+            written[model.__tablename__] += len(rows)
+            rows.clear()
+
+    for block in range(0, scale.questions, BLOCK):
+        with Session(engine) as session:
+            for index in range(block, min(block + BLOCK, scale.questions)):
+                question_id = index + 1
+                # Some questions are liked, some divisive
+                up_share = rng.betavariate(5, 2)
+                vote_sum = 0
+                for user in users.distinct(rng, question_votes[index]):
+                    value = 1 if rng.random() < up_share else -1
+                    vote_sum += value
+                    pending[QuestionVote].append({
+                        "user_id": user + 1, "question_id": question_id, "vote_value": value,
+                        "created_at": now - timedelta(seconds=rng.uniform(0, seconds)),
+                    })
+                text = " ".join(words[i] for i in text_words.draw(rng, rng.randint(5, 14)))
+                pending[Question].append({
+                    "id": question_id, "text": text.capitalize() + "?", "created_by": users.draw(rng, 1)[0] + 1,
+                    "vote_sum": vote_sum, "revision": question_id,
+                })
+
+                question_tags = tags.distinct(rng, rng.randint(1, 4))
+                # Tag votes follow the question's votes
+                expected = question_votes[index] * tag_vote_share
+                count = int(expected) + (rng.random() < expected % 1)
+                per_tag = Counter(rng.choices(question_tags, k=count))
+                for tag in question_tags:
+                    tag_up_share = rng.betavariate(3, 2)
+                    tag_sum = 0
+                    for user in users.distinct(rng, per_tag[tag]):
+                        value = 1 if rng.random() < tag_up_share else -1
+                        tag_sum += value
+                        pending[QuestionTagVote].append({
+                            "user_id": user + 1, "question_id": question_id, "tag_id": tag + 1, "vote_value": value,
+                            "created_at": now - timedelta(seconds=rng.uniform(0, seconds)),
+                        })
+                    pending[QuestionTagLink].append({"question_id": question_id, "tag_id": tag + 1, "vote_sum": tag_sum})
+                # The most voted questions come first and have most of the votes
+                if len(pending[QuestionVote]) + len(pending[QuestionTagVote]) >= FLUSH_ROWS:
+                    write(session)
+            write(session)
+            session.commit()
+        if block and block % (BLOCK * 50) == 0:
+            log(f"  {block} questions, {written['questionvote']} votes, {time.perf_counter() - started:.0f}s")
+    log(f"rows written in {time.perf_counter() - started:.1f}s: {dict(written)}")
+
+    for name, build in (
+        ("ranking scores", rankings.rebuild),
+        ("search index", search.rebuild),
+        ("related questions", lambda session: related.rebuild(
+            session, related.RelatedIndex(settings.RELATED_QUESTIONS, settings.RELATED_MAX_POSTINGS)
+        )),
+    ):
+        step = time.perf_counter()
+        with Session(engine) as session:
+            build(session)
+            session.commit()
+        log(f"{name} built in {time.perf_counter() - step:.1f}s")
+    return dict(written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=settings.DATABASE_URL, help="URL of an empty database")
+    parser.add_argument("--votes", type=int, default=100_000)
+    parser.add_argument("--questions", type=int)
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--tags", type=int)
+    parser.add_argument("--tag-votes", type=int)
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent")
+    parser.add_argument("--days", type=int, default=30, help="votes are spread over this many days")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    scale = Scale.from_votes(
+        args.votes, args.questions, args.users, args.tags, args.tag_votes, skew=args.skew, days=args.days
+    )
+    print(scale)
+    engine = create_engine(args.database)
+    apply_profile(engine, settings.DATABASE_PROFILE)
+    seed(engine, scale, args.seed)
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Time to first byte and peak memory of streamed vs. buffered pages.
+
+    python -m benchmarks.streaming --requests 200
+
+Seeds a throwaway SQLite file and serves app.main:app from a uvicorn
+subprocess with STREAM_HTML=0 and =1, timing the first body byte and the whole
+response of the front page and a 50-question list page. Peak Python memory per
+request is measured with tracemalloc in a child process that calls the app
+in-process (`--peak-memory PATH`).
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import httpx
+
+from benchmarks.load_async import free_port, seed, serve
+
+PAGES = {"front page": "/", "list of 50": "/questions/?limit=50"}
+
+
+async def time_page(client: httpx.AsyncClient, path: str) -> tuple[float, float]:
+    started = time.perf_counter()
+    async with client.stream("GET", path) as response:
+        first_byte = None
+        async for _ in response.aiter_raw():
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+    return first_byte, time.perf_counter() - started
+
+
+async def drive(base_url: str, path: str, requests: int) -> tuple[list[float], list[float]]:
+    first_bytes, totals = [], []
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        await time_page(client, path)  # warm up
+        for _ in range(requests):
+            first_byte, total = await time_page(client, path)
+            first_bytes.append(first_byte)
+            totals.append(total)
+    return first_bytes, totals
+
+
+def peak_memory(path: str, env: dict) -> int:
+    """Peak traced allocation while serving `path` once, in bytes."""
+    command = [sys.executable, "-m", "benchmarks.streaming", "--peak-memory", path]
+    return int(subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout)
+
+
+def measure_peak_memory(path: str) -> int:
+    # Settings are read on import, so this runs in a fresh process with the
+    # benchmark's environment
+    from app.main import app
+
+    async def one():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            await client.get(path)  # warm caches so only the request itself is traced
+            tracemalloc.start()
+            await client.get(path)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        return peak
+
+    return asyncio.run(one())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--questions", type=int, default=2000)
+    parser.add_argument("--tags", type=int, default=100)
+    parser.add_argument("--peak-memory", metavar="PATH", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.peak_memory:
+        print(measure_peak_memory(args.peak_memory))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = f"sqlite:///{Path(tmp) / 'bench.db'}"
+        seed(database_url, args.questions, args.tags)
+        os.environ["DATABASE_URL"] = database_url
+        # The fragment cache would hide most of the rendering either way
+        os.environ["FRAGMENT_CACHE_SIZE"] = "0"
+
+        for stream in (False, True):
+            env = {**os.environ, "STREAM_HTML": "1" if stream else "0"}
+            port = free_port()
+            server = serve("app.main:app", env, port)
+            try:
+                for label, path in PAGES.items():
+                    first_bytes, totals = asyncio.run(drive(f"http://127.0.0.1:{port}", path, args.requests))
+                    print(
+                        f"{'streamed' if stream else 'buffered':9s} {label:11s} "
+                        f"first byte p50={statistics.median(first_bytes) * 1000:6.1f}ms  "
+                        f"total p50={statistics.median(totals) * 1000:6.1f}ms  "
+                        f"peak memory={peak_memory(path, env) / 1024:7.0f}KiB"
+                    )
+            finally:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Tag typeahead latency: the in-memory prefix index vs. asking the database.
+
+    python -m benchmarks.tag_index --tags 100000
+
+Seeds a throwaway SQLite file with tags named from one or two made-up words
+and Zipf-distributed usage, loads the index from it and times
+TagIndex.suggest for 1 to 4 typed letters. For comparison the same
+suggestions are read from the database with a range scan of the unique
+tag.normalized_name index, joined to the links for the usage counts (which
+have no index by tag, so each count scans them; only DATABASE_ROUNDS prefixes
+are timed that way).
+"""
+import argparse
+import itertools
+import random
+import statistics
+import string
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, insert, text
+from sqlmodel import Session, SQLModel
+
+from app.db.migrations import upgrade
+from app.models import Question, QuestionTagLink, Tag
+from app.services.tag_index import TagIndex
+
+LIMIT = 8
+DATABASE_ROUNDS = 20
+
+
+def tag_names(count: int) -> list[str]:
+    rng = random.Random(0)
+    names = {}
+    while len(names) < count:
+        words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 8))) for _ in range(rng.randint(1, 2))]
+        names[rng.choice(" -").join(words)] = None
+    return list(names)
+
+
+def seed(engine, names: list[str], links: int):
+    rng = random.Random(1)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(names) + 1)))
+    questions = links // 3
+    with Session(engine) as session:
+        session.execute(insert(Tag), [{"name": name} for name in names])
+        session.execute(insert(Question), [{"text": f"question {i}"} for i in range(questions)])
+        pairs = {
+            (rng.randint(1, questions), tag_id)
+            for tag_id in rng.choices(range(1, len(names) + 1), cum_weights=cum_weights, k=links)
+        }
+        session.execute(insert(QuestionTagLink), [
+            {"question_id": question_id, "tag_id": tag_id, "vote_sum": 0} for question_id, tag_id in pairs
+        ])
+        session.commit()
+
+
+def percentiles(latencies: list[float]) -> str:
+    latencies = sorted(latencies)
+    return (
+        f"p50={statistics.median(latencies) * 1000:7.3f}ms "
+        f"p99={latencies[int(len(latencies) * 0.99)] * 1000:7.3f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tags", type=int, default=100_000)
+    parser.add_argument("--links", type=int, default=1_000_000)
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    names = tag_names(args.tags)
+    rng = random.Random(2)
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{Path(tmp) / 'bench.db'}")
+        SQLModel.metadata.create_all(engine)
+        upgrade(engine)
+        seed(engine, names, args.links)
+
+        index = TagIndex()
+        with Session(engine) as session:
+            started = time.perf_counter()
+            index.reload(session)
+            print(f"loaded {len(index)} tags in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+            for letters in range(1, 5):
+                prefixes = [name[:letters] for name in rng.sample(names, 200)]
+                memory, database = [], []
+                for prefix in itertools.islice(itertools.cycle(prefixes), args.rounds):
+                    started = time.perf_counter()
+                    index.suggest(prefix, LIMIT)
+                    memory.append(time.perf_counter() - started)
+                for prefix in prefixes[:DATABASE_ROUNDS]:
+                    started = time.perf_counter()
+                    session.execute(text(
+                        "SELECT tag.id, tag.name, count(questiontaglink.question_id) AS uses FROM tag "
+                        "LEFT JOIN questiontaglink ON questiontaglink.tag_id = tag.id "
+                        "WHERE tag.normalized_name >= :start AND tag.normalized_name < :end "
+                        "GROUP BY tag.id ORDER BY uses DESC LIMIT :limit"
+                    ), {"start": prefix, "end": prefix + "\U0010ffff", "limit": LIMIT}).all()
+                    database.append(time.perf_counter() - started)
+                print(f"{letters} letter{'s' if letters > 1 else ' '}  index {percentiles(memory)}   database {percentiles(database)}")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Vote write throughput: one transaction per click vs. the write-behind buffer.
+
+    python -m benchmarks.vote_writes --threads 8 --seconds 5
+
+Runs against a throwaway SQLite file, never database.db. Clicks are skewed
+towards a few hot questions, like a question that was just shared.
+"""
+import argparse
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel
+
+from app.db.counters import count_vote_counter_drift
+from app.db.migrations import upgrade
+from app.models import Question, User
+from app.services import votes
+from app.services.vote_buffer import VoteBuffer
+
+
+def make_engine(path: Path, users: int, questions: int):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(engine)
+    upgrade(engine)
+    with Session(engine) as session:
+        session.execute(insert(User), [
+            {"email": f"user{i}@example.com", "username": f"user{i}", "hashed_password": "x"}
+            for i in range(users)
+        ])
+        session.execute(insert(Question), [{"text": f"Question {i}", "vote_sum": 0} for i in range(questions)])
+        session.commit()
+    return engine
+
+
+def run(cast, args) -> tuple[int, int]:
+    clicks = 0
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+
+    def worker(seed: int):
+        nonlocal clicks, errors
+        rng = random.Random(seed)
+        done = failed = 0
+        while time.perf_counter() < deadline:
+            question_id = rng.randint(1, args.hot) if rng.random() < 0.8 else rng.randint(1, args.questions)
+            try:
+                cast(rng.randint(1, args.users), question_id, rng.choice((1, -1)))
+                done += 1
+            except OperationalError:
+                failed += 1
+        with lock:
+            clicks += done
+            errors += failed
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clicks, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--hot", type=int, default=3, help="number of hot questions receiving 80%% of clicks")
+    parser.add_argument("--flush-interval-ms", type=int, default=200)
+    parser.add_argument("--max-entries", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = make_engine(Path(tmp) / "direct.db", args.users, args.questions)
+
+        def cast_direct(user_id, question_id, vote_value):
+            with Session(engine) as session:
+                votes.cast_question_vote(session, user_id, question_id, vote_value)
+
+        clicks, errors = run(cast_direct, args)
+        with Session(engine) as session:
+            drift = count_vote_counter_drift(session)
+        print(f"direct:       {clicks / args.seconds:10.0f} clicks/s  {clicks:8d} commits  {errors} errors  drift={drift}")
+        engine.dispose()
+
+        engine = make_engine(Path(tmp) / "buffered.db", args.users, args.questions)
+        buffer = VoteBuffer(engine, args.flush_interval_ms, args.max_entries)
+        buffer.start()
+
+        def cast_buffered(user_id, question_id, vote_value):
+            with Session(engine) as session:
+                buffer.cast_question_vote(session, user_id, question_id, vote_value)
+
+        clicks, errors = run(cast_buffered, args)
+        buffer.stop()
+        with Session(engine) as session:
+            drift = count_vote_counter_drift(session)
+        print(
+            f"write-behind: {clicks / args.seconds:10.0f} clicks/s  {buffer.flushed_batches:8d} commits  {errors} errors  "
+            f"drift={drift}  ({buffer.flushed_votes} rows written)"
+        )
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()